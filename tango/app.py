@@ -1,14 +1,29 @@
 "Core Tango classes for creating applications from Tango sites."
 
+import Queue
+import calendar
+import hashlib
+import os
+import sys
+import threading
+
 from flask import Flask, request
 from jinja2 import Environment, PackageLoader, TemplateNotFound
 from werkzeug import create_environ
 
-from tango.errors import NoSuchWriterException
+from tango import instrument
+from tango.cache import LRUCache
+from tango.errors import NoSuchWriterException, ShelfError
+from tango.http import ENCODINGS, compress, is_compressible
 from tango.imports import module_exists, module_is_package
 from tango.imports import package_submodule, namespace_segments
-from tango.imports import fix_import_name_if_pyfile
-from tango.stash import build_module_routes
+from tango.imports import fix_import_name_if_pyfile, module_index
+from tango.incremental import InputFinder, load_state, plan_run, save_state
+from tango.manifest import compile_manifest, load_manifest, write_manifest
+from tango.shelf import CachingConnector
+from tango.stash import build_module_routes, merge_routes, parse_module_routes
+from tango.stash import parse_interval, parse_size, pull_module_routes
+from tango.stash import stream_module_routes, use_header_cache_dir
 from tango.writers import TemplateWriter, TextWriter, JsonWriter
 import tango.filters
 
@@ -40,6 +55,14 @@ class Tango(Flask):
         # config after Tango instance creation.
         self.default_writer = None
 
+        # The shelf connector, created on first use of the shelf property,
+        # along with the config options used to create it.
+        self.shelf_connector = None
+        self.shelf_options = None
+
+        # The response cache, created on first use, see cached_response.
+        self.response_cache = None
+
     def set_default_config(self):
         self.config.from_object('tango.config')
 
@@ -75,50 +98,539 @@ class Tango(Flask):
             return writer
         raise NoSuchWriterException(name)
 
+    def create_shelf(self):
+        "Create a shelf connector for this app, as given in its config."
+        connector = self.config['SHELF_CONNECTOR_CLASS'](self)
+        if self.config['SHELF_CACHE']:
+            connector = CachingConnector(self, connector)
+        return connector
+
     @property
     def shelf(self):
-        return self.config['SHELF_CONNECTOR_CLASS'](self)
+        """The shelf connector of this app, shared across requests.
 
-    def shelve(self, logfile=None):
-        """Shelve the route contexts of this app.
+        The connector is created on first use, and created again only if
+        SHELF_CONNECTOR_CLASS or SHELF_CACHE changes in the app's config:
+        >>> app = Tango.build_app('simplest')
+        >>> app.shelf is app.shelf
+        True
+        >>> app.shelf # doctest:+ELLIPSIS
+        <tango.shelf.SqliteConnector object at 0x...>
+        >>> app.config['SHELF_CACHE'] = True
+        >>> app.shelf # doctest:+ELLIPSIS
+        <tango.shelf.CachingConnector object at 0x...>
+        >>>
+        """
+        options = (self.config['SHELF_CONNECTOR_CLASS'],
+                   self.config['SHELF_CACHE'])
+        if self.shelf_options != options:
+            if self.shelf_connector is not None:
+                self.shelf_connector.close()
+            self.shelf_connector = self.create_shelf()
+            self.shelf_options = options
+        return self.shelf_connector
+
+    def shelve(self, logfile=None, routes=None):
+        """Shelve the route contexts of this app, or of the given routes.
+
+        All routes are written to the shelf as one new generation of the
+        site, which readers see only once the whole run is written. With
+        SHELVE_RESPONSE_BODIES set in config, each route's writer also encodes
+        its response body here, if it can, to store next to the context.
 
         Does not return anything, and inherently has side-effects:
         >>> Tango.build_app('simplest').shelve()
         >>>
         """
-        for route in self.routes:
-            site, rule, context = route.site, route.rule, route.context
-            source_files = route.source_files
-            if logfile is not None:
-                logfile.write('Stashing {0} {1} ... '.format(site, rule))
-            self.shelf.put(site, rule, context, source_files)
+        if routes is None:
+            routes = self.routes
+
+        def items():
+            for route in routes:
+                if logfile is not None:
+                    logfile.write('Stashing {0} {1} ... '.format(route.site,
+                                                                 route.rule))
+                yield self.shelf_item(route)
+                # The shelf asks for the next item once this one is written.
+                if logfile is not None:
+                    logfile.write('done.\n')
+        self.shelf.put_many(items())
+
+    def shelve_stream(self, modified_only=False, logfile=None, jobs=1):
+        """Shelve the route contexts of this app, streaming module by module.
+
+        Rather than pulling every context before writing any, as with shelve
+        after build_app with import_stash, each stash module's routes are
+        handed to a writer thread as soon as the module is pulled, see
+        stream_module_routes. The writer writes them while the next module
+        loads, and each context is released once written, such that memory
+        stays flat however many modules the site has.
+
+        Routes wait for the writer in a queue of at most SHELVE_QUEUE_SIZE
+        routes, and the writer commits every SHELVE_BATCH_SIZE routes. As
+        with shelve, readers see none of the run until all of it is written,
+        and a run which fails is not seen at all. A write which fails stops
+        the run at the next route pulled, raising the writer's error.
+
+        Does not return anything, and inherently has side-effects:
+        >>> app = Tango.build_app('testsite')
+        >>> app.shelve_stream()
+        >>> app.shelf.get('test', '/')
+        {'title': 'Tango'}
+        >>>
+        """
+        if logfile is not None:
+            # Both threads log, so keep their lines whole.
+            logfile = LineLog(logfile)
+        queue = Queue.Queue(self.config['SHELVE_QUEUE_SIZE'])
+        done, abort = object(), object()
+        errors = []
+
+        def items():
+            while True:
+                route = queue.get()
+                if route is done:
+                    return
+                if route is abort:
+                    raise ShelfError('Shelve run aborted.')
+                site, rule = route.site, route.rule
+                item = self.shelf_item(route)
+                del route
+                yield item
+                # The shelf asks for the next item once this one is written.
+                del item
+                if logfile is not None:
+                    logfile.write('Stashing {0} {1} ... done.\n'
+                                  .format(site, rule))
+
+        def write():
+            try:
+                batch_size = self.config['SHELVE_BATCH_SIZE']
+                self.shelf.put_many(items(), batch_size=batch_size)
+            except BaseException:
+                errors.append(sys.exc_info())
+
+        def put(route):
+            # Stop the run at the first write failure, rather than pull every
+            # remaining module for nothing, or wait on a full queue.
+            while not errors and writer.is_alive():
+                try:
+                    queue.put(route, timeout=0.1)
+                    return
+                except Queue.Full:
+                    pass
+            writer.join()
+            error_type, error, traceback = errors[0]
+            raise error_type, error, traceback
+
+        writer = threading.Thread(target=write, name='tango-shelve-writer')
+        writer.daemon = True
+        writer.start()
+        try:
+            with self.request_context(create_environ()):
+                timeout, memory = self.pull_limits()
+                for route in stream_module_routes(self.stash_module,
+                                                  modified_only=modified_only,
+                                                  logfile=logfile, jobs=jobs,
+                                                  timeout=timeout,
+                                                  memory=memory):
+                    put(route)
+                    del route
+        except:
+            error_type, error, traceback = sys.exc_info()
+            if not errors:
+                try:
+                    put(abort)
+                except:
+                    # The writer failed meanwhile; raise what stopped the run.
+                    pass
+            writer.join()
+            raise error_type, error, traceback
+        put(done)
+        writer.join()
+        if errors:
+            error_type, error, traceback = errors[0]
+            raise error_type, error, traceback
+
+    def shelve_incremental(self, logfile=None, jobs=1, force=None):
+        """Shelve the route contexts of stash modules whose inputs changed.
+
+        A stash module is pulled if it is new, failed in the last run, or if
+        its file or any local module it imports changed since it was last
+        pulled, see tango.incremental. Other modules are left as shelved,
+        unless force gives a reason to pull every module, e.g. a changed
+        config. Every module is pulled as well if the shelf is not the one
+        the last run wrote, or was written since, see shelf_state. The log
+        tells why each module was pulled or left. The state of each module is
+        kept in shelve_state_filepath, and updated once the run is written to
+        the shelf.
+
+        Does not return anything, and inherently has side-effects:
+        >>> app = Tango.build_app('simplest')
+        >>> app.shelve_incremental()
+        >>>
+        """
+        state_filepath = self.shelve_state_filepath()
+        shelf, state = load_state(state_filepath)
+        module_routes = parse_module_routes(self.stash_module)
+        finder = InputFinder()
+        if force is None and state and \
+                shelf != self.shelf_state(shelf['generations']):
+            force = 'shelf changed since last run'
+        if force is not None:
+            reasons = dict((name, force) for name, routes in module_routes)
+        else:
+            reasons = plan_run(module_routes, state, finder)
+
+        modules = {}
+        pulling = []
+        for name, routes in module_routes:
+            if reasons[name] is None:
+                if logfile is not None:
+                    logfile.write('Skipping {0}: unchanged.\n'.format(name))
+                modules[name] = state[name]
+                continue
             if logfile is not None:
-                logfile.write('done.\n')
+                logfile.write('Pulling {0}: {1}.\n'.format(name,
+                                                           reasons[name]))
+            pulling.append((name, routes))
+        names = [name for name, routes in pulling]
+
+        module_rules = [set(route.rule for route in routes)
+                        for name, routes in pulling]
+        route_collection = []
+        failed = set()
+        with self.request_context(create_environ()):
+            timeout, memory = self.pull_limits()
+            for index, routes in pull_module_routes(pulling, jobs, logfile,
+                                                    timeout, memory):
+                name = names[index]
+                if routes is None:
+                    # Failed in a child, and reported there; retry next run.
+                    # Its rules are left as shelved, as in build_module_routes.
+                    modules[name] = {'inputs': {}, 'ok': False}
+                    failed.update(module_rules[index])
+                    continue
+                modules[name] = {'inputs': finder.inputs(name), 'ok': True}
+                route_collection.append((index, routes))
+        route_collection.sort(key=lambda pair: pair[0])
+        routes = merge_routes([route for _, routes in route_collection
+                               for route in routes
+                               if route.rule not in failed])
+        self.shelve(logfile=logfile, routes=routes)
+        sites = set(route.site for name, routes in module_routes
+                    for route in routes)
+        save_state(state_filepath, modules, self.shelf_state(sites))
+
+    def pull_limits(self):
+        """Provide (timeout, memory) to pull each stash module by default.
+
+        These are SHELVE_MODULE_TIMEOUT and SHELVE_MODULE_MEMORY in config,
+        in seconds and bytes, where either may be None for no limit.
+        """
+        return (parse_interval(self.config['SHELVE_MODULE_TIMEOUT']),
+                parse_size(self.config['SHELVE_MODULE_MEMORY']))
+
+    def shelf_state(self, sites=None):
+        """Describe the shelf as of now, for shelve_incremental to compare.
+
+        Gives the shelf's filepath and the generation of each of the given
+        sites, as a dict of plain data.
+        """
+        filepath = os.path.abspath(self.config['SHELF_SQLITE_FILEPATH'])
+        return {'filepath': filepath,
+                'generations': dict((site, self.shelf.generation(site))
+                                    for site in sites or ())}
+
+    def shelve_state_filepath(self):
+        "Filepath of the state of incremental shelve runs of this app's stash."
+        stash = getattr(self.stash_module, '__name__', self.stash_module)
+        return os.path.join(self.config['SHELVE_STATE_DIR'], stash + '.state')
+
+    def shelf_item(self, route):
+        """Provide the arguments to put a route on the shelf, as a tuple.
+
+        With SHELVE_RESPONSE_BODIES set in config, the route's writer encodes
+        its response body here, if it can, to store next to the context.
+        """
+        instrument.note_route(route)
+        body = None
+        if self.config['SHELVE_RESPONSE_BODIES']:
+            with instrument.measure('serialize',
+                                    route=(route.site, route.rule)):
+                body = self.get_writer(route.writer_name).encode(route.context)
+        return (route.site, route.rule, route.context, route.source_files,
+                body)
 
     @classmethod
-    def shelve_by_name(cls, name, modified_only=False, logfile=None):
+    def shelve_by_name(cls, name, modified_only=False, logfile=None, jobs=1,
+                       stream=False, incremental=False, report=None):
         """Shelve the route contexts of an app matching import name.
 
-        Does not return anything, and inherently has side-effects:
+        With jobs greater than 1, stash modules are loaded in that many child
+        processes at once, see build_module_routes. With stream, routes are
+        written as each stash module is loaded, see shelve_stream. With
+        incremental, only modules whose inputs changed since they were last
+        shelved are loaded, see shelve_incremental. With report, a filepath,
+        each stage of the run is measured, see tango.instrument, and written
+        there as JSON, with a summary of the costliest modules in the log.
+
+        Returns the app built to shelve, e.g. to read its shelf afterwards:
         >>> Tango.shelve_by_name('simplest') # doctest:+ELLIPSIS
         <tango.app.Tango object at 0x...>
+        >>> Tango.shelve_by_name('testsite', stream=True) # doctest:+ELLIPSIS
+        <tango.app.Tango object at 0x...>
         >>>
         """
-        app = cls.build_app(name, import_stash=True, modified_only=modified_only, logfile=logfile)
-        app.shelve(logfile=logfile)
+        # Each run sees modules as they are now, e.g. for modified_only.
+        module_index.invalidate()
+        if report is not None:
+            instrument.start()
+        try:
+            if incremental:
+                app = cls.build_app(name)
+                app.shelve_incremental(logfile=logfile, jobs=jobs)
+            elif stream:
+                app = cls.build_app(name, modified_only=modified_only)
+                app.shelve_stream(modified_only=modified_only,
+                                  logfile=logfile, jobs=jobs)
+            else:
+                app = cls.build_app(name, import_stash=True,
+                                    modified_only=modified_only,
+                                    logfile=logfile, jobs=jobs)
+                app.shelve(logfile=logfile)
+        finally:
+            # Leave a recorder started by the caller to the caller.
+            if report is not None:
+                recorder = instrument.finish()
+        if report is not None:
+            instrument.write_report(report, recorder)
+            if logfile is not None:
+                for line in instrument.summary(recorder):
+                    logfile.write(line + '\n')
         return app
 
+    @classmethod
+    def compile_by_name(cls, name):
+        """Write the route manifest of an app matching import name.
+
+        Routes are discovered whether or not there is a fresh manifest, and
+        the manifest is written to manifest_filepath, for build_app to load.
+        Returns the app.
+
+        >>> import shutil, tempfile
+        >>> import tango.config
+        >>> manifest_dir = tango.config.ROUTE_MANIFEST_DIR
+        >>> tango.config.ROUTE_MANIFEST_DIR = tempfile.mkdtemp()
+        >>> app = Tango.compile_by_name('simplesite')
+        >>> os.path.exists(app.manifest_filepath('simplesite'))
+        True
+        >>> shutil.rmtree(tango.config.ROUTE_MANIFEST_DIR)
+        >>> tango.config.ROUTE_MANIFEST_DIR = manifest_dir
+        >>>
+        """
+        import_name = fix_import_name_if_pyfile(name)
+        app = cls.build_app(import_name, use_manifest=False)
+        stash = getattr(app.stash_module, '__name__', app.stash_module)
+        manifest = compile_manifest(import_name, stash, app.routes)
+        write_manifest(app.manifest_filepath(import_name), manifest)
+        return app
+
+    def manifest_filepath(self, import_name):
+        "Filepath of the route manifest of this app's given import name."
+        return os.path.join(self.config['ROUTE_MANIFEST_DIR'],
+                            import_name + '.manifest')
+
     def build_view(self, route, **options):
         site = route.site
         rule = route.rule
         writer = self.get_writer(route.writer_name)
-        def view(*args, **kwargs):
+        def render(generation=None):
+            keys = None
+            if self.config['SHELF_LAYOUT'] == 'exports':
+                # Load only those exports which the writer reads.
+                keys = writer.context_keys()
+            entry = self.shelf.fetch(site, rule, generation, keys=keys)
+            if entry is None:
+                context, body = {}, None
+            else:
+                context, body = entry.context, entry.body
             # Pass the actual request object, and not a proxy.
-            return writer(request._get_current_object(),
-                          self.shelf.get(site, rule))
+            return writer(request._get_current_object(), context, body=body)
+        def view(*args, **kwargs):
+            if self.debug:
+                return render()
+            generation = None
+            if self.config['RESPONSE_CACHE'] or \
+                    self.config['RESPONSE_VALIDATORS']:
+                # Read the generation first, and pin the response to it, such
+                # that its validators match the route as rendered.
+                generation = self.shelf.generation(site)
+            def respond():
+                if self.config['RESPONSE_CACHE']:
+                    return self.cached_response(route, kwargs, render,
+                                                generation)
+                return render(generation)
+            return self.conditional_response(route, kwargs, generation,
+                                             respond)
         view.__name__ = route.rule
         return self.route(route.rule, **options)(view)
 
+    def conditional_response(self, route, view_args, generation, respond):
+        """Serve a route's response, or 304 Not Modified if the client has it.
+
+        With RESPONSE_VALIDATORS set, the route's stamp in the given shelf
+        generation, or the latest if None, gives the response's ETag, see
+        response_etag, and its Last-Modified time, see BaseConnector.stamp. A
+        request whose If-None-Match, or else If-Modified-Since, header shows
+        the client has the response gets 304, and respond is not called; the
+        route is not read from the shelf. Otherwise, respond is called for the
+        response. Responses with status 200 or 304 get the route's max_age, if
+        any.
+
+        >>> app = Tango.build_app('testsite')
+        >>> app.config['RESPONSE_VALIDATORS'] = True
+        >>> client = app.test_client()
+        >>> response = client.get('/index.json')
+        >>> etag = response.headers['ETag']
+        >>> client.get('/index.json',
+        ...            headers={'If-None-Match': etag}).status_code
+        304
+        >>>
+        """
+        etag = shelved_at = encoding = None
+        if self.config['RESPONSE_VALIDATORS']:
+            stamp = self.shelf.stamp(route.site, route.rule, generation)
+            if stamp is not None:
+                digest, shelved_at = stamp
+                etag = response_etag(digest, route.writer_name, view_args)
+        modified = True
+        if etag is not None and request.if_none_match:
+            # Compressed variants have ETags of their own, see variant_etag.
+            for variant in (None,) + ENCODINGS:
+                if request.if_none_match.contains(variant_etag(etag, variant)):
+                    modified, encoding = False, variant
+                    break
+        elif shelved_at is not None and request.if_modified_since:
+            since = calendar.timegm(request.if_modified_since.utctimetuple())
+            # HTTP dates are to the second.
+            modified = int(shelved_at) > since
+        if modified:
+            response = respond()
+            encoding = response.content_encoding
+        else:
+            response = self.response_class(status=304)
+        if response.status_code in (200, 304):
+            if etag is not None:
+                response.set_etag(variant_etag(etag, encoding))
+            if shelved_at is not None:
+                response.last_modified = shelved_at
+            if route.max_age is not None:
+                response.cache_control.max_age = int(route.max_age)
+            if self.config['RESPONSE_CACHE'] and \
+                    self.config['RESPONSE_COMPRESS']:
+                response.vary.add('Accept-Encoding')
+        return response
+
+    def cached_response(self, route, view_args, render, generation=None):
+        """Serve a route's response from the response cache, or render it.
+
+        Responses are kept by site, rule, writer and view args, along with the
+        site's shelf generation they were rendered in, which is read first on
+        each request unless given, and the route's digest in that generation.
+        A response of an earlier generation is served if the route's digest is
+        the same. Otherwise, render is called with the generation to render,
+        and a response with status 200 is kept, bounded by
+        RESPONSE_CACHE_MAX_BYTES and RESPONSE_CACHE_MAX_ENTRIES. Compressed
+        variants of the response are made as it is kept, see
+        compressed_variants, and served to requests which accept them.
+
+        Enable with RESPONSE_CACHE in the app's config:
+        >>> app = Tango.build_app('testsite')
+        >>> app.config['RESPONSE_CACHE'] = True
+        >>> client = app.test_client()
+        >>> client.get('/index.json').data == client.get('/index.json').data
+        True
+        >>> len(app.response_cache)
+        1
+        >>>
+        """
+        if self.response_cache is None:
+            self.response_cache = LRUCache(
+                max_entries=self.config['RESPONSE_CACHE_MAX_ENTRIES'],
+                max_bytes=self.config['RESPONSE_CACHE_MAX_BYTES'])
+        site, rule = route.site, route.rule
+        key = (site, rule, route.writer_name,
+               tuple(sorted(view_args.items())))
+        if generation is None:
+            generation = self.shelf.generation(site)
+        cached = self.response_cache.get(key)
+        if cached is not None and cached[0] != generation:
+            # Keep a response which is unchanged in a later generation, as
+            # told by the route's content hash, rather than rendering again.
+            if cached[1] is not None and \
+                    self.shelf.digest(site, rule, generation) == cached[1]:
+                cached = (generation,) + cached[1:]
+                self.response_cache.set(key, cached, len(cached[2]) +
+                                        sum(len(variant) for variant
+                                            in cached[5].values()))
+            else:
+                cached = None
+        if cached is not None:
+            generation, digest, data, status, headers, variants = cached
+            return self.encoded_response(data, status, headers, variants)
+        digest = self.shelf.digest(site, rule, generation)
+        # Render as of the generation read, such that the response matches
+        # the generation it is kept with.
+        response = render(generation)
+        if response.status_code != 200 or response.is_streamed:
+            return response
+        data, status, headers = response.data, response.status, \
+            list(response.headers)
+        variants = self.compressed_variants(response)
+        self.response_cache.set(key, (generation, digest, data, status,
+                                      headers, variants),
+                                len(data) + sum(len(variant) for variant
+                                                in variants.values()))
+        return self.encoded_response(data, status, headers, variants)
+
+    def compressed_variants(self, response):
+        """Compress a rendered response's body, once for each of ENCODINGS.
+
+        Gives a dict of content coding to compressed body, which is empty if
+        RESPONSE_COMPRESS is not set, if the response's mimetype is not
+        compressible, see is_compressible, or if the body is smaller than
+        RESPONSE_COMPRESS_MIN_BYTES. Variants no smaller than the body are
+        left out.
+        """
+        data = response.data
+        if not self.config['RESPONSE_COMPRESS'] or \
+                response.content_encoding is not None or \
+                len(data) < self.config['RESPONSE_COMPRESS_MIN_BYTES'] or \
+                not is_compressible(response.mimetype):
+            return {}
+        variants = {}
+        for encoding in ENCODINGS:
+            variant = compress(data, encoding,
+                               self.config['RESPONSE_COMPRESS_LEVEL'])
+            if len(variant) < len(data):
+                variants[encoding] = variant
+        return variants
+
+    def encoded_response(self, data, status, headers, variants):
+        """Build a response from the response cache, for the current request.
+
+        Serve the compressed variant which the request accepts, if any, by its
+        Accept-Encoding header, and the body as rendered otherwise.
+        """
+        response = self.response_class(data, status=status, headers=headers)
+        encoding = request.accept_encodings.best_match(
+            [encoding for encoding in ENCODINGS if encoding in variants])
+        if encoding is not None:
+            response.data = variants[encoding]
+            response.content_encoding = encoding
+        return response
+
     @classmethod
     def get_app(cls, import_name, **options):
         """Get a Tango app object from a site by the given import name.
@@ -171,7 +683,8 @@ class Tango(Flask):
         return cls.build_app(import_name, **options)
 
     @classmethod
-    def build_app(cls, import_name, modified_only=False, import_stash=False, logfile=None):
+    def build_app(cls, import_name, modified_only=False, import_stash=False,
+                  logfile=None, jobs=1, use_manifest=True):
         """Create a Tango application object from a Python import name.
 
         This function accepts three kinds of import names:
@@ -235,6 +748,27 @@ class Tango(Flask):
         <tango.app.Tango object at 0x...>
         >>>
 
+        Once written with compile_by_name, e.g. `tango compile`, a route
+        manifest is loaded in place of discovering stash modules, for as long
+        as none of the stash's files changed, unless use_manifest is False or
+        contexts are pulled with import_stash:
+        >>> import shutil, tempfile
+        >>> import tango.config
+        >>> manifest_dir = tango.config.ROUTE_MANIFEST_DIR
+        >>> tango.config.ROUTE_MANIFEST_DIR = tempfile.mkdtemp()
+        >>> app = Tango.compile_by_name('testsite')
+        >>> app = Tango.build_app('testsite')
+        >>> app.stash_module
+        'testsite.stash'
+        >>> len(app.routes)
+        7
+        >>> Tango.build_app('testsite', use_manifest=False).stash_module
+        ... # doctest:+ELLIPSIS
+        <module 'testsite.stash' from '...'>
+        >>> shutil.rmtree(tango.config.ROUTE_MANIFEST_DIR)
+        >>> tango.config.ROUTE_MANIFEST_DIR = manifest_dir
+        >>>
+
         Avoids import side effects:
         >>> Tango.build_app('importerror.py') # doctest:+ELLIPSIS
         <tango.app.Tango object at 0x...>
@@ -260,6 +794,7 @@ class Tango(Flask):
         # Check for a site config.
         if module_exists(import_name + '.config'):
             app.config.from_object(import_name + '.config')
+        use_header_cache_dir(app.config['HEADER_CACHE_DIR'])
 
         # Push app context onto request stack for use in initialization.
         # Use `with` or try-finally, ensure context is popped in case of error.
@@ -272,11 +807,23 @@ class Tango(Flask):
             build_options = {'import_stash': import_stash}
             build_options['logfile'] = logfile
             build_options['modified_only'] = modified_only
-            if module_exists(import_name + '.stash'):
-                module = __import__(import_name, fromlist=['stash']).stash
-                app.routes = build_module_routes(module, **build_options)
+            build_options['jobs'] = jobs
+            build_options['timeout'], build_options['memory'] = \
+                app.pull_limits()
+            manifest = None
+            if use_manifest and not import_stash and not modified_only:
+                manifest = load_manifest(app.manifest_filepath(import_name),
+                                         import_name)
+            if manifest is not None:
+                app.stash_module, app.routes = manifest
             else:
-                app.routes = build_module_routes(import_name, **build_options)
+                if module_exists(import_name + '.stash'):
+                    app.stash_module = __import__(import_name,
+                                                  fromlist=['stash']).stash
+                else:
+                    app.stash_module = import_name
+                app.routes = build_module_routes(app.stash_module,
+                                                 **build_options)
 
             # Stitch together context, template, and path.
             for route in app.routes:
@@ -300,6 +847,68 @@ class Tango(Flask):
         return app
 
 
+def response_etag(digest, writer_name, view_args):
+    """Provide the ETag of a route's response, as rendered from its digest.
+
+    Responses differ by writer and view args, rendered from the same route:
+    >>> digest = 'c0ffee:'
+    >>> response_etag(digest, 'json', {}) == response_etag(digest, 'json', {})
+    True
+    >>> response_etag(digest, 'json', {}) == response_etag(digest, None, {})
+    False
+    >>> response_etag(digest, None, {'argument': 'spam'}) == \\
+    ...     response_etag(digest, None, {'argument': 'eggs'})
+    False
+    >>>
+    """
+    etag = hashlib.sha1(digest)
+    etag.update('\0{0}\0'.format(writer_name or ''))
+    etag.update(repr(sorted(view_args.items())))
+    return etag.hexdigest()
+
+
+def variant_etag(etag, encoding=None):
+    """Provide the ETag of a response compressed with a content coding.
+
+    >>> variant_etag('c0ffee'), variant_etag('c0ffee', 'gzip')
+    ('c0ffee', 'c0ffee-gzip')
+    >>>
+    """
+    if encoding is None:
+        return etag
+    return '{0}-{1}'.format(etag, encoding)
+
+
+class LineLog(object):
+    """Log file wrapper which writes whole lines only, shared by threads.
+
+    Each thread's writes are buffered up to the end of a line, such that
+    lines logged by different threads do not run into each other:
+    >>> import sys
+    >>> log = LineLog(sys.stdout)
+    >>> log.write('Loading module ... ')
+    >>> log.write('done.\\n')
+    Loading module ... done.
+    >>>
+    """
+
+    def __init__(self, logfile):
+        self.logfile = logfile
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def write(self, text):
+        text = getattr(self.local, 'partial', '') + text
+        lines, newline, self.local.partial = text.rpartition('\n')
+        if newline:
+            with self.lock:
+                self.logfile.write(lines + newline)
+                self.logfile.flush()
+
+    def flush(self):
+        "Flush nothing, as only whole lines are written."
+
+
 class TemplateLoader(PackageLoader):
     """Template loader which looks for defaults.
 
@@ -0,0 +1,126 @@
+"Bounded in-process caches for use within the Tango framework."
+
+import threading
+
+
+class LRUCache(object):
+    """A least-recently-used cache, bounded by entry count and by bytes.
+
+    The caller gives the size of each value in bytes when setting it. Once
+    either bound is exceeded, the least recently used entries are evicted.
+    A bound of None is no bound. Safe to share between threads.
+
+    Example:
+    >>> cache = LRUCache(max_entries=2)
+    >>> cache.set('a', 1)
+    >>> cache.set('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.set('c', 3)
+    >>> cache.get('b') is None
+    True
+    >>> sorted(cache.keys())
+    ['a', 'c']
+    >>>
+
+    Bounded by bytes, where a value larger than the bound is not kept:
+    >>> cache = LRUCache(max_bytes=10)
+    >>> cache.set('a', 'aaaa', size=4)
+    >>> cache.set('b', 'bbbbbb', size=6)
+    >>> cache.size
+    10
+    >>> cache.set('c', 'cc', size=2)
+    >>> sorted(cache.keys())
+    ['b', 'c']
+    >>> cache.set('d', 'd' * 11, size=11)
+    >>> sorted(cache.keys())
+    ['b', 'c']
+    >>> cache.pop('b')
+    'bbbbbb'
+    >>> len(cache), cache.size
+    (1, 2)
+    >>>
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        "Remove all entries."
+        # A dict of key to [prev, next, key, value, size] links, in a circular
+        # doubly linked list with the most recently used entry at root's next.
+        self.links = {}
+        self.root = root = []
+        root[:] = [root, root, None, None, 0]
+        self.size = 0
+
+    def __len__(self):
+        return len(self.links)
+
+    def __contains__(self, key):
+        return key in self.links
+
+    def keys(self):
+        return self.links.keys()
+
+    def get(self, key, default=None):
+        "Get the value at key, marking it as most recently used."
+        with self.lock:
+            link = self.links.get(key)
+            if link is None:
+                return default
+            self.unlink(link)
+            self.push(link)
+            return link[3]
+
+    def set(self, key, value, size=0):
+        "Set the value at key, with its size in bytes, and evict as needed."
+        with self.lock:
+            link = self.links.pop(key, None)
+            if link is not None:
+                self.unlink(link)
+                self.size -= link[4]
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            link = [None, None, key, value, size]
+            self.links[key] = link
+            self.push(link)
+            self.size += size
+            self.evict()
+
+    def pop(self, key, default=None):
+        "Remove the value at key, returning it."
+        with self.lock:
+            link = self.links.pop(key, None)
+            if link is None:
+                return default
+            self.unlink(link)
+            self.size -= link[4]
+            return link[3]
+
+    def evict(self):
+        "Drop least recently used entries until within bounds. Needs lock."
+        root = self.root
+        while self.links and (
+                (self.max_entries is not None and
+                 len(self.links) > self.max_entries) or
+                (self.max_bytes is not None and self.size > self.max_bytes)):
+            oldest = root[0]
+            self.unlink(oldest)
+            del self.links[oldest[2]]
+            self.size -= oldest[4]
+
+    def push(self, link):
+        "Insert link as most recently used. Needs lock."
+        root = self.root
+        first = root[1]
+        link[0], link[1] = root, first
+        root[1] = first[0] = link
+
+    def unlink(self, link):
+        "Remove link from the list. Needs lock."
+        prev, next = link[0], link[1]
+        prev[1], next[0] = next, prev
@@ -0,0 +1,252 @@
+"""Codecs which encode route contexts into bytes for storage on the shelf.
+
+A codec is registered by name. Encoding a context gives a tag along with the
+data, where the tag names the codec actually used plus any compression, e.g.
+'marshal' or 'pickle+zlib'. Shelf connectors store the tag next to the data,
+so that any stored context still decodes after the configured codec changes.
+
+The pickle codec handles any picklable context and is the default. The marshal
+and json codecs only handle plain data; contexts which do not round-trip
+through them are encoded with pickle instead. Neither is faster to decode
+than pickle on a typical context: with tests/bench_codecs.py on Python 2.7,
+a feed of 2000 plain dicts of byte and unicode strings, numbers and small
+lists decodes in 2.5ms from 76KB with pickle, 2.7ms from 294KB with marshal
+and 22.5ms from 361KB with json. Choose marshal or json for their formats,
+e.g. to read the shelf from other tools, not for speed.
+
+Example:
+>>> context = {u'title': u'Tango', u'count': [1, 2, 3]}
+>>> tag, data = encode(context, 'json')
+>>> tag
+'json'
+>>> decode(tag, data) == context
+True
+>>> tag, data = encode({'point': (1, 2)}, 'json')
+>>> tag
+'pickle'
+>>> decode(tag, data)
+{'point': (1, 2)}
+>>> tag, data = encode({'text': 'spam' * 1000}, 'marshal', threshold=1024)
+>>> tag, len(data) < 1024
+('marshal+zlib', True)
+>>> decode(tag, data) == {'text': 'spam' * 1000}
+True
+>>> decode('nosuchcodec', data)
+Traceback (most recent call last):
+  ...
+CodecError: No such codec: nosuchcodec
+>>>
+"""
+
+import cPickle as pickle
+import json
+import marshal
+import pickletools
+import zlib
+from cPickle import HIGHEST_PROTOCOL
+from cStringIO import StringIO
+
+from tango.errors import CodecError
+
+
+codecs = {}
+
+
+def register(codec):
+    "Register given codec instance under its name, for use in encode/decode."
+    codecs[codec.name] = codec
+    return codec
+
+
+def get_codec(name):
+    "Get a registered codec by name, raising CodecError if there is none."
+    codec = codecs.get(name)
+    if codec is None:
+        raise CodecError('No such codec: {0}'.format(name))
+    return codec
+
+
+def encode(context, name='pickle', threshold=None, level=6):
+    """Encode a context with the named codec, returning (tag, data).
+
+    Falls back to the pickle codec when the named codec cannot encode the
+    context. If threshold is given, data larger than threshold bytes is
+    compressed with zlib at the given level.
+    """
+    codec = get_codec(name)
+    try:
+        data = codec.encode(context)
+    except CodecError:
+        codec = get_codec('pickle')
+        data = codec.encode(context)
+    tag = codec.name
+    if threshold is not None and len(data) > threshold:
+        data = zlib.compress(data, level)
+        tag += '+zlib'
+    return tag, data
+
+
+def decode(tag, data):
+    "Decode data encoded as tag by encode, returning the context."
+    name, _, compression = tag.partition('+')
+    if compression == 'zlib':
+        data = zlib.decompress(data)
+    elif compression:
+        raise CodecError('No such compression: {0}'.format(compression))
+    return get_codec(name).decode(data)
+
+
+class BaseCodec(object):
+    """A codec, to encode contexts into bytes and decode them back.
+
+    A subclass must implement encode and decode, and raise CodecError from
+    encode for any context it cannot represent faithfully. Decode takes data
+    as a str, or as a buffer, e.g. of a mapped shelf snapshot, to be read
+    without copying it where the codec can:
+    >>> class IncompleteCodec(BaseCodec):
+    ...     "Does not implement the encode method."
+    ...
+    >>> IncompleteCodec().encode({})
+    Traceback (most recent call last):
+       ...
+    NotImplementedError: A codec must implement encode.
+    >>>
+    """
+
+    # Name of this codec, as registered and as stored in tags.
+    name = None
+
+    def encode(self, context):
+        raise NotImplementedError('A codec must implement encode.')
+
+    def decode(self, data):
+        raise NotImplementedError('A codec must implement decode.')
+
+
+class PickleCodec(BaseCodec):
+    "Encode any picklable context, with pickle size optimized."
+
+    name = 'pickle'
+
+    def encode(self, context):
+        return pickletools.optimize(pickle.dumps(context, HIGHEST_PROTOCOL))
+
+    def decode(self, data):
+        if isinstance(data, buffer):
+            # Read the buffer in place, as pickle.loads takes only a str.
+            return pickle.load(StringIO(data))
+        return pickle.loads(data)
+
+
+class MarshalCodec(BaseCodec):
+    """Encode contexts of core Python types only, in marshal's format.
+
+    Handles dict, list, tuple, set, str, unicode, int, long, float, bool and
+    None, but not objects such as dates, nor subclasses of those types:
+    >>> import datetime
+    >>> MarshalCodec().encode({'date': datetime.date(2012, 9, 13)})
+    Traceback (most recent call last):
+      ...
+    CodecError: unmarshallable object
+    >>> from jinja2 import Markup
+    >>> encode({'html': Markup('<b>')}, 'marshal')[0]
+    'pickle'
+    >>>
+    """
+
+    name = 'marshal'
+
+    def encode(self, context):
+        # Marshal writes objects of subclasses, e.g. jinja2's Markup, as raw
+        # buffers, which decode as other values; take exact types only.
+        if not of_types(context, MARSHAL_TYPES):
+            raise CodecError('unmarshallable object')
+        try:
+            return marshal.dumps(context, 2)
+        except ValueError, error:
+            raise CodecError(str(error))
+
+    def decode(self, data):
+        return marshal.loads(data)
+
+
+class JsonCodec(BaseCodec):
+    """Encode contexts which round-trip through JSON as equal values.
+
+    Byte strings are taken if ASCII, and decode as unicode strings equal to
+    them, as stash contexts are mostly byte strings. Tuples, non-string keys,
+    byte strings of other bytes and objects such as dates do not round-trip,
+    nor do subclasses such as OrderedDict or defaultdict, which decode as
+    their base type:
+    >>> JsonCodec().decode(JsonCodec().encode({'title': 'Tango'}))
+    {u'title': u'Tango'}
+    >>> JsonCodec().encode({1: u'one'})
+    Traceback (most recent call last):
+      ...
+    CodecError: context does not round-trip through json
+    >>> encode({'title': 'Tang\xc3\xb6'}, 'json')[0]
+    'pickle'
+    >>>
+    """
+
+    name = 'json'
+
+    def encode(self, context):
+        try:
+            # Decode byte strings as ASCII, failing on any other byte.
+            data = json.dumps(context, separators=(',', ':'),
+                              encoding='ascii')
+        except (TypeError, ValueError), error:
+            raise CodecError(str(error))
+        # Encoding is done at shelve time, so spend time here to verify.
+        if not of_types(context, JSON_TYPES) or json.loads(data) != context:
+            raise CodecError('context does not round-trip through json')
+        return data
+
+    def decode(self, data):
+        # The json module reads only strings; str of a str is no copy.
+        return json.loads(str(data))
+
+
+# Types of values which each codec gives back as they were, exactly, but for
+# byte strings in json, which must be ASCII and come back as unicode strings.
+MARSHAL_TYPES = frozenset([dict, list, tuple, set, frozenset, str, unicode,
+                           int, long, float, complex, bool, type(None)])
+JSON_TYPES = frozenset([dict, list, str, unicode, int, long, float, bool,
+                        type(None)])
+
+
+def of_types(value, types):
+    """Tell whether value, and every key and item within it, is of types.
+
+    Types must match exactly, not by isinstance:
+    >>> from collections import defaultdict
+    >>> of_types({'spam': ['eggs', 1]}, MARSHAL_TYPES)
+    True
+    >>> of_types({'spam': defaultdict(int)}, MARSHAL_TYPES)
+    False
+    >>>
+    """
+    stack = [value]
+    seen = set()
+    while stack:
+        value = stack.pop()
+        kind = type(value)
+        if kind not in types:
+            return False
+        if kind in (dict, list, tuple, set, frozenset):
+            # Do not walk a value held in two places, or in itself, twice.
+            if id(value) in seen:
+                continue
+            seen.add(id(value))
+            if kind is dict:
+                stack.extend(value.iterkeys())
+                stack.extend(value.itervalues())
+            else:
+                stack.extend(value)
+    return True
+
+
+register(PickleCodec())
+register(MarshalCodec())
+register(JsonCodec())
@@ -15,6 +15,134 @@ SHELF_CONNECTOR_CLASS = SqliteConnector
 # Note that getuser reads environment variables and can be easily spoofed.
 SHELF_SQLITE_FILEPATH = '/tmp/tango-%(user)s.db' % {'user': getuser()}
 
+# Codec to encode route contexts on the shelf, by name in tango.codec.
+# The 'marshal' and 'json' codecs only handle plain data, and other contexts
+# are stored with 'pickle' regardless. Neither decodes faster than 'pickle',
+# see tango.codec.
+SHELF_CODEC = 'pickle'
+
+# Layout of route contexts on the SQLite shelf: 'context' to store each
+# context whole, or 'exports' to store each export of a context on its own,
+# such that a route can be served loading only the exports its writer needs,
+# e.g. the variables referenced in its template.
+SHELF_LAYOUT = 'context'
+
+# Compress encoded contexts larger than this many bytes with zlib, if not None.
+SHELF_COMPRESS_THRESHOLD = None
+SHELF_COMPRESS_LEVEL = 6
+
+# Optionally encode each route's response body once at shelve time, and store
+# it on the shelf next to the context. Routes whose writer supports this, e.g.
+# 'json' and 'text' but not templates, then respond with the stored bytes.
+SHELVE_RESPONSE_BODIES = False
+
+# Filepath of a read-only snapshot of the shelf, exported from the SQLite shelf
+# with `tango snapshot`. Set SHELF_CONNECTOR_CLASS to SnapshotConnector in
+# serving processes to serve from it, checking for a newly published snapshot
+# at most once per given number of seconds.
+SHELF_SNAPSHOT_FILEPATH = '/tmp/tango-%(user)s.snapshot' % {'user': getuser()}
+SHELF_SNAPSHOT_CHECK_INTERVAL = 1
+
+# Number of prior generations of each site to keep on the SQLite shelf, to
+# roll back to with `tango rollback`. Each shelve run writes a generation,
+# which readers see all at once when the run completes.
+SHELF_KEEP_GENERATIONS = 2
+
+# Optionally cache route contexts in each serving process, read through to
+# the shelf connector above, and bounded by count and by bytes as stored.
+# Entries are checked against their site's shelf generation on each read.
+SHELF_CACHE = False
+SHELF_CACHE_MAX_ENTRIES = 1024
+SHELF_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Optionally cache rendered responses in each serving process, by site, rule,
+# writer and view args, and bounded by count and by bytes. As above, entries
+# are checked against their site's shelf generation on each request. Leave off
+# for templates which read more of the request than view args, e.g. its query
+# string. Not used in debug mode, such that template edits are seen.
+RESPONSE_CACHE = False
+RESPONSE_CACHE_MAX_ENTRIES = 4096
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# With RESPONSE_CACHE, keep gzip and deflate variants of each text response
+# too, compressed once as the response is rendered into the cache, and serve
+# them by the request's Accept-Encoding, with Vary: Accept-Encoding. Bodies
+# smaller than RESPONSE_COMPRESS_MIN_BYTES are not worth compressing.
+RESPONSE_COMPRESS = True
+RESPONSE_COMPRESS_LEVEL = 6
+RESPONSE_COMPRESS_MIN_BYTES = 256
+
+# Give each stash route's response an ETag, from the route's content hash on
+# the shelf along with its writer and view args, and a Last-Modified time, of
+# when the route was shelved. Clients sending these back in If-None-Match or
+# If-Modified-Since get 304 Not Modified, without the route being read. As
+# with RESPONSE_CACHE, not used in debug mode. A module's header may give a
+# Cache-Control max-age for its routes, e.g. `max_age: 5m`. Off by default, as
+# validators do not change with templates: after deploying template changes,
+# shelve again such that clients do not keep stale responses.
+RESPONSE_VALIDATORS = False
+
+# Optional limits on pulling the context of each stash module in a shelve run,
+# as seconds of wall-clock time and bytes of address space grown beyond what
+# the shelve run has, where /proc gives it. A limited module is pulled in a
+# child process, which is killed if it runs out of time, and a module which
+# fails leaves its routes as shelved. A module's header may set its own, e.g.
+# `timeout: 30s` and `memory: 512M`.
+SHELVE_MODULE_TIMEOUT = None
+SHELVE_MODULE_MEMORY = None
+
+# With `tango shelve --stream`, number of routes waiting to be written at most,
+# and number of routes written per commit. Readers still see the whole run at
+# once, when it completes.
+SHELVE_QUEUE_SIZE = 64
+SHELVE_BATCH_SIZE = 100
+
+# Directory of route manifests written by `tango compile`, which apps load in
+# place of discovering their stash modules, for as long as those are unchanged.
+# As with HEADER_CACHE_DIR, it is made private to the user, and manifests are
+# not loaded from it if another user owns it.
+ROUTE_MANIFEST_DIR = '/tmp/tango-%(user)s-manifests/' % {'user': getuser()}
+
+# Directory of the cache of stash module headers, which each build of an app
+# reads in place of modules unchanged since. It is made private to the user,
+# and not used if another user owns it. Empty to keep headers in memory only.
+HEADER_CACHE_DIR = '/tmp/tango-%(user)s-headers/' % {'user': getuser()}
+
+# Directory of the state of `tango shelve --incremental` runs, which records
+# the inputs of each stash module as of its last run, by content hash. As with
+# HEADER_CACHE_DIR, it is made private to the user, and state is not loaded
+# from it if another user owns it.
+SHELVE_STATE_DIR = '/tmp/tango-%(user)s-shelve-state/' % {'user': getuser()}
+
+# With `tango shelve --watch`, seconds between polls of the site's files, and
+# seconds files must stay unchanged before the site is shelved again, so that
+# a burst of edits, e.g. a checkout, gives one run.
+SHELVE_WATCH_INTERVAL = 1
+SHELVE_WATCH_DEBOUNCE = 0.5
+
+# With `tango schedule`, number of stash modules pulled at once at most, each
+# in a child process, and the fraction of a module's refresh interval by which
+# each of its refreshes is delayed at random, to spread out equal intervals.
+SCHEDULE_JOBS = 4
+SCHEDULE_JITTER = 0.1
+
+# With `tango serve --workers N`, number of worker processes by default, and
+# whether to warm the app's caches before forking them, by requesting each
+# route without view args. A worker is replaced after serving at most about
+# SERVE_MAX_REQUESTS requests, or once its resident memory grows by more than
+# SERVE_MAX_MEMORY since it was forked, e.g. '512M', where either is set. The
+# memory limit needs /proc, and is not applied without it. Every
+# SERVE_CHECK_INTERVAL seconds, workers are replaced gracefully if the shelf
+# has a new generation.
+SERVE_WORKERS = 4
+SERVE_WARM = True
+SERVE_MAX_REQUESTS = None
+SERVE_MAX_MEMORY = None
+SERVE_CHECK_INTERVAL = 1
+
+# With `tango export`, number of child processes rendering routes at once.
+EXPORT_JOBS = 4
+
 # Directory where last shelve time is stored. 
 SHELVE_TIME_DIR = '/tmp/shelve_time/'
 
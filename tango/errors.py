@@ -21,6 +21,18 @@ class ConfigurationError(TangoException):
     "Error in app.config, either a missing or wrongly set value."
 
 
+class ShelfError(TangoException):
+    "Error in reading or writing the shelf, e.g. writing to a snapshot."
+
+
+class ExportError(TangoException):
+    "Error in exporting a site to files, e.g. a route which fails to render."
+
+
+class CodecError(TangoException):
+    "Error when a context cannot be encoded or decoded for the shelf."
+
+
 class ModuleNotFound(TangoException):
     "Error when requiring a Python module, but it's filepath cannot be found."
 
@@ -43,3 +55,7 @@ class DuplicateExportWarning(DuplicateWarning):
 
 class DuplicateContextWarning(DuplicateWarning):
     "Route context item is replaced by a new route context in same project."
+
+
+class StashModuleWarning(TangoWarning):
+    "Stash module failed to load in a shelve run, and was left as shelved."
@@ -0,0 +1,298 @@
+"""Static export of a site, rendering each of its routes to a file.
+
+`tango export site outdir` renders every route of a site through its writer,
+as a request for the route would, into a tree of files along with the site's
+static files. A web server or CDN then serves the tree as is, with no Python
+on the request path, which suits sites whose routes change only as they are
+shelved. Routes with view args, e.g. /argument/<argument>/, are skipped, as
+there is no telling which paths they serve.
+
+Each route is written to the file of its rule, see rule_filepath. The tree's
+manifest, EXPORT_MANIFEST, gives the content hash and content type of each
+file. As a file's name need not tell its content type, CONTENT_TYPE_MAP gives
+the content type of each file by URI, for nginx to include in a map block:
+
+    map $uri $tango_content_type {
+        include /srv/site/.content-types.map;
+    }
+
+Routes are rendered in batches in child processes, up to EXPORT_JOBS at once.
+A file whose content hash is unchanged since the last export is linked from
+the last export's tree rather than written again, keeping its modification
+time. The new tree is built next to outdir, and swapped in atomically: outdir
+is a symlink to the current tree, replaced by rename, such that a web server
+sees either all of the last export or all of the new one. If any route fails
+to render, the last export is left in place.
+"""
+
+import errno
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import tempfile
+from functools import partial
+
+from tango.app import Tango
+from tango.errors import ExportError
+from tango.parallel import run_in_children
+
+
+# Version of the manifest format, written into each manifest.
+EXPORT_VERSION = 1
+
+# Names of the manifest and the nginx content type map, at the tree's root.
+EXPORT_MANIFEST = '.tango-export.json'
+CONTENT_TYPE_MAP = '.content-types.map'
+
+# Name of the file of a rule ending in a slash, as web servers look for.
+INDEX_FILENAME = 'index.html'
+
+# Number of batches of routes to render per job, to even out the load.
+BATCHES_PER_JOB = 4
+
+
+def export_by_name(name, outdir, jobs=None, logfile=None):
+    """Export the routes of an app matching import name to a tree at outdir.
+
+    Jobs defaults to EXPORT_JOBS in config. Returns the manifest, as in
+    export_site.
+    """
+    app = Tango.get_app(name)
+    if jobs is None:
+        jobs = app.config['EXPORT_JOBS']
+    return export_site(app, outdir, jobs=jobs, logfile=logfile)
+
+
+def export_site(app, outdir, jobs=1, logfile=None):
+    """Export the routes and static files of an app to a tree at outdir.
+
+    With jobs greater than 1, routes are rendered in that many child
+    processes. Returns the manifest of the new tree, a dict of each file's
+    path relative to outdir to its (content hash, content type).
+
+    Raise ExportError if a route fails to render, or if outdir exists but is
+    not the symlink of an export.
+    """
+    outdir = os.path.abspath(outdir)
+    previous = current_tree(outdir)
+    old_files = read_manifest(previous)
+    rules = []
+    for route in app.routes:
+        if '<' in route.rule:
+            log(logfile, 'Skipped {0}: has view args.'.format(route.rule))
+        else:
+            rules.append(route.rule)
+
+    parent, name = os.path.split(outdir)
+    ensure_dir(parent)
+    tree = tempfile.mkdtemp(dir=parent, prefix='.{0}.'.format(name))
+    try:
+        # Let the web server read the tree, as mkdtemp gives it to us only.
+        os.chmod(tree, 0755)
+        place = partial(place_file, tree, previous, old_files)
+        files, failures = render_rules(app, rules, place, jobs)
+        if failures:
+            raise ExportError('Failed to export {0} routes of {1}:\n{2}'
+                              .format(len(failures), app.import_name,
+                                      '\n'.join(failures)))
+        routes_count = len(files)
+        for filepath, data in static_files(app):
+            content_type = mimetypes.guess_type(filepath)[0] or \
+                'application/octet-stream'
+            record = place(filepath, data, content_type)
+            files[record[0]] = record[1:]
+        manifest = dict((filepath, (digest, content_type))
+                        for filepath, (digest, content_type, written)
+                        in files.items())
+        write_manifest(tree, manifest)
+        swap_tree(outdir, tree)
+    except:
+        shutil.rmtree(tree, ignore_errors=True)
+        raise
+    if previous is not None and previous != tree:
+        shutil.rmtree(previous, ignore_errors=True)
+    written = sum(1 for record in files.values() if record[2])
+    log(logfile, 'Exported {0} routes and {1} static files to {2}: '
+        '{3} written, {4} unchanged.'.format(
+            routes_count, len(files) - routes_count, outdir, written,
+            len(files) - written))
+    return manifest
+
+
+def render_rules(app, rules, place, jobs=1):
+    """Render rules of an app, each placed into the tree with place.
+
+    Gives (files, failures), where files is a dict of path to (content hash,
+    content type, whether written) as placed, and failures is a list of
+    messages of rules which failed to render.
+    """
+    if jobs > 1 and len(rules) > 1:
+        count = min(len(rules), jobs * BATCHES_PER_JOB)
+        batches = [rules[index::count] for index in range(count)]
+        results = []
+        for index, result, error in run_in_children(
+                partial(render_batch, app, place), batches, jobs=jobs):
+            if error is not None:
+                results.extend((rule, None, error) for rule in batches[index])
+            else:
+                results.extend(result)
+    else:
+        results = render_batch(app, place, rules)
+    files = {}
+    failures = []
+    for rule, record, error in sorted(results):
+        if error is not None:
+            failures.append('{0}: {1}'.format(rule, error.rstrip()))
+        else:
+            files[record[0]] = record[1:]
+    return files, failures
+
+
+def render_batch(app, place, rules):
+    """Render each rule of an app as a request for it, and place its file.
+
+    Gives a list of (rule, record, error) where record is as given by place,
+    and error is None on success or a message otherwise.
+    """
+    client = app.test_client()
+    results = []
+    for rule in rules:
+        response = client.get(rule)
+        if response.status_code != 200:
+            results.append((rule, None, 'responded {0}'
+                                        .format(response.status)))
+            continue
+        try:
+            record = place(rule_filepath(rule), response.data,
+                           response.headers.get('Content-Type'))
+        except (ExportError, EnvironmentError), error:
+            results.append((rule, None, str(error)))
+            continue
+        results.append((rule, record, None))
+    return results
+
+
+def place_file(tree, previous, old_files, filepath, data, content_type):
+    """Write data to filepath within tree, unless unchanged in the last export.
+
+    A file with the same content hash in the previous tree's manifest,
+    old_files, is linked from there instead. Gives (filepath, content hash,
+    content type, whether written).
+    """
+    digest = hashlib.sha1(data).hexdigest()
+    target = os.path.join(tree, filepath)
+    ensure_dir(os.path.dirname(target))
+    old = old_files.get(filepath)
+    if old is not None and old[0] == digest:
+        try:
+            os.link(os.path.join(previous, filepath), target)
+            return filepath, digest, content_type, False
+        except OSError:
+            # Write it anew, e.g. if the old file is gone.
+            pass
+    if os.path.lexists(target):
+        # Never write through a link into the last export's tree.
+        os.remove(target)
+    with open(target, 'wb') as fd:
+        fd.write(data)
+    return filepath, digest, content_type, True
+
+
+def rule_filepath(rule):
+    """Provide the path of a rule's file, relative to the tree's root.
+
+    >>> rule_filepath('/'), rule_filepath('/feeds/'), rule_filepath('/a.json')
+    ('index.html', 'feeds/index.html', 'a.json')
+    >>> rule_filepath('/../etc/passwd')
+    Traceback (most recent call last):
+      ...
+    ExportError: not a path within the tree: /../etc/passwd
+    >>>
+    """
+    filepath = rule.lstrip('/')
+    if not filepath or filepath.endswith('/'):
+        filepath += INDEX_FILENAME
+    if os.path.normpath(filepath) != filepath or filepath.startswith('..'):
+        raise ExportError('not a path within the tree: {0}'.format(rule))
+    return filepath
+
+
+def static_files(app):
+    "Iterate over (path in tree, data) of each static file of an app."
+    if not app.has_static_folder:
+        return
+    prefix = app.static_url_path.strip('/')
+    for dirpath, dirnames, filenames in os.walk(app.static_folder):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            filepath = os.path.join(dirpath, filename)
+            relpath = os.path.relpath(filepath, app.static_folder)
+            with open(filepath, 'rb') as fd:
+                yield os.path.join(prefix, relpath), fd.read()
+
+
+def current_tree(outdir):
+    """Provide the path of the tree which outdir links to, or None if none.
+
+    Raise ExportError if outdir exists but is not a symlink, as an export
+    would then replace something other than an export.
+    """
+    if os.path.islink(outdir):
+        return os.path.realpath(outdir)
+    if os.path.exists(outdir):
+        raise ExportError('{0} exists but is not an export, i.e. a symlink '
+                          'to a tree; move it aside first.'.format(outdir))
+    return None
+
+
+def read_manifest(tree):
+    "Read the manifest of an exported tree, or give {} if there is none."
+    if tree is None:
+        return {}
+    try:
+        with open(os.path.join(tree, EXPORT_MANIFEST)) as fd:
+            manifest = json.load(fd)
+    except (IOError, ValueError):
+        return {}
+    if not isinstance(manifest, dict) or \
+            manifest.get('version') != EXPORT_VERSION:
+        return {}
+    return manifest['files']
+
+
+def write_manifest(tree, files):
+    "Write the manifest and the nginx content type map of a tree."
+    with open(os.path.join(tree, EXPORT_MANIFEST), 'w') as fd:
+        json.dump({'version': EXPORT_VERSION, 'files': files}, fd, indent=1,
+                  sort_keys=True)
+    with open(os.path.join(tree, CONTENT_TYPE_MAP), 'w') as fd:
+        for filepath, (digest, content_type) in sorted(files.items()):
+            fd.write('"/{0}" "{1}";\n'.format(filepath, content_type))
+
+
+def swap_tree(outdir, tree):
+    "Point outdir at tree, by renaming a new symlink over outdir at once."
+    link = tree + '.link'
+    # Link by relative path, such that outdir's parent can be moved.
+    os.symlink(os.path.basename(tree), link)
+    try:
+        os.rename(link, outdir)
+    except OSError:
+        os.remove(link)
+        raise
+
+
+def ensure_dir(dirpath):
+    "Make dirpath and its parents, if they do not exist, as children race to."
+    try:
+        os.makedirs(dirpath)
+    except OSError, error:
+        if error.errno != errno.EEXIST:
+            raise
+
+
+def log(logfile, line):
+    if logfile is not None:
+        logfile.write(line + '\n')
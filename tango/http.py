@@ -1,9 +1,25 @@
 "Tango's WSGI wrappers for request and response."
 
+import zlib
+
 from flask import Request as BaseRequest
 from flask import Response as BaseResponse
 
 
+# Content codings which Tango compresses responses with, in order of
+# preference where a request accepts more than one.
+ENCODINGS = ('gzip', 'deflate')
+
+# Mimetypes of compressible responses, beside those of text/*.
+COMPRESSIBLE_MIMETYPES = frozenset(['application/json',
+                                    'application/javascript',
+                                    'application/xml',
+                                    'application/xhtml+xml',
+                                    'application/rss+xml',
+                                    'application/atom+xml',
+                                    'image/svg+xml'])
+
+
 # Currently just class declarations to provide an extensible namespace.
 
 class Request(BaseRequest):
@@ -12,3 +28,44 @@ class Request(BaseRequest):
 
 class Response(BaseResponse):
     "The response object contains the body, headers, status code, ..."
+
+
+def compress(data, encoding, level=6):
+    """Compress bytes with a content coding of ENCODINGS.
+
+    A gzip body has no file name or time in its header, such that the same
+    data always compresses the same:
+    >>> import gzip, StringIO
+    >>> body = compress('Tango ' * 100, 'gzip')
+    >>> body == compress('Tango ' * 100, 'gzip')
+    True
+    >>> gzip.GzipFile(fileobj=StringIO.StringIO(body)).read() == 'Tango ' * 100
+    True
+    >>> zlib.decompress(compress('Tango', 'deflate'))
+    'Tango'
+    >>>
+    """
+    if encoding == 'gzip':
+        # A window of 16 plus the maximum of 15 bits gives a gzip wrapper.
+        compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    if encoding == 'deflate':
+        # HTTP's deflate coding is the zlib format.
+        return zlib.compress(data, level)
+    raise ValueError('not a content coding of {0}: {1}'
+                     .format(', '.join(ENCODINGS), encoding))
+
+
+def is_compressible(mimetype):
+    """Tell whether responses of a mimetype are worth compressing.
+
+    >>> is_compressible('text/html'), is_compressible('application/json')
+    (True, True)
+    >>> is_compressible('image/png'), is_compressible(None)
+    (False, False)
+    >>>
+    """
+    if not mimetype:
+        return False
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_MIMETYPES
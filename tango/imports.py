@@ -3,6 +3,8 @@
 import imp
 import os
 import pkgutil
+import sys
+import tokenize
 import types
 
 
@@ -22,11 +24,19 @@ def get_module(name):
     >>> get_module('tango') # doctest:+ELLIPSIS
     <module 'tango' from '...'>
     >>>
+
+    A module removed from sys.modules is imported anew, even though its
+    package still holds the old module as an attribute:
+    >>> module = get_module('simplesite.stash')
+    >>> del sys.modules['simplesite.stash']
+    >>> get_module('simplesite.stash') is module
+    False
+    >>>
     """
-    packagename, base = package_submodule(name)
-    if packagename is None:
-        return __import__(base)
-    return getattr(__import__(packagename, fromlist=[base]), base)
+    # Look the module up in sys.modules, not as an attribute of its package,
+    # which __import__ gives without importing if it holds a stale module.
+    __import__(name)
+    return sys.modules[name]
 
 
 def get_module_docstring(filepath):
@@ -62,11 +72,47 @@ def get_module_docstring(filepath):
     routes:
     exports:
     >>>
+
+    Only the module's first statement is read and compiled, as a docstring
+    can only be the first statement, such that a long module costs no more
+    than a short one. A module whose first statement is not a string has no
+    docstring, whatever follows:
+    >>> print get_module_docstring(get_module_filepath('tango.app'))
+    Core Tango classes for creating applications from Tango sites.
+    >>> print get_module_docstring(get_module_filepath('tango.config'))
+    Default configuration for new Tango instances.
+    >>> print get_module_docstring(get_module_filepath('tango'))
+    None
+    >>>
     """
-    # Keep these operations on separate lines, for exception line numbers.
-    fd = open(filepath)
-    src = fd.read()
-    co = compile(src, filepath, 'exec')
+    lines = []
+    with open(filepath) as fd:
+        def readline():
+            line = fd.readline()
+            lines.append(line)
+            return line
+        tokens = tokenize.generate_tokens(readline)
+        try:
+            for token in tokens:
+                if token[0] in (tokenize.COMMENT, tokenize.NL):
+                    continue
+                if token[0] in (tokenize.NAME, tokenize.NUMBER,
+                                tokenize.ENDMARKER):
+                    # First statement is not an expression of a string.
+                    return None
+                if token[0] not in (tokenize.STRING, tokenize.OP):
+                    # e.g. a byte order mark; leave these to the compiler.
+                    raise tokenize.TokenError(token)
+                break
+            # Read to the end of the first statement, whatever its lines.
+            for token in tokens:
+                if token[0] in (tokenize.NEWLINE, tokenize.ENDMARKER):
+                    break
+            co = compile(''.join(lines), filepath, 'exec')
+        except (tokenize.TokenError, IndentationError, SyntaxError):
+            # Compile the whole file, for the compiler's own error, if any.
+            lines.append(fd.read())
+            co = compile(''.join(lines), filepath, 'exec')
     if co.co_consts and isinstance(co.co_consts[0], basestring):
         docstring = co.co_consts[0]
     else:
@@ -108,6 +154,9 @@ def get_module_filepath(module_or_name):
             filepath = module.__file__
     else:
         name = module_or_name
+        entry = module_index.find(name)
+        if entry is not None:
+            return entry[0]
         loader = pkgutil.get_loader(name)
         if loader is None:
             filepath = None
@@ -121,7 +170,8 @@ def get_module_filepath(module_or_name):
 def discover_modules(module_or_name):
     """Given an import name, provide an iterable of module filepath,name pairs.
 
-    This function imports package __init__.py but does not import modules.
+    This function does not import modules, nor packages where these are found
+    by the module index. Otherwise, it imports package __init__.py files.
 
     More specifically, given a package name, this function walks the package
     (which requires importing the package __init__) and yields the filepath and
@@ -184,17 +234,28 @@ def discover_modules(module_or_name):
         module = None
         name = module_or_name
         yield name
-    if module_is_package(name):
+    if module is not None and hasattr(module, '__path__'):
+        walk = module_index.walk(name, module.__path__[0])
+    elif module is None and module_index.find(name) is not None:
+        walk = module_index.walk(name)
+    elif module_is_package(name):
         if module is None:
             module = get_module(name)
         prefix = name + '.'
-        for _, name, _ in pkgutil.walk_packages(module.__path__, prefix):
-            yield name
+        walk = (name for _, name, _ in
+                pkgutil.walk_packages(module.__path__, prefix))
+    else:
+        walk = []
+    for name in walk:
+        yield name
 
 
 def discover_modified_modules(module_or_name, last_modified_time=0):
     for module in discover_modules(module_or_name):
-        if os.path.getmtime(get_module_filepath(module)) > last_modified_time:
+        mtime = module_index.mtime(module)
+        if mtime is None:
+            mtime = os.path.getmtime(get_module_filepath(module))
+        if mtime > last_modified_time:
             yield module
 
 
@@ -249,6 +310,15 @@ def module_exists(name):
     ImportError: No module named doesnotexist
     >>>
     """
+    # Modules in the module index are found without a walk through pkgutil.
+    if module_index.find(name) is not None:
+        # Import parent packages as importing the module would, such that
+        # errors in them are raised here. Packages already imported are free.
+        package, _ = package_submodule(name)
+        if package is not None and package not in sys.modules:
+            __import__(package)
+        return True
+
     # This function must be very careful not to suppress real ImportErrors.
     #
     # pkgutil.get_loader triggers an ImportError when:
@@ -298,6 +368,9 @@ def module_is_package(module_or_name):
             return False
     else:
         name = module_or_name
+        entry = module_index.find(name)
+        if entry is not None:
+            return entry[1]
         loader = pkgutil.get_loader(name)
         if loader is None:
             return None
@@ -401,3 +474,184 @@ def fix_import_name_if_pyfile(import_name):
     if package and submodule == 'py' and not module_is_package(package):
         import_name = package
     return import_name
+
+
+class ModuleIndex(object):
+    """Index of modules by import name, found on the filesystem.
+
+    Modules are found as Python's import finds them, through sys.path and
+    then through each package's directory, but without importing anything.
+    Each directory is listed once, on the first lookup of a module in it,
+    and each module's file is stat'ed once, for mtime. Listings are kept
+    until invalidate, which watch & reload modes call on changes.
+
+    The index only answers for modules on plain directories. For anything
+    else, e.g. a zipped egg earlier on sys.path, builtin modules, or modules
+    of import hooks on sys.meta_path, find returns None as when there is no
+    such module, and callers fall back to pkgutil, which imports parent
+    packages to find a module.
+
+    Example:
+    >>> index = ModuleIndex()
+    >>> index.find('testsite.stash.index') # doctest:+ELLIPSIS
+    ('.../tests/testsite/stash/index.py', False)
+    >>> index.find('testsite.stash') # doctest:+ELLIPSIS
+    ('.../tests/testsite/stash/__init__.py', True)
+    >>> index.find('testsite.stash.doesnotexist')
+    >>> list(index.walk('testsite.stash.package'))
+    ['testsite.stash.package.module']
+    >>> index.mtime('simplest') > 0
+    True
+    >>> index.invalidate()
+    >>>
+    """
+
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self, dirpath=None):
+        "Forget listings of all directories, or those within dirpath."
+        if dirpath is None:
+            self.listings = {}
+        else:
+            dirpath = os.path.abspath(dirpath)
+            for path in self.listings.keys():
+                if path == dirpath or path.startswith(dirpath + os.sep):
+                    del self.listings[path]
+        self.entries = {}
+        self.mtimes = {}
+        self.path_key = None
+
+    def find(self, name):
+        """Find module of import name, as (filepath, is_package), or None.
+
+        The filepath is as given by get_module_filepath for the name, i.e.
+        the __init__ file of a package.
+        """
+        self.check_path()
+        if name not in self.entries:
+            self.entries[name] = self.lookup(name)
+        return self.entries[name]
+
+    def mtime(self, name):
+        "Get mtime of the file of module of import name, or None."
+        entry = self.find(name)
+        if entry is None:
+            return None
+        filepath = entry[0]
+        if filepath not in self.mtimes:
+            self.mtimes[filepath] = os.path.getmtime(filepath)
+        return self.mtimes[filepath]
+
+    def walk(self, name, dirpath=None):
+        """Yield names of all modules within package of import name.
+
+        Modules are given in the order of pkgutil.walk_packages, i.e. by
+        filename within each package, with each package's modules right after
+        the package. Unlike walk_packages, no package is imported. Give the
+        dirpath of the package to walk it there, rather than where it is
+        found by name.
+        """
+        if dirpath is None:
+            entry = self.find(name)
+            if entry is None or not entry[1]:
+                return
+            dirpath = os.path.dirname(entry[0])
+        prefix = name + '.'
+        for filename, (modname, kind, filepath) in self.listing(dirpath):
+            yield prefix + modname
+            if kind == imp.PKG_DIRECTORY:
+                for subname in self.walk(prefix + modname,
+                                         os.path.join(dirpath, filename)):
+                    yield subname
+
+    def lookup(self, name):
+        "Look up module of import name on the filesystem, uncached."
+        package, submodule = package_submodule(name)
+        if package is None:
+            if name in sys.builtin_module_names:
+                return None
+            dirpaths = []
+            for path in sys.path:
+                path = os.path.abspath(path or os.curdir)
+                if os.path.isdir(path):
+                    dirpaths.append(path)
+                elif os.path.exists(path):
+                    # e.g. a zipped egg, which the index does not look into,
+                    # and which hides the module if it comes first.
+                    dirpaths.append(None)
+        else:
+            entry = self.find(package)
+            if entry is None or not entry[1]:
+                return None
+            dirpaths = [os.path.dirname(entry[0])]
+        # Leave modules of import hooks, which come first, to the hooks.
+        for finder in sys.meta_path:
+            if finder.find_module(name, package and dirpaths) is not None:
+                return None
+        for dirpath in dirpaths:
+            if dirpath is None:
+                return None
+            for _, (modname, kind, filepath) in self.listing(dirpath):
+                if modname == submodule:
+                    return filepath, kind == imp.PKG_DIRECTORY
+        return None
+
+    def listing(self, dirpath):
+        """List modules in directory at dirpath, in order of filename.
+
+        Gives (filename, (module name, kind, filepath)) pairs, where kind is
+        as in imp.find_module. Of files or directories of the same module
+        name, only the one which imp.find_module would take is listed.
+        """
+        if dirpath not in self.listings:
+            self.listings[dirpath] = self.list_modules(dirpath)
+        return self.listings[dirpath]
+
+    def list_modules(self, dirpath):
+        "List modules in directory at dirpath, as listing, uncached."
+        try:
+            filenames = sorted(os.listdir(dirpath))
+        except OSError:
+            return []
+        suffixes = [(suffix, kind) for suffix, _, kind in imp.get_suffixes()]
+        found = {}
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            if '.' not in filename and os.path.isdir(filepath):
+                for suffix, kind in suffixes:
+                    init = os.path.join(filepath, '__init__' + suffix)
+                    if os.path.isfile(init):
+                        # As imp.find_module, packages come first.
+                        found[filename] = 0, filename, imp.PKG_DIRECTORY, init
+                        break
+                continue
+            for rank, (suffix, kind) in enumerate(suffixes, 1):
+                if not filename.endswith(suffix):
+                    continue
+                modname = filename[:-len(suffix)]
+                if modname and '.' not in modname and modname != '__init__':
+                    # As imp.find_module, take the first suffix found.
+                    if modname not in found or rank < found[modname][0]:
+                        found[modname] = rank, filename, kind, filepath
+                break
+        chosen = dict((found[modname][1], modname) for modname in found)
+        modules = []
+        for filename in filenames:
+            if filename not in chosen:
+                continue
+            modname = chosen[filename]
+            _, _, kind, filepath = found[modname]
+            modules.append((filename, (modname, kind, filepath)))
+        return modules
+
+    def check_path(self):
+        "Forget top-level lookups if sys.path or the current directory moved."
+        path_key = tuple(sys.path), os.getcwd()
+        if path_key != self.path_key:
+            self.entries = {}
+            self.path_key = path_key
+
+
+# Shared index of modules, for the functions in this module.
+module_index = ModuleIndex()
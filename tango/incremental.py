@@ -0,0 +1,254 @@
+"""Incremental shelving, which pulls only stash modules whose inputs changed.
+
+The inputs of a stash module are its own file, the files of its parent
+packages, and the files of the local modules it imports, directly or through
+other local modules. Local modules are those not installed with Python or
+part of Tango, i.e. the site's own code. Imports are found by reading import
+statements, wherever they are in a module, without importing anything; an
+import by a computed name, e.g. with __import__, is not seen.
+
+Each shelve run records a content hash of each input of each module it
+pulls, in a state file of the site's stash, along with the shelf it wrote
+and the generation of each site there. A later run pulls a module only if it
+is new, failed in the last run, or any of its inputs changed, and pulls every
+module if the shelf is another or was written since, e.g. deleted or rolled
+back. A site installed with Python still has the modules of its own package
+as inputs.
+
+Example:
+>>> finder = InputFinder()
+>>> inputs = finder.inputs('testsite.stash.index')
+>>> sorted(os.path.relpath(filepath) for filepath in inputs)
+... # doctest:+NORMALIZE_WHITESPACE
+['tests/testsite/__init__.py', 'tests/testsite/stash/__init__.py',
+ 'tests/testsite/stash/index.py']
+>>> state = {'testsite.stash.index': {'inputs': inputs, 'ok': True}}
+>>> reasons = plan_run([('testsite.stash.index', []),
+...                     ('testsite.stash.multiple', [])], state, finder)
+>>> reasons['testsite.stash.index'] is None
+True
+>>> reasons['testsite.stash.multiple']
+'new module'
+>>>
+"""
+
+import ast
+import hashlib
+import os
+import site
+import sys
+
+import tango
+from tango.imports import module_index, namespace_segments, package_submodule
+from tango.stash import load_private, save_private
+
+
+# Version of the state file format, to ignore state files of other versions.
+STATE_VERSION = 2
+
+
+class InputFinder(object):
+    "Find the inputs of modules, reading and hashing each file only once."
+
+    def __init__(self):
+        # Directories of top-level packages of modules asked for, as local.
+        self.roots = set()
+        self.prefixes = installed_prefixes()
+        # Dict of filepath to list of (filepath, name, is_package) imported.
+        self.imports = {}
+        # Dict of filepath to its content hash, or None if it is gone.
+        self.hashes = {}
+
+    def inputs(self, name):
+        """Provide the inputs of module of import name, as a dict.
+
+        Gives the content hash of each input, by filepath, including the
+        module's own file.
+        """
+        entry = module_index.find(namespace_segments(name)[0])
+        if entry is not None and entry[1]:
+            self.roots.add(os.path.dirname(entry[0]))
+        pending = list(self.resolve([name]))
+        found = set()
+        while pending:
+            item = pending.pop()
+            if item[0] in found:
+                continue
+            found.add(item[0])
+            pending.extend(self.imported(*item))
+        return dict((filepath, self.hash(filepath)) for filepath in found)
+
+    def imported(self, filepath, name, is_package):
+        "Provide local modules imported in file of module name, as resolve."
+        if filepath not in self.imports:
+            package = name if is_package else package_submodule(name)[0]
+            modules = []
+            for names in import_statements(filepath, package):
+                modules.extend(self.resolve(names))
+            self.imports[filepath] = modules
+        return self.imports[filepath]
+
+    def resolve(self, names):
+        """Resolve the first of names which is a local module.
+
+        Yields (filepath, name, is_package) of the module along with each of
+        its parent packages, as importing the module imports its parents.
+        """
+        for name in names:
+            entry = module_index.find(name)
+            if entry is None:
+                continue
+            if self.is_local(entry[0]):
+                yield entry[0], name, entry[1]
+                package = package_submodule(name)[0]
+                while package is not None:
+                    entry = module_index.find(package)
+                    if entry is not None:
+                        yield entry[0], package, entry[1]
+                    package = package_submodule(package)[0]
+            return
+
+    def is_local(self, filepath):
+        "Tell whether a module's file is of the site, not Python nor Tango."
+        for root in self.roots:
+            if filepath.startswith(root + os.sep):
+                return True
+        for prefix in self.prefixes:
+            if filepath.startswith(prefix + os.sep):
+                return False
+        return True
+
+    def hash(self, filepath):
+        if filepath not in self.hashes:
+            try:
+                with open(filepath, 'rb') as fd:
+                    self.hashes[filepath] = hashlib.sha1(fd.read()).hexdigest()
+            except (IOError, OSError):
+                self.hashes[filepath] = None
+        return self.hashes[filepath]
+
+
+def import_statements(filepath, package=None):
+    """Yield candidate module names of each import statement in a file.
+
+    Each import gives a list of the names it may refer to, in order of
+    precedence, as with implicit relative imports in a package. A file
+    which cannot be parsed yields nothing, leaving errors to its import.
+    """
+    try:
+        with open(filepath, 'rb') as fd:
+            tree = compile(fd.read(), filepath, 'exec', ast.PyCF_ONLY_AST)
+    except (IOError, OSError, SyntaxError, TypeError):
+        return
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                yield candidates(alias.name, package)
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:
+                base = package
+                for _ in range(node.level - 1):
+                    base = base and package_submodule(base)[0]
+                if base is None:
+                    continue
+                base = '.'.join(filter(None, [base, node.module]))
+                bases = [base]
+            else:
+                bases = candidates(node.module, package)
+            yield bases
+            # Names imported from a package may be its modules.
+            for alias in node.names:
+                if alias.name != '*':
+                    yield [name + '.' + alias.name for name in bases]
+
+
+def candidates(name, package=None):
+    "Provide names an import of name in package may refer to, in order."
+    if package is None:
+        return [name]
+    return [package + '.' + name, name]
+
+
+def installed_prefixes():
+    "Provide directories of modules installed with Python, and of Tango."
+    prefixes = set([sys.prefix, sys.exec_prefix,
+                    getattr(sys, 'real_prefix', sys.prefix)])
+    if hasattr(site, 'getsitepackages'):
+        prefixes.update(site.getsitepackages())
+    prefixes.add(os.path.dirname(tango.__file__))
+    return [os.path.abspath(prefix) for prefix in prefixes]
+
+
+def plan_run(module_routes, state, finder):
+    """Decide which of (name, routes) module pairs to pull in this run.
+
+    Returns a dict of module name to the reason to pull it, or None if it is
+    to be left as shelved. A route declared in more than one module is
+    merged from all of them, so each of those is pulled if one is.
+    """
+    reasons = {}
+    for name, routes in module_routes:
+        reasons[name] = reason(name, state.get(name), finder)
+
+    # Pull all modules declaring a route which any pulled module declares.
+    declaring = {}
+    for name, routes in module_routes:
+        for route in routes:
+            declaring.setdefault(route.rule, []).append(name)
+    changed = True
+    while changed:
+        changed = False
+        for rule, names in sorted(declaring.items()):
+            pulled = [name for name in names if reasons[name] is not None]
+            if not pulled:
+                continue
+            for name in names:
+                if reasons[name] is None:
+                    reasons[name] = 'shares {0} with {1}'.format(rule,
+                                                                  pulled[0])
+                    changed = True
+    return reasons
+
+
+def reason(name, record, finder):
+    "Provide the reason to pull module of name, given its state record."
+    if record is None:
+        return 'new module'
+    if not record['ok']:
+        return 'failed in last run'
+    inputs = finder.inputs(name)
+    for filepath in sorted(set(inputs) | set(record['inputs'])):
+        if inputs.get(filepath) != record['inputs'].get(filepath):
+            if inputs.get(filepath) is None:
+                return 'no longer imports {0}'.format(filepath)
+            if filepath not in record['inputs']:
+                return 'now imports {0}'.format(filepath)
+            return '{0} changed'.format(filepath)
+    return None
+
+
+def load_state(filepath):
+    """Load the state of the last run, as (shelf, modules).
+
+    Shelf is as given to save_state, and modules is a dict by module name of
+    records of each module's inputs as of its last run, and whether it was
+    pulled ok. Returns (None, {}) if there is no usable state file, which
+    includes one not in a private directory of this user, see load_private.
+    """
+    try:
+        state = load_private(filepath)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None, {}
+    if not isinstance(state, dict) or state.get('version') != STATE_VERSION:
+        return None, {}
+    return state['shelf'], state['modules']
+
+
+def save_state(filepath, modules, shelf):
+    """Write the state of a run to filepath, in a private directory.
+
+    Shelf describes the shelf written, e.g. its filepath and the generation
+    of each site, such that a later run can tell the state no longer holds.
+    """
+    save_private(filepath, {'version': STATE_VERSION, 'shelf': shelf,
+                            'modules': modules}, prefix='.tango-state')
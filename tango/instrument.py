@@ -0,0 +1,298 @@
+"""Instrumentation of shelve runs, to tell which stash modules cost the most.
+
+While recording, as with `tango shelve --report FILE`, each stage of a run is
+measured for each stash module and route:
+
+* header: reading and parsing the module's header
+* import: importing the module
+* pull: collecting the module's exports into a context
+* serialize: encoding a route's context, and any body, for the shelf
+* write: writing a route on the shelf, uncommitted
+* commit: committing the run, measured for the run as a whole
+
+Each measure has wall-clock and CPU seconds, the peak resident memory of the
+process the stage ran in, and by how much the stage raised that peak. Stages
+run in child processes, with jobs or limits, are measured in the child and
+reported back. CPU seconds are those of the whole process, such that stages
+which overlap, as with `--stream`, count each other's. Serializing also gives
+the bytes stored for each route.
+
+Example:
+>>> recorder = start()
+>>> with measure('import', module='spam'):
+...     pass
+...
+>>> add_bytes(('site', '/'), 42)
+>>> finish() is recorder
+True
+>>> sorted(recorder.modules['spam'])
+['import']
+>>> recorder.routes[('site', '/')]['bytes']
+42
+>>>
+
+Once finished, nothing is recorded:
+>>> with measure('import', module='spam'):
+...     pass
+...
+>>> recorder.modules['spam']['import']['count']
+1
+>>>
+"""
+
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Version of the report format, written into each report.
+REPORT_VERSION = 1
+
+# The recorder of the run in progress, or None if not recording.
+recorder = None
+
+# Measures in progress in each thread, see measure.
+local = threading.local()
+
+
+class Recorder(object):
+    "Measures of the stages of one shelve run, by module and by route."
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.finished_at = None
+        # Dict of module name to dict of stage to measure.
+        self.modules = {}
+        # Dict of (site, rule) to dict of 'modules', 'bytes' and 'stages'.
+        self.routes = {}
+        # Dict of stage to measure, of stages of the run as a whole.
+        self.run = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, measure, module=None, route=None):
+        "Add a measure of stage, e.g. as taken by measure, to a total."
+        with self.lock:
+            if module is not None:
+                stages = self.modules.setdefault(module, {})
+            elif route is not None:
+                stages = self.route(route)['stages']
+            else:
+                stages = self.run
+            total = stages.setdefault(stage, {'count': 0, 'wall': 0.0,
+                                              'cpu': 0.0, 'peak_memory': 0,
+                                              'peak_growth': 0})
+            total['count'] += measure.get('count', 1)
+            total['wall'] += measure['wall']
+            total['cpu'] += measure['cpu']
+            total['peak_memory'] = max(total['peak_memory'],
+                                       measure['peak_memory'])
+            total['peak_growth'] += measure['peak_growth']
+
+    def route(self, route):
+        "Get the record of a route, by (site, rule), creating it if need be."
+        if route not in self.routes:
+            self.routes[route] = {'modules': [], 'bytes': 0, 'stages': {}}
+        return self.routes[route]
+
+    def records(self):
+        "Provide the measures recorded, as plain data, for update."
+        return {'modules': self.modules, 'routes': self.routes,
+                'run': self.run}
+
+    def update(self, records):
+        "Add measures recorded elsewhere, e.g. in a child process."
+        for module, stages in records['modules'].items():
+            for stage, measure in stages.items():
+                self.add(stage, measure, module=module)
+        for route, record in records['routes'].items():
+            for stage, measure in record['stages'].items():
+                self.add(stage, measure, route=route)
+            with self.lock:
+                self.route(route)['bytes'] += record['bytes']
+        for stage, measure in records['run'].items():
+            self.add(stage, measure)
+
+    def module_totals(self):
+        """Provide (module, wall seconds, bytes) of each module, as a list.
+
+        A module's totals include those of the routes it declares.
+        """
+        totals = dict((module, [sum(measure['wall']
+                                    for measure in stages.values()), 0])
+                      for module, stages in self.modules.items())
+        for record in self.routes.values():
+            wall = sum(measure['wall']
+                       for measure in record['stages'].values())
+            for module in record['modules']:
+                total = totals.setdefault(module, [0.0, 0])
+                total[0] += wall
+                total[1] += record['bytes']
+        return [(module, module_wall, size)
+                for module, (module_wall, size) in sorted(totals.items())]
+
+
+def start():
+    "Start recording a shelve run, giving the new recorder."
+    global recorder
+    recorder = Recorder()
+    return recorder
+
+
+def finish():
+    "Stop recording, giving the recorder of the run, or None if none."
+    global recorder
+    finished, recorder = recorder, None
+    if finished is not None:
+        finished.finished_at = time.time()
+    return finished
+
+
+@contextmanager
+def measure(stage, module=None, route=None):
+    """Measure the block as a stage of module name or (site, rule) route.
+
+    With neither module nor route, the stage is of the run as a whole. The
+    time of a stage measured within another, e.g. serialize within write, is
+    not counted in the outer stage. Does nothing unless recording.
+    """
+    current = recorder
+    if current is None:
+        yield
+        return
+    # Stack of [wall, cpu] seconds of stages nested in each measure of this
+    # thread, which are taken off the measure.
+    stack = local.__dict__.setdefault('stack', [])
+    nested = [0.0, 0.0]
+    stack.append(nested)
+    started = time.time()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    try:
+        yield
+    finally:
+        ended = resource.getrusage(resource.RUSAGE_SELF)
+        wall = time.time() - started
+        cpu = (ended.ru_utime + ended.ru_stime -
+               usage.ru_utime - usage.ru_stime)
+        stack.pop()
+        if stack:
+            stack[-1][0] += wall
+            stack[-1][1] += cpu
+        current.add(stage, {
+            'wall': wall - nested[0],
+            'cpu': cpu - nested[1],
+            # Linux gives maximum resident set size in kilobytes.
+            'peak_memory': ended.ru_maxrss * 1024,
+            'peak_growth': (ended.ru_maxrss - usage.ru_maxrss) * 1024,
+        }, module=module, route=route)
+
+
+def add_bytes(route, count):
+    "Count bytes stored for a (site, rule) route, if recording."
+    current = recorder
+    if current is not None:
+        with current.lock:
+            current.route(route)['bytes'] += count
+
+
+def note_route(route):
+    "Note which modules declare a Route object, if recording."
+    current = recorder
+    if current is not None:
+        with current.lock:
+            record = current.route((route.site, route.rule))
+            for module in route.modules or []:
+                if module not in record['modules']:
+                    record['modules'].append(module)
+
+
+def run_recorded(function, item):
+    """Call function with item in a child process, as run_in_children does.
+
+    Gives (result, records) where records are the measures taken in the
+    child, or None if not recording, for the parent to update its recorder.
+    """
+    global recorder
+    if recorder is None:
+        return function(item), None
+    # The child has a copy of the parent's recorder; only report its own.
+    recorder = Recorder()
+    return function(item), recorder.records()
+
+
+def report(recorder):
+    "Provide the report of a recorder's run, as plain data for JSON."
+    modules = dict((module, {'stages': stages, 'routes': []})
+                   for module, stages in recorder.modules.items())
+    routes = []
+    for (site, rule), record in sorted(recorder.routes.items()):
+        routes.append({'site': site, 'rule': rule,
+                       'modules': record['modules'],
+                       'bytes': record['bytes'],
+                       'stages': record['stages']})
+        for module in record['modules']:
+            modules.setdefault(module, {'stages': {}, 'routes': []})
+            modules[module]['routes'].append([site, rule])
+    finished_at = recorder.finished_at or time.time()
+    return {
+        'version': REPORT_VERSION,
+        'started_at': recorder.started_at,
+        'wall': finished_at - recorder.started_at,
+        'run': recorder.run,
+        'modules': modules,
+        'routes': routes,
+    }
+
+
+def write_report(filepath, recorder):
+    "Write the JSON report of a recorder's run to filepath, by atomic rename."
+    dirname = os.path.dirname(filepath) or os.curdir
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, temp_filepath = tempfile.mkstemp(dir=dirname, prefix='.tango-report')
+    try:
+        with os.fdopen(fd, 'w') as temp_file:
+            json.dump(report(recorder), temp_file, indent=1, sort_keys=True)
+        os.rename(temp_filepath, filepath)
+    except:
+        os.remove(temp_filepath)
+        raise
+
+
+def summary(recorder, count=5):
+    """Summarize a recorder's run, as lines naming its costliest modules.
+
+    Gives the count slowest modules by wall-clock seconds, and the count
+    largest by bytes stored, each including the routes it declares.
+    """
+    totals = recorder.module_totals()
+    finished_at = recorder.finished_at or time.time()
+    lines = ['Measured {0} modules and {1} routes, in {2:.2f}s.'.format(
+        len(totals), len(recorder.routes), finished_at - recorder.started_at)]
+    lines.append('Slowest modules:')
+    for module, wall, size in sorted(totals, key=lambda total: -total[1])[
+            :count]:
+        lines.append('  {0:8.3f}s  {1}'.format(wall, module))
+    lines.append('Largest modules:')
+    for module, wall, size in sorted(totals, key=lambda total: -total[2])[
+            :count]:
+        lines.append('  {0:>9}  {1}'.format(format_size(size), module))
+    return lines
+
+
+def format_size(size):
+    """Format a size in bytes for people to read.
+
+    >>> format_size(42), format_size(2048), format_size(5 * 1024 ** 2)
+    ('42B', '2.0K', '5.0M')
+    >>>
+    """
+    if size < 1024:
+        return '{0}B'.format(size)
+    for unit in ('K', 'M', 'G'):
+        size /= 1024.0
+        if size < 1024 or unit == 'G':
+            return '{0:.1f}{1}'.format(size, unit)
@@ -14,7 +14,12 @@ from flask.ext.script import Shell as BaseShell
 from tango.app import Tango
 from tango.config import SHELVE_TIME_DIR
 from tango.imports import module_exists, fix_import_name_if_pyfile
-from tango.errors import ModuleNotFound
+from tango.errors import ExportError, ModuleNotFound, ShelfError
+from tango.export import export_by_name
+from tango.prefork import serve_prefork
+from tango.schedule import schedule_by_name
+from tango.shelf import SqliteConnector, write_snapshot
+from tango.watch import shelve_forever
 import tango
 
 commands = []
@@ -67,7 +72,8 @@ def version():
 
 
 @command
-def shelve(site, modified_only=False):
+def shelve(site, modified_only=False, jobs=1, stream=False,
+           incremental=False, watch=False, report=None):
     "Shelve an application's stash, as a worker process."
     with no_pyc():
         # Create shelve time dir if it does not exist
@@ -77,10 +83,62 @@ def shelve(site, modified_only=False):
         shelve_time_path = os.path.join(SHELVE_TIME_DIR, site)
         os.environ['SHELVE_TIME_PATH'] = shelve_time_path
         site = validate_site(site)
-        Tango.shelve_by_name(site, modified_only=modified_only, logfile=sys.stdout)
+        if watch:
+            # Runs until interrupted, shelving again as the site changes.
+            try:
+                shelve_forever(site, logfile=sys.stdout, jobs=int(jobs))
+            except KeyboardInterrupt:
+                pass
+            return
+        Tango.shelve_by_name(site, modified_only=modified_only,
+                             logfile=sys.stdout, jobs=int(jobs),
+                             stream=stream, incremental=incremental,
+                             report=report)
         open(os.environ['SHELVE_TIME_PATH'], 'w').close()
 
 
+@command
+def schedule(site, jobs=None):
+    "Refresh an application's stash modules as each falls due, as a daemon."
+    with no_pyc():
+        site = validate_site(site)
+        if jobs is not None:
+            jobs = int(jobs)
+        try:
+            schedule_by_name(site, jobs=jobs, logfile=sys.stdout)
+        except KeyboardInterrupt:
+            pass
+
+
+@command
+def export(site, outdir, jobs=None):
+    "Render a site's routes and static files to outdir, to serve as files."
+    with no_pyc():
+        site = validate_site(site)
+        if jobs is not None:
+            jobs = int(jobs)
+        try:
+            export_by_name(site, outdir, jobs=jobs, logfile=sys.stdout)
+        except ExportError, error:
+            print error
+            sys.exit(1)
+
+
+@command
+def snapshot(site, filepath=None):
+    "Export the shelf to a read-only snapshot file, for serving."
+    site = validate_site(site)
+    app = get_app(site)
+    if not app: return
+    if filepath is None:
+        filepath = app.config['SHELF_SNAPSHOT_FILEPATH']
+    # Export every route on the SQLite shelf, which may hold many sites.
+    shelf = SqliteConnector(app)
+    count = write_snapshot(filepath, shelf.records())
+    shelf.close()
+    print 'Exported {0} routes to {1}.'.format(count, filepath)
+
+
 class Get(Command):
     """Create shelf.dat
     """
@@ -89,14 +147,17 @@ class Get(Command):
 
         if not app: return
 
+        shelf_list = app.shelf.list(site, rule)
+        contexts = app.shelf.get_many(shelf_list)
+
         data =  {
             'tango_version': tango.__version__,
             'site': site,
             'module': module,
             'entries': [
-                {'rule': rule,
-                 'context': app.shelf.get(site, rule),
-                } for site, rule in app.shelf.list(site, rule)
+                {'rule': entry_rule,
+                 'context': contexts[entry_site, entry_rule],
+                } for entry_site, entry_rule in shelf_list
             ],
         }
 
@@ -132,10 +193,8 @@ class Put(Command):
 
             if not app: return
 
-            for item in entries:
-                rule = item['rule']
-                context = item['context']
-                app.shelf.put(site, rule, context)
+            app.shelf.put_many((site, item['rule'], item['context'])
+                               for item in entries)
 
     def get_options(self):
         return (Option('filename'),)
@@ -155,6 +214,8 @@ class Show(Command):
             print "from shelf ...",
 
         shelf_list = app.shelf.list(site, rule)
+        if show_context:
+            contexts = app.shelf.get_many(shelf_list)
 
         if not data_only:
             print "done."
@@ -164,7 +225,7 @@ class Show(Command):
                 print "Matches",
             print "{0} {1}".format(site, rule),
             if show_context:
-                context = app.shelf.get(site, rule)
+                context = contexts[site, rule]
                 if not data_only:
                     print "with context",
                 print context,
@@ -206,6 +267,33 @@ class Drop(Command):
         )
 
 
+class Rollback(Command):
+    """Roll back a site on the shelf to a prior generation.
+    """
+    def run(self, site, generation, module):
+        app = get_app(site, module)
+
+        if not app: return
+
+        try:
+            generation = app.shelf.rollback(site, generation)
+        except ShelfError, error:
+            print error
+            return
+        print 'Rolled back {0} to generation {1}.'.format(site, generation)
+
+    def get_options(self):
+        return(
+            Option('site', default=None),
+            Option('generation', nargs='?', type=int, default=None,
+                   help="Generation to roll back to, by default the one "
+                        "before the current generation."),
+            Option('-m', '--module', dest="module", default=None,
+                   help="Provide a module name if the module name differs from"
+                        " the site name."),
+        )
+
+
 class Source(Command):
     """Display the file or files where a shelf entry originated.
     """
@@ -248,21 +336,54 @@ class Manager(BaseManager):
 
 
 class Server(BaseServer):
-    description = "Run a Tango site on the local machine, for development."
+    description = ("Run a Tango site for development, or from prefork "
+                   "workers with --workers.")
 
     def get_options(self):
-        return (Option('site'),) + BaseServer.get_options(self)
+        return (Option('site'),) + BaseServer.get_options(self) + (
+            Option('-w', '--workers', dest='workers', type=int, default=None,
+                   help="Serve from this many forked worker processes, "
+                        "for production, without debugger or reloader."),
+            Option('--max-requests', dest='max_requests', type=int,
+                   default=None,
+                   help="Replace each worker after about this many "
+                        "requests."),
+            Option('--max-memory', dest='max_memory', default=None,
+                   help="Replace each worker once its memory grows by "
+                        "more than this size, e.g. 512M."),
+        )
 
-    def handle(self, _, site, host, port, use_debugger, use_reloader):
+    def handle(self, _, site, host, port, use_debugger, use_reloader,
+               workers=None, max_requests=None, max_memory=None):
         site = validate_site(site)
         app = Tango.get_app(site)
 
         if not app: return
+        if workers is not None:
+            serve_prefork(app, host=host, port=port, workers=workers,
+                          max_requests=max_requests, max_memory=max_memory,
+                          logfile=sys.stdout)
+            return
         app.run(host=host, port=port, debug=use_debugger,
                 use_debugger=use_debugger, use_reloader=use_reloader,
                 **self.server_options)
 
 
+class Compile(Command):
+    """Write a site's route manifest, to build the site without discovery.
+    """
+    # A class rather than a command function, to not shadow builtin compile.
+    def run(self, site):
+        with no_pyc():
+            site = validate_site(site)
+            app = Tango.compile_by_name(site)
+            print 'Compiled {0} routes to {1}.'.format(
+                len(app.routes), app.manifest_filepath(site))
+
+    def get_options(self):
+        return (Option('site'),)
+
+
 class Shell(BaseShell):
     description = 'Runs a Python shell inside Tango application context.'
 
@@ -290,7 +411,9 @@ def run():
     manager.add_command('get', Get())
     manager.add_command('put', Put())
     manager.add_command('drop', Drop())
+    manager.add_command('rollback', Rollback())
     manager.add_command('source', Source())
+    manager.add_command('compile', Compile())
     for cmd in commands:
         manager.command(cmd)
     manager.run()
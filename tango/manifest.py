@@ -0,0 +1,149 @@
+"""Route manifests, to build an app without discovering its stash modules.
+
+Building an app discovers each module in its stash, which imports each
+package in the stash, and parses the header of each module. A manifest holds
+the result, i.e. the routes of the app without their contexts, along with
+what is needed to tell whether it is still fresh: the files and directory
+listings it was built from. Write one with `tango compile`, and build_app
+loads it in place of discovery for as long as it is fresh.
+
+Example:
+>>> import os, tempfile
+>>> manifest = compile_manifest('testsite', 'testsite.stash')
+>>> filepath = os.path.join(tempfile.mkdtemp(), 'testsite.manifest')
+>>> write_manifest(filepath, manifest)
+>>> stash, routes = load_manifest(filepath, 'testsite')
+>>> stash
+'testsite.stash'
+>>> routes # doctest: +NORMALIZE_WHITESPACE
+[<Route: /, template:index.html>,
+ <Route: /argument/<argument>/, template:argument.html>,
+ <Route: /blank/export.txt>,
+ <Route: /index.json, json>,
+ <Route: /plain/exports.txt, text>,
+ <Route: /route1.txt>,
+ <Route: /route2.txt>]
+>>> routes[3].modules
+['testsite.stash.package.module', 'testsite.stash']
+>>> load_manifest(filepath, 'simplesite') is None
+True
+>>> load_manifest(filepath + '.doesnotexist', 'testsite') is None
+True
+>>>
+"""
+
+import os
+
+from tango.imports import discover_modules, get_module_filepath
+from tango.imports import module_is_package
+from tango.stash import Route, build_module_routes, load_private
+from tango.stash import save_private
+
+
+# Version of the manifest format, to ignore manifests of other versions.
+MANIFEST_VERSION = 5
+
+# Route attributes kept in a manifest, i.e. all but the context.
+ROUTE_FIELDS = ('site', 'rule', 'exports', 'static', 'writer_name', 'modules',
+                'source_files', 'refresh', 'timeout', 'memory', 'max_age')
+
+
+def compile_manifest(import_name, stash, routes=None):
+    """Build the manifest of an app's stash, given by import name.
+
+    Returns a dict of plain values, ready for write_manifest, where import
+    name is that of the app and stash is the import name of its stash. Routes
+    are discovered unless given, as built by build_module_routes.
+    """
+    if routes is None:
+        routes = build_module_routes(stash)
+    filepaths, dirpaths = set(), set()
+    for name in discover_modules(stash):
+        filepath = get_module_filepath(name)
+        filepaths.add(filepath)
+        if module_is_package(name):
+            dirpaths.add(os.path.dirname(filepath))
+    for route in routes:
+        filepaths.update(route.source_files or [])
+    return {
+        'version': MANIFEST_VERSION,
+        'import_name': import_name,
+        'filepath': get_module_filepath(import_name),
+        'stash': stash,
+        'files': [(path, file_stat(path)) for path in sorted(filepaths)
+                  if path is not None],
+        'listings': [(dirpath, listing(dirpath))
+                     for dirpath in sorted(dirpaths)],
+        'routes': [dict((field, getattr(route, field))
+                        for field in ROUTE_FIELDS) for route in routes],
+    }
+
+
+def write_manifest(filepath, manifest):
+    """Write a manifest to filepath, by atomic rename.
+
+    The manifest is marshaled, in a directory private to this user, see
+    save_private, such that loading it runs no code of anyone else's.
+    """
+    save_private(filepath, manifest, prefix='.tango-manifest')
+
+
+def load_manifest(filepath, import_name):
+    """Load the manifest at filepath, for an app of the given import name.
+
+    Returns (stash import name, list of Route objects), or None if there is
+    no such manifest, it is stale, or it is not private to this user, see
+    load_private, such that the caller discovers routes.
+    """
+    try:
+        manifest = load_private(filepath)
+    except Exception:
+        return None
+    if not is_fresh(manifest, import_name):
+        return None
+    routes = [Route(**fields) for fields in manifest['routes']]
+    return manifest['stash'], routes
+
+
+def is_fresh(manifest, import_name):
+    """Tell whether manifest still holds for an app of the given import name.
+
+    It does if it is of this format and app, which resolves to the same file,
+    and none of its files or directory listings changed since it was built.
+    """
+    if not isinstance(manifest, dict):
+        return False
+    if manifest.get('version') != MANIFEST_VERSION:
+        return False
+    if manifest['import_name'] != import_name:
+        return False
+    for filepath, stat in manifest['files']:
+        if file_stat(filepath) != stat:
+            return False
+    for dirpath, names in manifest['listings']:
+        if listing(dirpath) != names:
+            return False
+    # Check last, as the app's own module takes the most work to find.
+    return manifest['filepath'] == get_module_filepath(import_name)
+
+
+def file_stat(filepath):
+    "Provide (mtime, size) of file at filepath, or None if there is none."
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+def listing(dirpath):
+    """List the entries of directory at dirpath which may be modules.
+
+    Directory mtimes are not used, as they change with each .pyc written.
+    """
+    try:
+        names = os.listdir(dirpath)
+    except OSError:
+        return None
+    return sorted(name for name in names
+                  if name.endswith('.py') or '.' not in name)
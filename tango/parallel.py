@@ -0,0 +1,263 @@
+"""Run work in child processes, for parallel shelving within Tango.
+
+Each call runs in a child process of its own, forked from the current process,
+such that a call which crashes its process, or corrupts its interpreter, does
+not take the parent down with it. Results are pickled back to the parent.
+Forking requires a POSIX system. Each call may be limited in time, and in
+memory, such that a call which hangs or leaks is reported as an error.
+
+Example:
+>>> def square(n):
+...     return n * n
+...
+>>> sorted(run_in_children(square, [1, 2, 3], jobs=2))
+[(0, 1, None), (1, 4, None), (2, 9, None)]
+>>>
+
+A call which raises reports the traceback instead of a result:
+>>> def fail(n):
+...     raise ValueError(n)
+...
+>>> [(index, result, error.splitlines()[-1]) for index, result, error
+...  in run_in_children(fail, [1])]
+[(0, None, 'ValueError: 1')]
+>>>
+
+A child which dies before giving a result is reported with its exit status:
+>>> import os
+>>> list(run_in_children(os._exit, [3]))
+[(0, None, 'Child process exited with status 3.')]
+>>>
+
+A child which runs past its timeout is killed:
+>>> import time
+>>> list(run_in_children(time.sleep, [10], limits=[(0.1, None)]))
+[(0, None, 'Child process timed out after 0.1s.')]
+>>>
+"""
+
+import cPickle as pickle
+import errno
+import os
+import resource
+import select
+import signal
+import sys
+import time
+import traceback
+from cPickle import HIGHEST_PROTOCOL
+
+
+def run_in_children(function, items, jobs=1, limits=None):
+    """Call function with each item, each call in a child process.
+
+    Runs up to jobs children at once. Yields (index, result, error) for each
+    item as its child completes, in order of completion, where index is the
+    item's position in items, and error is None on success or a message
+    otherwise, e.g. the traceback of an exception raised by the call.
+
+    If limits is given, it is a list of (timeout, memory) for each item, as
+    given to Children.start, where either may be None for no limit.
+
+    Children still running when the caller stops iterating are terminated.
+    """
+    pending = list(enumerate(items))
+    pending.reverse()
+    jobs = max(1, jobs)
+    children = Children()
+    try:
+        while pending or children:
+            while pending and len(children) < jobs:
+                index, item = pending.pop()
+                timeout, memory = (None, None) if limits is None \
+                    else limits[index]
+                children.start(index, function, item, timeout=timeout,
+                               memory=memory)
+            for index, result, error in children.wait():
+                yield index, result, error
+    finally:
+        children.terminate()
+
+
+class Children(object):
+    """Calls running in child processes, for callers which start each call.
+
+    Each call is started with a key, and reported with it once complete, as
+    (key, result, error), as in run_in_children:
+    >>> children = Children()
+    >>> children.start('two', abs, -2)
+    >>> len(children)
+    1
+    >>> children.wait()
+    [('two', 2, None)]
+    >>> len(children)
+    0
+    >>>
+    """
+
+    def __init__(self):
+        # Dict of pipe file descriptor to (key, pid, chunks read, time started,
+        # timeout) of children.
+        self.running = {}
+
+    def __len__(self):
+        return len(self.running)
+
+    def start(self, key, function, item, timeout=None, memory=None):
+        """Call function with item in a new child, to be reported with key.
+
+        A child still running after timeout seconds is killed, and reported
+        as timed out. Memory limits how far the child's address space may
+        grow, in bytes, beyond what it inherits from this process.
+        """
+        # Do not leave buffered output for each child to write again on exit.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        fd, pid = spawn(function, item, memory)
+        self.running[fd] = key, pid, [], time.time(), timeout
+
+    def wait(self, timeout=None):
+        """Wait for any child to complete, up to timeout seconds if given.
+
+        Returns a list of (key, result, error) of the children which
+        completed, which is empty if none did within timeout.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        completed = []
+        while self.running and not completed:
+            completed.extend(self.expire())
+            if completed:
+                break
+            # Wake up for the caller's timeout or the next child's, if any.
+            deadlines = [started + limit for _, _, _, started, limit
+                         in self.running.values() if limit is not None]
+            if deadline is not None:
+                deadlines.append(deadline)
+            timeout = None
+            if deadlines:
+                timeout = max(0, min(deadlines) - time.time())
+            try:
+                readable, _, _ = select.select(list(self.running), [], [],
+                                               timeout)
+            except select.error, error:
+                if error.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                if deadline is not None and time.time() >= deadline:
+                    break
+                continue
+            for fd in readable:
+                chunk = os.read(fd, 65536)
+                if chunk:
+                    self.running[fd][2].append(chunk)
+                    continue
+                os.close(fd)
+                key, pid, chunks, started, limit = self.running.pop(fd)
+                _, status = os.waitpid(pid, 0)
+                result, error = outcome(''.join(chunks), status)
+                completed.append((key, result, error))
+        return completed
+
+    def expire(self):
+        "Kill children past their timeout, giving (key, None, error) of each."
+        expired = []
+        now = time.time()
+        for fd, (key, pid, chunks, started, limit) in self.running.items():
+            if limit is None or now < started + limit:
+                continue
+            del self.running[fd]
+            os.close(fd)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            expired.append((key, None, 'Child process timed out after '
+                                       '{0:g}s.'.format(limit)))
+        return expired
+
+    def terminate(self):
+        "Terminate children still running, without reporting them."
+        for fd, (key, pid, chunks, started, limit) in self.running.items():
+            os.close(fd)
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.running.clear()
+
+
+def spawn(function, item, memory=None):
+    """Fork a child to call function with item, giving (pipe fd, child pid).
+
+    If memory is given, the child limits its address space to that many
+    bytes more than it has before the call, such that allocating past it
+    raises MemoryError. Without /proc to read the address space from, memory
+    is not limited, as the limit would count all the child inherits.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid != 0:
+        os.close(write_fd)
+        return read_fd, pid
+    # In the child: never return into the caller's code, whatever happens.
+    status = 0
+    try:
+        os.close(read_fd)
+        try:
+            if memory is not None:
+                limit_memory(memory)
+            data = pickle.dumps(('result', function(item)), HIGHEST_PROTOCOL)
+        except Exception:
+            data = pickle.dumps(('error', traceback.format_exc()),
+                                HIGHEST_PROTOCOL)
+        with os.fdopen(write_fd, 'wb') as pipe:
+            pipe.write(data)
+    except BaseException:
+        status = 1
+    finally:
+        os._exit(status)
+
+
+def limit_memory(memory):
+    "Limit this process to grow its address space by memory bytes at most."
+    size = address_space()
+    if size is None:
+        return
+    limit = size + memory
+    hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def address_space():
+    "Provide the address space of this process in bytes, None without /proc."
+    try:
+        with open('/proc/self/statm') as fd:
+            pages = int(fd.read().split()[0])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize()
+
+
+def outcome(data, status):
+    "Provide (result, error) of a child, given data it wrote & exit status."
+    try:
+        kind, value = pickle.loads(data)
+    except Exception:
+        # No data, or cut short as the child died while writing it.
+        pass
+    else:
+        if kind == 'result':
+            return value, None
+        return None, value
+    if os.WIFSIGNALED(status):
+        return None, 'Child process killed by signal {0}.'.format(
+            os.WTERMSIG(status))
+    return None, 'Child process exited with status {0}.'.format(
+        os.WEXITSTATUS(status))
@@ -0,0 +1,303 @@
+"""Prefork serving, in worker processes sharing the memory of one parent.
+
+`tango serve site --workers N` serves a site from N worker processes forked
+from one parent, in place of the single-process development server. The
+parent builds the app, its routes and its Jinja environment, and with
+SERVE_WARM set, warms the app's caches by requesting each route without view
+args, see warm, before it forks. Workers then share all of that copy-on-write,
+and take turns accepting connections on the parent's listening socket.
+
+Workers are recycled: a worker exits after serving SERVE_MAX_REQUESTS
+requests, give or take a tenth such that workers do not all exit at once, or
+once its resident memory grows by more than SERVE_MAX_MEMORY since it was
+forked, and the parent forks another in its place. Resident memory is read
+from /proc, so SERVE_MAX_MEMORY applies only on systems which have it.
+
+Every SERVE_CHECK_INTERVAL seconds, the parent checks the shelf generation of
+the site. On a new generation, or on SIGHUP, it warms the app's caches again,
+forks a new set of workers, and stops the old set gracefully: each worker
+finishes the request in hand, then exits. On SIGTERM or SIGINT, the parent
+stops all workers the same way, then exits.
+
+Forking requires a POSIX system.
+"""
+
+import errno
+import os
+import resource
+import signal
+import time
+import traceback
+
+from werkzeug.serving import BaseWSGIServer
+
+from tango.stash import parse_size
+
+
+class WorkerServer(BaseWSGIServer):
+    """WSGI server of one worker, accepting on a socket shared by workers.
+
+    The socket does not block, as another worker may accept a connection
+    first; handle_request then returns after at most timeout seconds.
+    """
+
+    multiprocess = True
+    timeout = 1
+
+    # Number of requests served by this process.
+    served = 0
+
+    def server_activate(self):
+        BaseWSGIServer.server_activate(self)
+        self.socket.setblocking(0)
+
+    def process_request(self, request, client_address):
+        self.served += 1
+        BaseWSGIServer.process_request(self, request, client_address)
+
+
+class PreforkServer(object):
+    "Serve an app from a pool of forked worker processes, see module doc."
+
+    def __init__(self, app, host='127.0.0.1', port=5000, workers=1,
+                 max_requests=None, max_memory=None, warm=True,
+                 check_interval=1, logfile=None):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = max(1, workers)
+        self.max_requests = max_requests
+        self.max_memory = max_memory
+        self.warm = warm
+        self.check_interval = check_interval
+        self.logfile = logfile
+        self.server = None
+        # Dict of worker pid to the set of workers it belongs to, counted up
+        # on each reload, such that workers of an old set are not replaced.
+        self.children = {}
+        self.current = 0
+        self.stopping = False
+        self.reloading = False
+        # Whether a worker was asked to stop, as set in the worker itself.
+        self.stopped = False
+
+    @property
+    def address(self):
+        "The (host, port) served, once bound, e.g. with port 0 given."
+        return self.server.server_address
+
+    def bind(self):
+        "Open the listening socket, which workers inherit, if not yet open."
+        if self.server is None:
+            self.server = WorkerServer(self.host, self.port, self.app)
+        return self.server
+
+    def run(self):
+        "Serve until SIGTERM or SIGINT, then stop the workers and return."
+        if self.warm:
+            self.log('Warmed {0} routes.'.format(warm(self.app)))
+        self.bind()
+        generations = self.generations()
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        self.log('Serving {0} on http://{1}:{2}/ with {3} workers.'.format(
+            self.app.import_name, self.address[0], self.address[1],
+            self.workers))
+        try:
+            self.spawn_workers()
+            checked = time.time()
+            while not self.stopping:
+                self.reap()
+                if time.time() - checked >= self.check_interval:
+                    checked = time.time()
+                    latest = self.generations()
+                    if latest != generations:
+                        generations = latest
+                        self.log('Reloading, as the shelf changed.')
+                        self.reloading = True
+                if self.reloading:
+                    self.reload()
+                self.spawn_workers()
+                time.sleep(0.05)
+        finally:
+            self.stop(list(self.children))
+            self.server.server_close()
+        self.log('Stopped.')
+
+    def generations(self):
+        "Provide the shelf generation of each site of the app, as a tuple."
+        sites = sorted(set(route.site for route in self.app.routes))
+        return tuple(self.app.shelf.generation(site) for site in sites)
+
+    def reload(self):
+        "Replace all workers with a new set, forked after warming again."
+        self.reloading = False
+        old = list(self.children)
+        self.current += 1
+        if self.warm:
+            warm(self.app)
+        self.spawn_workers()
+        self.stop(old)
+
+    def spawn_workers(self):
+        "Fork workers of the current set until there are enough of them."
+        while not self.stopping and \
+                self.children.values().count(self.current) < self.workers:
+            pid = os.fork()
+            if pid == 0:
+                status = 0
+                try:
+                    self.work()
+                except:
+                    traceback.print_exc()
+                    status = 1
+                finally:
+                    os._exit(status)
+            self.children[pid] = self.current
+
+    def work(self):
+        "Serve requests in a worker, until stopped or due to be recycled."
+        signal.signal(signal.SIGTERM, self.handle_worker_stop)
+        # Finish the request in hand, rather than fail its reads and writes.
+        signal.siginterrupt(signal.SIGTERM, False)
+        # The parent handles interrupts, and stops workers with SIGTERM.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        # A SIGTERM since the fork went to the parent's handler.
+        self.stopped = self.stopping
+        parent = os.getppid()
+        max_requests = self.max_requests
+        if max_requests is not None:
+            # Spread out workers' exits, by up to a tenth of max requests.
+            max_requests += os.getpid() % (max_requests // 10 + 1)
+        server = self.server
+        # Measure this worker's own growth, not what it shares of the parent.
+        forked_memory = resident_memory()
+        while not (self.stopped or self.stopping) and \
+                os.getppid() == parent:
+            server.handle_request()
+            if max_requests is not None and server.served >= max_requests:
+                return
+            if self.max_memory is not None and forked_memory is not None \
+                    and resident_memory() - forked_memory > self.max_memory:
+                return
+
+    def reap(self):
+        "Collect workers which exited, logging those which were not stopped."
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, error:
+                if error.errno == errno.EINTR:
+                    continue
+                if error.errno == errno.ECHILD:
+                    self.children.clear()
+                    return
+                raise
+            if pid == 0:
+                return
+            if self.children.pop(pid, None) == self.current and \
+                    not self.stopping:
+                self.log('Worker {0} exited with status {1}; replacing it.'
+                         .format(pid, os.WEXITSTATUS(status)
+                                 if os.WIFEXITED(status) else status))
+
+    def stop(self, pids):
+        "Stop workers gracefully, waiting for each to finish its request."
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError, error:
+                if error.errno != errno.ESRCH:
+                    raise
+        for pid in pids:
+            while True:
+                try:
+                    os.waitpid(pid, 0)
+                except OSError, error:
+                    if error.errno == errno.EINTR:
+                        continue
+                    if error.errno != errno.ECHILD:
+                        raise
+                break
+            self.children.pop(pid, None)
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def handle_reload(self, signum, frame):
+        self.reloading = True
+
+    def handle_worker_stop(self, signum, frame):
+        self.stopped = True
+
+    def log(self, line):
+        if self.logfile is not None:
+            self.logfile.write(line + '\n')
+            self.logfile.flush()
+
+
+def serve_prefork(app, host='127.0.0.1', port=5000, workers=None,
+                  max_requests=None, max_memory=None, logfile=None):
+    """Serve an app from forked workers, until SIGTERM or SIGINT.
+
+    Workers, max_requests and max_memory default to SERVE_WORKERS,
+    SERVE_MAX_REQUESTS and SERVE_MAX_MEMORY in config. Max memory is a
+    size, see parse_size.
+    """
+    config = app.config
+    if workers is None:
+        workers = config['SERVE_WORKERS']
+    if max_requests is None:
+        max_requests = config['SERVE_MAX_REQUESTS']
+    if max_memory is None:
+        max_memory = config['SERVE_MAX_MEMORY']
+    server = PreforkServer(app, host, port, workers=workers,
+                           max_requests=max_requests,
+                           max_memory=parse_size(max_memory),
+                           warm=config['SERVE_WARM'],
+                           check_interval=config['SERVE_CHECK_INTERVAL'],
+                           logfile=logfile)
+    server.run()
+    return server
+
+
+def warm(app):
+    """Request each route of an app without view args, to fill its caches.
+
+    Responses are discarded; what remains is whatever the app keeps, e.g. its
+    shelf and response caches, see SHELF_CACHE and RESPONSE_CACHE, and its
+    compiled templates. Returns the number of routes requested.
+
+    >>> from tango.app import Tango
+    >>> app = Tango.build_app('testsite')
+    >>> app.config['RESPONSE_CACHE'] = True
+    >>> warm(app)
+    6
+    >>> len(app.response_cache)
+    6
+    >>>
+    """
+    client = app.test_client()
+    count = 0
+    for route in app.routes:
+        if '<' not in route.rule:
+            client.get(route.rule)
+            count += 1
+    return count
+
+
+def resident_memory():
+    """Provide the resident memory of this process, in bytes.
+
+    This is read from /proc, and is None where there is no /proc. The peak
+    resident memory from getrusage is no substitute, as a forked process
+    starts out with its parent's peak.
+    """
+    try:
+        with open('/proc/self/statm') as fd:
+            pages = int(fd.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize()
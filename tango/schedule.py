@@ -0,0 +1,210 @@
+"""Scheduled shelving, which refreshes each stash module as it falls due.
+
+A stash module may declare how often its routes are to be refreshed, with a
+refresh field in its header, e.g. `refresh: 5m`, see parse_interval. `tango
+schedule site` runs until interrupted: it shelves the whole site once, then
+pulls each module again each time its interval elapses, such that upstream
+load and shelf writes follow what each route needs. A module without refresh
+is left as shelved after the first run, e.g. for `tango shelve` to update.
+
+Modules are pulled in child processes, up to SCHEDULE_JOBS at once, each
+importing the module anew, and limited in time and memory as in a shelve
+run, see pull_module_routes. Each refresh is delayed at random by up to
+SCHEDULE_JITTER of its interval, to spread out modules of equal intervals.
+A module which fails, or whose routes fail to be written, is logged and left
+as shelved until its next refresh.
+Modules declaring a route in common are pulled together, as its context is
+merged from all of them, as often as the most often of them.
+
+Routes are read from headers once, at start; restart the scheduler to pick up
+a changed header. The log line of each pull gives the backlog: the number of
+modules due but waiting for a child, and by how long the oldest is late.
+
+Example:
+>>> units = schedule_units(parse_module_routes('testsite.stash'))
+>>> [(names, refresh) for names, module_routes, refresh in units]
+... # doctest: +NORMALIZE_WHITESPACE
+[(['testsite.stash', 'testsite.stash.package.module'], None),
+ (['testsite.stash.blankexport'], None),
+ (['testsite.stash.index'], None),
+ (['testsite.stash.multiple'], None),
+ (['testsite.stash.noexports'], None),
+ (['testsite.stash.view_arg'], None)]
+>>>
+"""
+
+import heapq
+import random
+import time
+import traceback
+
+from werkzeug import create_environ
+
+from tango.app import Tango
+from tango.parallel import Children
+from tango.stash import merge_routes, module_limits, parse_module_routes
+from tango.stash import pull_context
+
+
+class Scheduler(object):
+    "Pull the stash modules of an app as they fall due, and shelve them."
+
+    def __init__(self, app, jobs=1, jitter=0, logfile=None):
+        self.app = app
+        self.jobs = max(1, jobs)
+        self.jitter = jitter
+        self.logfile = logfile
+        # List of (names, module routes, refresh) of modules pulled together.
+        self.units = schedule_units(parse_module_routes(app.stash_module))
+        # Heap of (due time, index) of units waiting to be pulled.
+        now = time.time()
+        self.queue = [(now, index) for index in range(len(self.units))]
+        heapq.heapify(self.queue)
+        self.children = Children()
+
+    def run(self, pulls=None):
+        """Pull units of modules as they fall due, and shelve their routes.
+
+        Runs until interrupted, until the given number of pulls complete if
+        any, or until no unit is due ever again.
+        """
+        completed = 0
+        try:
+            with self.app.request_context(create_environ()):
+                while pulls is None or completed < pulls:
+                    if not self.queue and not self.children:
+                        return
+                    now = time.time()
+                    while self.queue and self.queue[0][0] <= now and \
+                            len(self.children) < self.jobs:
+                        due, index = heapq.heappop(self.queue)
+                        names, module_routes, refresh = self.units[index]
+                        timeout, memory = unit_limits(module_routes,
+                                                      *self.app.pull_limits())
+                        self.children.start((index, due, now), pull_unit,
+                                            module_routes, timeout=timeout,
+                                            memory=memory)
+                    # Wait for a child, or until the next unit falls due.
+                    timeout = None
+                    if self.queue and len(self.children) < self.jobs:
+                        timeout = max(0, self.queue[0][0] - now)
+                    if not self.children:
+                        time.sleep(timeout)
+                        continue
+                    for key, routes, error in self.children.wait(timeout):
+                        self.complete(key, routes, error)
+                        completed += 1
+        finally:
+            self.children.terminate()
+
+    def complete(self, key, routes, error):
+        "Shelve the routes of a unit pulled, given its key, and reschedule."
+        index, due, started = key
+        names, module_routes, refresh = self.units[index]
+        now = time.time()
+        if error is None:
+            try:
+                self.app.shelf.put_many(self.app.shelf_item(route)
+                                        for route in routes)
+            except Exception:
+                # E.g. the database is locked by a shelve run; try again on
+                # the unit's next refresh.
+                error = traceback.format_exc()
+        if refresh is not None:
+            # Keep to the unit's cadence, unless it is overdue already.
+            due = max(due + refresh, now)
+            due += random.uniform(0, self.jitter * refresh)
+            heapq.heappush(self.queue, (due, index))
+        if self.logfile is None:
+            return
+        count, late = self.backlog(now)
+        outcome = 'Refreshed' if error is None else 'Failed to refresh'
+        self.logfile.write('{0} {1} in {2:.2f}s; backlog: {3} due, {4:.1f}s '
+                           'late.\n'.format(outcome, ', '.join(names),
+                                            now - started, count, late))
+        if error is not None:
+            self.logfile.write(error.rstrip('\n') + '\n')
+        self.logfile.flush()
+
+    def backlog(self, now=None):
+        """Provide the backlog, as (count, seconds late) of units due.
+
+        Counts units due but not yet pulled, i.e. waiting for a child, and
+        gives how long ago the oldest of them fell due.
+        """
+        if now is None:
+            now = time.time()
+        due = [when for when, index in self.queue if when <= now]
+        if not due:
+            return 0, 0.0
+        return len(due), now - min(due)
+
+
+def schedule_units(module_routes):
+    """Group (name, routes) module pairs into units to be pulled together.
+
+    Modules declaring a route in common share a unit. Gives a list of
+    (names, module routes, refresh) for each unit, in order of its first
+    module, where refresh is the least refresh of its routes, or None.
+    """
+    position = dict((name, index)
+                    for index, (name, routes) in enumerate(module_routes))
+    # Dict of module name to its group, the list of modules it shares.
+    group_of = {}
+    # Dict of rule to the first module declaring it.
+    declaring = {}
+    for name, routes in module_routes:
+        group_of[name] = [name]
+        for route in routes:
+            other = declaring.setdefault(route.rule, name)
+            if group_of[other] is not group_of[name]:
+                group = group_of[other] + group_of[name]
+                for member in group:
+                    group_of[member] = group
+    units = []
+    for name, routes in module_routes:
+        names = sorted(group_of[name], key=position.get)
+        if names[0] != name:
+            continue
+        unit = [module_routes[position[member]] for member in names]
+        refreshes = [route.refresh for member, member_routes in unit
+                     for route in member_routes if route.refresh is not None]
+        units.append((names, unit, min(refreshes) if refreshes else None))
+    return units
+
+
+def unit_limits(module_routes, timeout=None, memory=None):
+    """Provide (timeout, memory) to pull the modules of a unit in one child.
+
+    The unit has the sum of the timeouts of its modules, and the most memory
+    of any, as in module_limits, or no limit if any of its modules has none.
+    """
+    limits = [module_limits(routes, timeout, memory)
+              for name, routes in module_routes]
+    timeouts = [limit[0] for limit in limits]
+    memories = [limit[1] for limit in limits]
+    return (None if None in timeouts else sum(timeouts),
+            None if None in memories else max(memories))
+
+
+def pull_unit(module_routes):
+    "Pull the contexts of (name, routes) modules of a unit, merging routes."
+    routes = []
+    for name, declared in module_routes:
+        routes.extend(pull_context(declared))
+    return merge_routes(routes)
+
+
+def schedule_by_name(name, jobs=None, logfile=None, pulls=None):
+    """Refresh the stash modules of an app matching import name, as due.
+
+    Runs for the given number of pulls, or until interrupted. Jobs defaults
+    to SCHEDULE_JOBS in config. Returns the scheduler.
+    """
+    app = Tango.build_app(name)
+    if jobs is None:
+        jobs = app.config['SCHEDULE_JOBS']
+    scheduler = Scheduler(app, jobs=jobs, jitter=app.config['SCHEDULE_JITTER'],
+                          logfile=logfile)
+    scheduler.run(pulls=pulls)
+    return scheduler
@@ -1,24 +1,154 @@
 "Shelf connectors for persisting stashed template context variables."
 
 import cPickle as pickle
+import hashlib
+import marshal
+import mmap
+import os
 import pickletools
-from contextlib import closing
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
 from cPickle import HIGHEST_PROTOCOL
 from sqlite3 import Binary as blobify
 from sqlite3 import dbapi2 as sqlite3
 from sqlite3 import OperationalError
 
+from tango import instrument
+from tango.cache import LRUCache
+from tango.codec import decode, encode
+from tango.errors import ShelfError
+
+
+class Entry(object):
+    "A route's context as found on the shelf, with details of its storage."
+
+    # site & rule of the route
+    site = None
+    rule = None
+
+    # template context of the route
+    context = None
+
+    # response body pre-encoded by the route's writer at shelve time, or None
+    body = None
+
+    # size in bytes of the context and body as stored, or None if unknown
+    size = None
+
+    # generation of the site when this entry was read, or None if unknown
+    generation = None
+
+    # content hash of the context and body as stored, or None if unknown
+    digest = None
+
+    # time at which the context and body were shelved, or None if unknown
+    shelved_at = None
+
+    def __init__(self, site, rule, context, body=None, size=None,
+                 generation=None, digest=None, shelved_at=None):
+        self.site = site
+        self.rule = rule
+        self.context = context
+        self.body = body
+        self.size = size
+        self.generation = generation
+        self.digest = digest
+        self.shelved_at = shelved_at
+
+    def __repr__(self):
+        return '<Entry: {0} {1}>'.format(self.site, self.rule)
+
 
 class BaseConnector(object):
     def __init__(self, app):
         self.app = app
 
-    def get(self, site, rule):
+    def get(self, site, rule, keys=None):
+        """Get the context of a route, or {} if the route is not shelved.
+
+        If keys is given, get only those keys of the context, e.g. as a
+        writer needs them. Connectors storing each export of a context on
+        its own, see SHELF_LAYOUT, then load only the exports needed.
+        """
         raise NotImplementedError('A shelf connector must implement get.')
 
-    def put(self, site, rule, context, source_files=None):
+    def fetch(self, site, rule, generation=None, keys=None):
+        """Get the Entry of a route, or None if the route is not shelved.
+
+        If generation is given, read the route as of that generation of its
+        site, as pinned by the caller. If keys is given, the entry holds only
+        those keys of the context, as in get. Connectors should override this
+        to report the size of the entry; by default, this wraps get.
+        """
+        context = self.get(site, rule, keys)
+        if not context:
+            return None
+        return Entry(site, rule, context)
+
+    def generation(self, site):
+        """Return the generation of a site on the shelf.
+
+        A site's generation changes each time any of its routes are put or
+        dropped, such that caches of those routes can tell they are stale.
+        """
+        raise NotImplementedError('A shelf connector must implement '
+                                  'generation.')
+
+    def rollback(self, site, generation=None):
+        """Make a prior generation of a site current again, by default the
+        one before the current generation. Returns the generation.
+        """
+        raise NotImplementedError('A shelf connector must implement '
+                                  'rollback.')
+
+    def digest(self, site, rule, generation=None):
+        """Return the content hash of a route as stored, as in Entry.digest.
+
+        This lets a cache keep an entry across generations in which the
+        route did not change. Returns None if the route is not shelved or
+        the connector does not hash contents, which is the default.
+        """
+        return None
+
+    def stamp(self, site, rule, generation=None):
+        """Return (digest, shelved_at) of a route as stored, as in Entry.
+
+        This tells whether a client's copy of a route is current without
+        loading the route. Returns None if the route is not shelved or has no
+        digest. Time shelved_at is None if unknown, which is the default.
+        """
+        digest = self.digest(site, rule, generation)
+        if digest is None:
+            return None
+        return digest, None
+
+    def get_many(self, keys):
+        """Get the contexts of many routes, given (site, rule) pairs.
+
+        Returns a dict of (site, rule) to context. Connectors should override
+        this to fetch in bulk; by default, this calls get once per key.
+        """
+        return dict((key, self.get(*key)) for key in keys)
+
+    def put(self, site, rule, context, source_files=None, body=None):
         raise NotImplementedError('A shelf connector must implement put.')
 
+    def put_many(self, items, batch_size=None):
+        """Put many routes on the shelf, each item a tuple of put arguments.
+
+        Connectors should override this to write all items in one
+        transaction; by default, this calls put once per item. Items may be
+        an iterator, consumed as written. A connector may commit its writes
+        in batches of batch_size items, where given, so long as readers do
+        not see any of the items until all are written.
+        """
+        for item in items:
+            self.put(*item)
+
     def drop(self, site, rule=None):
         raise NotImplementedError('A shelf connector must implement drop.')
 
@@ -28,8 +158,38 @@ class BaseConnector(object):
         """
         raise NotImplementedError('A shelf connector must implement list.')
 
+    def close(self):
+        "Release any resources held by this connector, e.g. connections."
+
+
 class SqliteConnector(BaseConnector):
-    def initialize(self):
+    """Shelf connector backed by a SQLite database file.
+
+    One connector is shared by all requests of an app, see Tango.shelf.
+    Connections are pooled: each thread of each process opens one connection
+    to the database file on first use, sets up the schema on that connection,
+    then reuses it for every later call. A forked worker process does not
+    reuse the connection of its parent, as SQLite forbids that.
+
+    Each put_many, e.g. a shelve run, writes a new generation of each site
+    it touches, and points each site at its new generation on completion.
+    Reads of a site go through its pointer, as of one generation, so readers
+    never see a site half shelved. A route's row is only written again when
+    the route is put; reads take the latest row up to the site's generation.
+    Prior generations are kept as given by SHELF_KEEP_GENERATIONS, to roll
+    back to.
+
+    Encoded contexts and bodies are stored once each in the blobs table, by
+    content hash, and rows refer to them by hash. A route whose hashes and
+    source files are unchanged is not written again, so re-shelving an
+    unchanged site writes nothing and keeps its generation.
+    """
+
+    def __init__(self, app):
+        BaseConnector.__init__(self, app)
+        self.local = threading.local()
+
+    def initialize(self, db):
         """ -- schema:
         CREATE TABLE IF NOT EXISTS contexts (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -38,105 +198,1128 @@ class SqliteConnector(BaseConnector):
             context BLOB NOT NULL
         );
         """
-        with self.connect(initialize=False) as db:
+        with db:
             db.cursor().executescript(self.initialize.func_doc)
+        self.add_source_files_to_schema(db)
+        self.migrate(db)
 
-    def add_source_files_to_schema(self):
-        with self.connect(initialize=False) as db:
+    def add_source_files_to_schema(self, db):
+        with db:
             try:
-                db.cursor().execute("SELECT source_files FROM contexts")
+                db.cursor().execute("SELECT source_files FROM contexts LIMIT 1")
             except OperationalError:
                 db.cursor().execute("ALTER TABLE contexts "
                                     "ADD COLUMN source_files "
                                     "NOT NULL "
                                     "DEFAULT ''")
 
+    # Names of schema migrations, in order. See migrate.
+    migrations = ['index_site_rule', 'site_generations', 'context_codecs',
+                  'response_bodies', 'shelf_generations', 'context_blobs',
+                  'export_references']
+
+    def migrate(self, db):
+        """Apply the schema migrations which this shelf file has not yet seen.
+
+        The file's user_version pragma counts the migrations applied to it.
+        Each migration is the SQL script in the docstring of the method by
+        that name, followed by the method called with db, for data which SQL
+        alone cannot migrate. Pending migrations run in one transaction along
+        with the version bump, under a write lock in case connections race to
+        migrate.
+        """
+        if self.schema_version(db) >= len(self.migrations):
+            return
+        # Manage the transaction here; sqlite3 otherwise commits before DDL.
+        isolation_level, db.isolation_level = db.isolation_level, None
+        try:
+            db.execute('BEGIN IMMEDIATE;')
+            try:
+                applied = self.schema_version(db)
+                for name in self.migrations[applied:]:
+                    migration = getattr(self, name)
+                    for statement in split_sql(migration.func_doc):
+                        db.execute(statement)
+                    migration(db)
+                db.execute('PRAGMA user_version = {0};'
+                           .format(len(self.migrations)))
+                db.execute('COMMIT;')
+            except:
+                db.execute('ROLLBACK;')
+                raise
+        finally:
+            db.isolation_level = isolation_level
+
+    def schema_version(self, db):
+        "Return the number of migrations applied to the shelf on db."
+        return db.execute('PRAGMA user_version;').fetchone()[0]
+
+    def index_site_rule(self, db=None):
+        """ -- migration: one row per route, looked up by index.
+        DELETE FROM contexts WHERE id NOT IN
+            (SELECT MAX(id) FROM contexts GROUP BY site, rule);
+        CREATE UNIQUE INDEX IF NOT EXISTS contexts_site_rule
+            ON contexts (site, rule);
+        """
+
+    def site_generations(self, db=None):
+        """ -- migration: count writes to each site, to invalidate caches.
+        CREATE TABLE IF NOT EXISTS sites (
+            site TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL DEFAULT 0
+        );
+        """
+
+    def context_codecs(self, db=None):
+        """ -- migration: tag each context with the codec which encoded it.
+        ALTER TABLE contexts ADD COLUMN codec TEXT NOT NULL DEFAULT 'pickle';
+        """
+
+    def response_bodies(self, db=None):
+        """ -- migration: store response bodies pre-encoded by writers.
+        ALTER TABLE contexts ADD COLUMN body BLOB;
+        """
+
+    def shelf_generations(self, db=None):
+        """ -- migration: write each shelve run into a generation of its own.
+        ALTER TABLE contexts ADD COLUMN generation INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE contexts ADD COLUMN dropped INTEGER NOT NULL DEFAULT 0;
+        DROP INDEX IF EXISTS contexts_site_rule;
+        CREATE UNIQUE INDEX IF NOT EXISTS contexts_site_rule_generation
+            ON contexts (site, rule, generation);
+        CREATE INDEX IF NOT EXISTS contexts_site_generation
+            ON contexts (site, generation);
+        ALTER TABLE sites ADD COLUMN latest INTEGER NOT NULL DEFAULT 0;
+        UPDATE sites SET latest = generation;
+        CREATE TABLE IF NOT EXISTS generations (
+            site TEXT NOT NULL,
+            generation INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            committed_at REAL,
+            PRIMARY KEY (site, generation)
+        );
+        INSERT INTO generations (site, generation, state)
+            SELECT DISTINCT site, 0, 'committed' FROM contexts;
+        """
+
+    def context_blobs(self, db=None):
+        """ -- migration: store each distinct context and body once, by hash.
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            data BLOB NOT NULL
+        );
+        ALTER TABLE contexts ADD COLUMN hash TEXT;
+        ALTER TABLE contexts ADD COLUMN body_hash TEXT;
+        CREATE INDEX IF NOT EXISTS contexts_hash ON contexts (hash);
+        CREATE INDEX IF NOT EXISTS contexts_body_hash ON contexts (body_hash);
+        """
+
+    def export_references(self, db=None):
+        """ -- migration: record the export blobs of each row, for pruning.
+        CREATE TABLE IF NOT EXISTS export_blobs (
+            context_id INTEGER NOT NULL,
+            hash TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS export_blobs_context_id
+            ON export_blobs (context_id);
+        CREATE INDEX IF NOT EXISTS export_blobs_hash ON export_blobs (hash);
+        """
+        if db is None:
+            return
+        # Rows stored by export list their exports' hashes in their context.
+        cursor = db.execute('SELECT contexts.id, '
+                            'COALESCE(context_blobs.data, contexts.context) '
+                            'FROM contexts LEFT JOIN blobs AS context_blobs '
+                            'ON context_blobs.hash = contexts.hash '
+                            'WHERE contexts.codec = ?;', (EXPORTS,))
+        for context_id, data in cursor.fetchall():
+            db.executemany('INSERT INTO export_blobs (context_id, hash) '
+                           'VALUES (?, ?);',
+                           [(context_id, export[2])
+                            for export in marshal.loads(str(data))])
+
     def connect(self, initialize=True):
+        "Open a new connection to the shelf, which is not pooled."
+        db = sqlite3.connect(self.app.config['SHELF_SQLITE_FILEPATH'])
         if initialize:
-            self.initialize()
-            self.add_source_files_to_schema()
-        return sqlite3.connect(self.app.config['SHELF_SQLITE_FILEPATH'])
+            self.initialize(db)
+        return db
 
+    @contextmanager
     def connection(self):
-        return closing(self.connect())
+        "Provide the pooled connection of the current thread and process."
+        # Key on filepath too, in case app.config changes after first use.
+        key = os.getpid(), self.app.config['SHELF_SQLITE_FILEPATH']
+        if getattr(self.local, 'key', None) != key:
+            self.local.db = self.connect()
+            self.local.key = key
+        db = self.local.db
+        try:
+            yield db
+        except:
+            # Do not leave a failed write pending on a reused connection.
+            db.rollback()
+            raise
+
+    def close(self):
+        "Close the pooled connection of the current thread, if any."
+        db = getattr(self.local, 'db', None)
+        if db is not None and self.local.key[0] == os.getpid():
+            db.close()
+        self.local.db = self.local.key = None
 
-    def get(self, site, rule):
+    def get(self, site, rule, keys=None):
+        entry = self.fetch(site, rule, keys=keys)
+        if entry is None:
+            return {}
+        return entry.context
+
+    def fetch(self, site, rule, generation=None, keys=None):
         with self.connection() as db:
-            cursor = db.execute('SELECT context FROM contexts '
-                                'WHERE site = ? AND rule = ? '
-                                'ORDER BY id DESC;', (site, rule))
+            if generation is None:
+                generation = self.current(db, site)
+            cursor = db.execute(SELECT_ROW + ', contexts.dropped, '
+                                'contexts.hash, contexts.body_hash, ' +
+                                SHELVED_AT + 'FROM ' + ROW_BLOBS + ' '
+                                'WHERE ' + VISIBLE_ROW,
+                                (site, rule, generation, site))
             result = cursor.fetchone()
-            if result is None:
-                return {}
-            return pickle.loads(str(result[0]))
+            if result is None or result[3]:
+                return None
+            codec, data, body = result[0], str(result[1]), result[2]
+            context, size = self.load(db, codec, data, keys)
+            if body is not None:
+                body = str(body)
+                size += len(body)
+            return Entry(site, rule, context, body=body, size=size,
+                         generation=generation,
+                         digest=join_digest(result[4], result[5]),
+                         shelved_at=result[6])
+
+    def load(self, db, codec, data, keys=None):
+        """Decode a context as stored, on connection db: (context, size).
+
+        A context stored by export, see SHELF_LAYOUT, is a list of its exports
+        with their codecs and hashes; only the exports in keys are loaded
+        then, if keys is given. Size counts the bytes loaded.
+        """
+        if codec != EXPORTS:
+            return project(decode(codec, data), keys), len(data)
+        exports = marshal.loads(data)
+        if keys is not None:
+            keys = set(keys)
+            exports = [export for export in exports if export[0] in keys]
+        hashes = list(set(export[2] for export in exports))
+        blobs = {}
+        for start in range(0, len(hashes), 500):
+            chunk = hashes[start:start + 500]
+            cursor = db.execute('SELECT hash, data FROM blobs '
+                                'WHERE hash IN ({0});'
+                                .format(', '.join('?' * len(chunk))), chunk)
+            blobs.update((key, str(blob)) for key, blob in cursor)
+        context = {}
+        size = len(data)
+        for name, export_codec, export_hash in exports:
+            context[name] = decode(export_codec, blobs[export_hash])
+            size += len(blobs[export_hash])
+        return context, size
+
+    def digest(self, site, rule, generation=None):
+        stamp = self.stamp(site, rule, generation)
+        if stamp is None:
+            return None
+        return stamp[0]
+
+    def stamp(self, site, rule, generation=None):
+        """Return (digest, shelved_at) of a route, without reading its blobs.
+
+        Time shelved_at is when the generation which last changed the route
+        was committed, which is None for routes from before generations.
+        """
+        with self.connection() as db:
+            if generation is None:
+                generation = self.current(db, site)
+            cursor = db.execute('SELECT hash, body_hash, dropped, ' +
+                                SHELVED_AT + 'FROM contexts '
+                                'WHERE ' + VISIBLE_ROW,
+                                (site, rule, generation, site))
+            result = cursor.fetchone()
+            if result is None or result[2]:
+                return None
+            digest = join_digest(result[0], result[1])
+            if digest is None:
+                return None
+            return digest, result[3]
+
+    def generation(self, site):
+        with self.connection() as db:
+            return self.current(db, site)
+
+    def current(self, db, site):
+        "Return the current generation of a site, on connection db."
+        cursor = db.execute('SELECT generation FROM sites '
+                            'WHERE site = ?;', (site,))
+        result = cursor.fetchone()
+        if result is None:
+            return 0
+        return result[0]
+
+    def history(self, site):
+        """Return the generations of a site which it can be rolled back to.
+
+        Gives (generation, committed_at) pairs, latest first, starting with
+        the current generation and followed by SHELF_KEEP_GENERATIONS prior
+        generations at most. Time committed_at is None if not recorded.
+        """
+        with self.connection() as db:
+            return self.committed(db, site)
+
+    def committed(self, db, site):
+        "Return the history of a site, on connection db."
+        keep = self.app.config['SHELF_KEEP_GENERATIONS']
+        cursor = db.execute('SELECT generation, committed_at '
+                            'FROM generations '
+                            "WHERE site = ? AND state = 'committed' "
+                            'AND generation <= ? '
+                            'ORDER BY generation DESC LIMIT ?;',
+                            (site, self.current(db, site), keep + 1))
+        return cursor.fetchall()
+
+    def begin(self, db, site):
+        """Start a new generation of a site on connection db, uncommitted.
+
+        Routes written in this generation are not read until it is
+        committed. Returns the new generation, which is never reused.
+        """
+        # Update, or else insert, rather than upsert, which needs SQLite 3.24.
+        cursor = db.execute('UPDATE sites SET latest = latest + 1 '
+                            'WHERE site = ?;', (site,))
+        if not cursor.rowcount:
+            db.execute('INSERT INTO sites (site, generation, latest) '
+                       'VALUES (?, 0, 1);', (site,))
+        cursor = db.execute('SELECT latest FROM sites WHERE site = ?;',
+                            (site,))
+        generation = cursor.fetchone()[0]
+        db.execute('INSERT INTO generations (site, generation, state) '
+                   "VALUES (?, ?, 'pending');", (site, generation))
+        return generation
+
+    def commit(self, db, site, generation):
+        """Make a generation of a site current on connection db.
+
+        This moves the site's pointer to the new generation, which readers
+        see all at once when the transaction on db commits. Prior
+        generations are then pruned down to SHELF_KEEP_GENERATIONS.
+        """
+        db.execute('UPDATE generations '
+                   "SET state = 'committed', committed_at = ? "
+                   'WHERE site = ? AND generation = ?;',
+                   (time.time(), site, generation))
+        db.execute('UPDATE sites SET generation = ? WHERE site = ?;',
+                   (generation, site))
+        self.prune(db, site)
+
+    def prune(self, db, site):
+        """Delete rows which no kept generation of a site reads, on db.
+
+        Rows of rolled back generations go. Once the site has more prior
+        generations than SHELF_KEEP_GENERATIONS, the oldest kept generation
+        is the floor: so do rows of generations left pending below the floor,
+        which are taken to be abandoned, along with rows which are replaced
+        or dropped at or below the floor.
+        """
+        keep = self.app.config['SHELF_KEEP_GENERATIONS']
+        history = self.committed(db, site)
+        changes = db.total_changes
+        dead = "state = 'rolledback'"
+        floor = None
+        if len(history) > keep:
+            floor = history[keep][0]
+            dead += " OR (state = 'pending' AND generation < {0:d})" \
+                .format(floor)
+        db.execute('DELETE FROM contexts WHERE site = ? AND generation IN '
+                   '(SELECT generation FROM generations '
+                   'WHERE site = ? AND ({0}));'.format(dead), (site, site))
+        db.execute('DELETE FROM generations WHERE site = ? AND ({0});'
+                   .format(dead), (site,))
+        if floor is not None:
+            self.prune_below(db, site, floor)
+        # Drop blobs which no row refers to any more, if any rows were deleted,
+        # whether as its context, its body or one of its exports.
+        if db.total_changes != changes:
+            db.execute('DELETE FROM export_blobs WHERE context_id NOT IN '
+                       '(SELECT id FROM contexts);')
+            db.execute('DELETE FROM blobs WHERE hash NOT IN '
+                       '(SELECT hash FROM contexts WHERE hash IS NOT NULL) '
+                       'AND hash NOT IN (SELECT body_hash FROM contexts '
+                       'WHERE body_hash IS NOT NULL) '
+                       'AND hash NOT IN (SELECT hash FROM export_blobs);')
+
+    def prune_below(self, db, site, floor):
+        "Delete rows which a site's floor generation replaces, on db."
+        db.execute('DELETE FROM contexts WHERE site = ? AND generation < ? '
+                   'AND EXISTS (SELECT 1 FROM contexts AS newer '
+                   'WHERE newer.site = contexts.site '
+                   'AND newer.rule = contexts.rule '
+                   'AND newer.generation > contexts.generation '
+                   'AND newer.generation <= ?);', (site, floor, floor))
+        db.execute('DELETE FROM contexts WHERE site = ? AND dropped '
+                   'AND generation <= ?;', (site, floor))
+        db.execute('DELETE FROM generations WHERE site = ? AND generation < ? '
+                   'AND NOT EXISTS (SELECT 1 FROM contexts '
+                   'WHERE contexts.site = generations.site '
+                   'AND contexts.generation = generations.generation);',
+                   (site, floor))
+
+    def rollback(self, site, generation=None):
+        """Make a prior generation of a site current again, by default the
+        one before the current generation. Returns the generation.
+
+        Only generations in the site's history are kept to roll back to.
+        Generations after the one rolled back to are discarded.
+        """
+        with self.connection() as db:
+            history = [g for g, committed_at in self.committed(db, site)]
+            if generation is None and len(history) > 1:
+                generation = history[1]
+            if generation not in history:
+                raise ShelfError('No generation of {0} to roll back to: {1}'
+                                 .format(site, generation))
+            db.execute("UPDATE generations SET state = 'rolledback' "
+                       "WHERE site = ? AND state = 'committed' "
+                       'AND generation > ?;', (site, generation))
+            db.execute('UPDATE sites SET generation = ? WHERE site = ?;',
+                       (generation, site))
+            db.commit()
+        return generation
 
     def source(self, site, rule):
         with self.connection() as db:
-            cursor = db.execute('SELECT source_files FROM contexts '
-                                'WHERE site = ? AND rule = ? '
-                                'ORDER BY id DESC;', (site, rule))
+            cursor = db.execute('SELECT source_files FROM contexts WHERE ' +
+                                VISIBLE_ROW, (site, rule,
+                                              self.current(db, site), site))
             result = cursor.fetchone()
-            if result is None:
+            # Rows from before source files were shelved hold an empty value.
+            if result is None or not result[0]:
                 return []
             return pickle.loads(str(result[0]))
 
-    def put(self, site, rule, context, source_files=None):
+    def get_many(self, keys):
+        """Get the contexts of many routes, given (site, rule) pairs.
+
+        Returns a dict of (site, rule) to context, with one batched query per
+        site, as of its current generation. A missing route maps to an empty
+        context, as in get.
+        """
+        contexts = {}
+        rules_by_site = {}
+        for site, rule in keys:
+            contexts[site, rule] = {}
+            rules_by_site.setdefault(site, []).append(rule)
+        with self.connection() as db:
+            for site, rules in rules_by_site.items():
+                generation = self.current(db, site)
+                # Stay well under sqlite's limit of 999 bound parameters.
+                for start in range(0, len(rules), 500):
+                    chunk = rules[start:start + 500]
+                    markers = ', '.join('?' * len(chunk))
+                    # Rows come oldest first, so the latest of a route wins.
+                    cursor = db.execute(SELECT_ROW + ', contexts.dropped, '
+                                        'contexts.rule '
+                                        'FROM ' + ROW_BLOBS + ' '
+                                        'WHERE site = ? AND rule IN ({0}) '
+                                        'AND generation <= ? '
+                                        'AND generation IN ({1}) '
+                                        'ORDER BY generation;'
+                                        .format(markers, COMMITTED),
+                                        [site] + chunk + [generation, site])
+                    for codec, data, _, dropped, rule in cursor:
+                        if dropped:
+                            contexts[site, rule] = {}
+                        else:
+                            contexts[site, rule] = \
+                                self.load(db, codec, str(data))[0]
+        return contexts
+
+    def put(self, site, rule, context, source_files=None, body=None):
+        self.put_many([(site, rule, context, source_files, body)])
+
+    def put_many(self, items, batch_size=None):
+        """Put many routes on the shelf in one transaction.
+
+        Each item is a tuple of arguments to put. Items are written in order
+        into a new generation of each site written, and the generations are
+        committed together once all are written. Readers see either all of
+        the items or none of them. Items which are unchanged on the shelf
+        are skipped, and a site with no changed items keeps its generation.
+
+        With batch_size, the transaction is committed every batch_size items,
+        such that a long stream of items does not build up in one pending
+        transaction. The new generations stay pending, and are not read,
+        until all items are written. If writing fails midway, generations
+        with committed batches are marked rolled back, to be pruned.
+        """
+        generations = {}
+        try:
+            with self.connection() as db:
+                for count, item in enumerate(items, 1):
+                    with instrument.measure('write', route=tuple(item[:2])):
+                        self.write(db, generations, *item)
+                    if batch_size and count % batch_size == 0:
+                        with instrument.measure('commit'):
+                            db.commit()
+                with instrument.measure('commit'):
+                    for site, generation in generations.items():
+                        self.commit(db, site, generation)
+                    db.commit()
+        except:
+            if batch_size and generations:
+                self.abandon(generations)
+            raise
+
+    def abandon(self, generations):
+        "Mark pending generations, a dict of site to generation, rolled back."
+        with self.connection() as db:
+            for site, generation in generations.items():
+                db.execute("UPDATE generations SET state = 'rolledback' "
+                           "WHERE site = ? AND generation = ? "
+                           "AND state = 'pending';", (site, generation))
+            db.commit()
+
+    def write(self, db, generations, site, rule, context, source_files=None,
+              body=None):
+        """Write one route on connection db, uncommitted, unless unchanged.
+
+        The route goes into the site's generation in the generations dict,
+        which is begun here on the first changed route of the site.
+        """
         if source_files is None:
             source_files = [None]
+        with instrument.measure('serialize', route=(site, rule)):
+            codec, serialized_context, context_hash, blobs = \
+                self.encode(context)
+        instrument.add_bytes((site, rule), len(serialized_context) +
+                             sum(len(data) for _, data in blobs) +
+                             len(body or ''))
+        body_hash = None
+        if body is not None:
+            body_hash = blob_hash('', body)
+        generation = generations.get(site)
+
+        # Preserve existing source files, as of this generation.
+        cursor = db.execute('SELECT source_files, hash, body_hash, dropped '
+                            'FROM contexts '
+                            'WHERE site = ? AND rule = ? '
+                            'AND (generation = ? OR generation IN ({0})) '
+                            'ORDER BY generation DESC LIMIT 1;'
+                            .format(COMMITTED),
+                            (site, rule, generation, site))
+        existing = cursor.fetchone()
+        existing_source_files = None
+        if existing and existing[0]:
+            existing_source_files = pickle.loads(str(existing[0]))
+            source_files = sorted(set(source_files + existing_source_files))
+
+        # Skip the write if the route would be read back the same.
+        if existing and not existing[3] and \
+                (existing[1], existing[2]) == (context_hash, body_hash) and \
+                source_files == existing_source_files:
+            return
+        if generation is None:
+            generation = generations[site] = self.begin(db, site)
+
+        serialized_source_files = pickle.dumps(source_files, HIGHEST_PROTOCOL)
+        # Optimize pickle size, and conform it to sqlite's BLOB type.
+        serialized_source_files = blobify(pickletools.optimize(serialized_source_files))
+
+        # Store contexts and bodies once each, shared by all routes using them.
+        export_hashes = [key for key, _ in blobs]
+        blobs = blobs + [(context_hash, serialized_context)]
+        if body is not None:
+            blobs.append((body_hash, body))
+        db.executemany('INSERT OR IGNORE INTO blobs (hash, data) '
+                       'VALUES (?, ?);',
+                       [(key, blobify(data)) for key, data in blobs])
+
+        # Update the route's row of this generation, or else insert it, keyed
+        # by unique (site, rule, generation), such that a route written twice
+        # in a run is kept once. This is not an upsert, which needs SQLite
+        # 3.24 or later.
+        row = (codec, blobify(''), serialized_source_files, context_hash,
+               body_hash, site, rule, generation)
+        cursor = db.execute('UPDATE contexts '
+                            'SET codec = ?, context = ?, source_files = ?, '
+                            '    body = NULL, hash = ?, body_hash = ?, '
+                            '    dropped = 0 '
+                            'WHERE site = ? AND rule = ? AND generation = ?;',
+                            row)
+        if cursor.rowcount:
+            context_id = db.execute('SELECT id FROM contexts '
+                                    'WHERE site = ? AND rule = ? '
+                                    'AND generation = ?;',
+                                    (site, rule, generation)).fetchone()[0]
+            db.execute('DELETE FROM export_blobs WHERE context_id = ?;',
+                       (context_id,))
+        else:
+            context_id = db.execute('INSERT INTO contexts '
+                                    '(codec, context, source_files, body, '
+                                    ' hash, body_hash, site, rule, '
+                                    ' generation) '
+                                    'VALUES (?, ?, ?, NULL, ?, ?, ?, ?, ?);',
+                                    row).lastrowid
+        # Record the row's exports, which prune keeps as long as the row.
+        db.executemany('INSERT INTO export_blobs (context_id, hash) '
+                       'VALUES (?, ?);',
+                       [(context_id, key) for key in export_hashes])
 
+    def encode(self, context):
+        """Encode a context for the shelf, giving (codec, data, hash, blobs).
+
+        With SHELF_LAYOUT set to 'exports', each export of the context is
+        encoded on its own, into blobs as (hash, data) pairs, and the context
+        is stored as a list of its exports. Otherwise blobs is empty.
+        """
+        config = self.app.config
+        options = dict(name=config['SHELF_CODEC'],
+                       threshold=config['SHELF_COMPRESS_THRESHOLD'],
+                       level=config['SHELF_COMPRESS_LEVEL'])
+        blobs = []
+        if config['SHELF_LAYOUT'] == EXPORTS and isinstance(context, dict):
+            exports = []
+            for name in sorted(context):
+                export_codec, data = encode(context[name], **options)
+                export_hash = blob_hash(export_codec, data)
+                exports.append((name, export_codec, export_hash))
+                blobs.append((export_hash, data))
+            codec, data = EXPORTS, marshal.dumps(exports, 2)
+        else:
+            codec, data = encode(context, **options)
+        return codec, data, blob_hash(codec, data), blobs
+
+    def drop(self, site, rule=None):
+        "Drop routes of a site, in a new generation of that site."
         with self.connection() as db:
-            # Preserve existing source files
-            cursor = db.execute('SELECT source_files '
-                                'FROM contexts '
-                                'WHERE site = ? AND rule = ?;',
-                                (site, rule))
-            existing_source_files = cursor.fetchone()
-            if existing_source_files:
-                existing_source_files = pickle.loads(str(existing_source_files[0]))
-                source_files += existing_source_files
-                source_files = sorted(list(set(source_files)))
-
-            # Check to see if the context is already shelved.
-            cursor = db.execute('SELECT id FROM contexts '
-                                'WHERE site = ? AND rule = ?;', (site, rule))
-            serialized_context = pickle.dumps(context, HIGHEST_PROTOCOL)
-            serialized_source_files = pickle.dumps(source_files, HIGHEST_PROTOCOL)
-            # Optimize pickle size, and conform it to sqlite's BLOB type.
-            serialized_context = blobify(pickletools.optimize(serialized_context))
-            serialized_source_files = blobify(pickletools.optimize(serialized_source_files))
-
-            if cursor.fetchone() is None:
-                db.execute('INSERT INTO contexts '
-                           '(site, rule, context, source_files) VALUES (?, ?, ?, ?);',
-                           (site, rule, serialized_context, serialized_source_files))
-            else:
-                db.execute('UPDATE contexts '
-                           'SET context = ?, '
-                           '    source_files = ? '
-                           'WHERE site = ? AND rule = ?;',
-                           (serialized_context, serialized_source_files, site, rule))
+            # Match the site exactly, as LIKE takes _ in a name as a wildcard.
+            rules = [route[1] for route in self.routes(db, site, rule)
+                     if route[0] == site]
+            if not rules:
+                return
+            generation = self.begin(db, site)
+            db.executemany('INSERT INTO contexts '
+                           '(site, rule, generation, context, dropped) '
+                           'VALUES (?, ?, ?, ?, 1);',
+                           [(site, dropped, generation, blobify(''))
+                            for dropped in rules])
+            self.commit(db, site, generation)
             db.commit()
 
-    def drop(self, site, rule=None):
-        if rule is None:
-            rule = '%'
+    def list(self, site=None, rule=None):
         with self.connection() as db:
-            cursor = db.execute('SELECT id FROM contexts '
-                                'WHERE site = ? '
-                                'AND rule LIKE ?;', (site, rule))
-            if cursor.fetchone() is not None:
-                db.execute('DELETE FROM contexts '
-                           'WHERE site = ? AND rule LIKE ?;', (site, rule))
+            return [(route_site, route_rule)
+                    for route_site, route_rule, _ in
+                    self.routes(db, site, rule)]
 
-                db.commit()
+    def routes(self, db, site=None, rule=None):
+        """List routes matching site and rule patterns, on connection db.
 
-    def list(self, site=None, rule=None):
+        Gives (site, rule, generation) for each route as of the current
+        generation of its site, where generation is that of the row to read,
+        in the order in which the routes were first shelved.
+        """
         if site is None:
             site = '%'
         if rule is None:
             rule = '%'
+        cursor = db.execute('SELECT contexts.site, contexts.rule, '
+                            '       contexts.generation, contexts.dropped '
+                            'FROM contexts '
+                            'JOIN generations '
+                            'ON generations.site = contexts.site '
+                            'AND generations.generation = contexts.generation '
+                            'LEFT JOIN sites ON sites.site = contexts.site '
+                            'WHERE contexts.site LIKE ? '
+                            'AND contexts.rule LIKE ? '
+                            "AND generations.state = 'committed' "
+                            'AND contexts.generation <= '
+                            '    COALESCE(sites.generation, 0) '
+                            'ORDER BY contexts.id;', (site, rule))
+        # Keep the latest row of each route, in order of its first row.
+        order, routes = [], {}
+        for site, rule, generation, dropped in cursor:
+            if (site, rule) not in routes:
+                order.append((site, rule))
+            elif generation < routes[site, rule][0]:
+                continue
+            routes[site, rule] = generation, dropped
+        return [key + (routes[key][0],) for key in order
+                if not routes[key][1]]
+
+    def records(self):
+        """Iterate over all routes as stored, without decoding contexts.
+
+        Yields (site, rule, codec, data, body) tuples in order of list, as of
+        the current generation of each site, e.g. to export with
+        write_snapshot.
+        """
         with self.connection() as db:
-            cursor = db.execute('SELECT site, rule FROM contexts '
-                                'WHERE site LIKE ? AND rule LIKE ?;',
-                                (site, rule))
-            return cursor.fetchall()
+            for site, rule, generation in self.routes(db):
+                cursor = db.execute(SELECT_ROW + 'FROM ' + ROW_BLOBS + ' '
+                                    'WHERE site = ? AND rule = ? '
+                                    'AND generation = ?;',
+                                    (site, rule, generation))
+                codec, data, body = cursor.fetchone()
+                data = str(data)
+                if codec == EXPORTS:
+                    # Give the whole context, as readers of records expect.
+                    codec, data = encode(self.load(db, codec, data)[0],
+                                         self.app.config['SHELF_CODEC'])
+                if body is not None:
+                    body = str(body)
+                yield site, rule, codec, data, body
+
+
+# Codec tag of contexts stored by export, see SqliteConnector.encode.
+EXPORTS = 'exports'
+
+# SQL to select generation numbers of a site's committed generations.
+COMMITTED = ("SELECT generation FROM generations "
+             "WHERE site = ? AND state = 'committed'")
+
+# SQL to select a route's row as of a given generation of its site: the latest
+# row among committed generations up to it. Bind site, rule, generation, site.
+VISIBLE_ROW = ('site = ? AND rule = ? AND generation <= ? '
+               'AND generation IN (' + COMMITTED + ') '
+               'ORDER BY generation DESC LIMIT 1;')
+
+# SQL to select the time at which the generation of a row was committed.
+SHELVED_AT = ('(SELECT committed_at FROM generations '
+              'WHERE generations.site = contexts.site '
+              'AND generations.generation = contexts.generation) ')
+
+# SQL to select codec, context and body of rows, from their blobs if stored by
+# hash, and from the row itself otherwise, as in rows from before blobs.
+SELECT_ROW = ('SELECT contexts.codec, '
+              'COALESCE(context_blobs.data, contexts.context), '
+              'COALESCE(body_blobs.data, contexts.body) ')
+ROW_BLOBS = ('contexts '
+             'LEFT JOIN blobs AS context_blobs '
+             'ON context_blobs.hash = contexts.hash '
+             'LEFT JOIN blobs AS body_blobs '
+             'ON body_blobs.hash = contexts.body_hash')
+
+
+def blob_hash(codec, data):
+    "Provide the content hash of data as encoded by codec, '' for a body."
+    digest = hashlib.sha1(str(codec))
+    digest.update('\0')
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def project(context, keys=None):
+    """Provide only the given keys of a context, or all of it if keys is None.
+
+    Example:
+    >>> project({'title': 'Tango', 'count': 3}, ['title', 'missing'])
+    {'title': 'Tango'}
+    >>> project({'title': 'Tango'}) == {'title': 'Tango'}
+    True
+    >>>
+    """
+    if keys is None:
+        return context
+    return dict((key, context[key]) for key in keys if key in context)
+
+
+def join_digest(context_hash, body_hash):
+    "Provide the digest of a route, given hashes of its context and body."
+    if context_hash is None:
+        return None
+    return '{0}:{1}'.format(context_hash, body_hash or '')
+
+
+class CachingConnector(BaseConnector):
+    """Read-through cache of route entries around another shelf connector.
+
+    Entries are kept in an LRU cache bounded by SHELF_CACHE_MAX_ENTRIES and
+    SHELF_CACHE_MAX_BYTES. Each read first asks the shelf for the site's
+    generation, one small query, and reuses a cached entry only if it was read
+    in that same generation. Writes from any process move the site to a new
+    generation, so entries are never served stale, and unchanged entries are
+    never loaded and deserialized again.
+
+    Cached contexts are shared between requests; do not modify them.
+
+    Enable with SHELF_CACHE in the app's config, see Tango.shelf.
+    """
+
+    def __init__(self, app, connector):
+        BaseConnector.__init__(self, app)
+        self.connector = connector
+        self.cache = LRUCache(
+            max_entries=app.config['SHELF_CACHE_MAX_ENTRIES'],
+            max_bytes=app.config['SHELF_CACHE_MAX_BYTES'])
+
+    def get(self, site, rule, keys=None):
+        entry = self.fetch(site, rule, keys=keys)
+        if entry is None:
+            return {}
+        return entry.context
+
+    def fetch(self, site, rule, generation=None, keys=None):
+        # Read the generation first, then pin the read of the entry to it,
+        # such that a cached entry always matches its recorded generation.
+        if generation is None:
+            generation = self.connector.generation(site)
+        # Entries of some keys only are cached apart from whole entries.
+        key = (site, rule)
+        if keys is not None:
+            key = (site, rule, tuple(sorted(keys)))
+        entry = self.cache.get(key)
+        if entry is not None and entry.generation == generation:
+            return entry
+        # Keep an entry which is unchanged in a later generation, as told by
+        # its content hash, rather than loading it again.
+        if entry is not None and entry.digest is not None and \
+                self.connector.digest(site, rule, generation) == entry.digest:
+            entry.generation = generation
+            return entry
+        entry = self.connector.fetch(site, rule, generation, keys)
+        if entry is None:
+            self.cache.pop(key)
+            return None
+        entry.generation = generation
+        self.cache.set(key, entry, entry.size or 0)
+        return entry
+
+    def get_many(self, keys):
+        return dict((key, self.get(*key)) for key in keys)
+
+    def generation(self, site):
+        return self.connector.generation(site)
+
+    def history(self, site):
+        return self.connector.history(site)
+
+    def rollback(self, site, generation=None):
+        # Entries are keyed by generation, which is never reused.
+        return self.connector.rollback(site, generation)
+
+    def digest(self, site, rule, generation=None):
+        return self.connector.digest(site, rule, generation)
+
+    def stamp(self, site, rule, generation=None):
+        return self.connector.stamp(site, rule, generation)
+
+    def source(self, site, rule):
+        return self.connector.source(site, rule)
+
+    def put(self, site, rule, context, source_files=None, body=None):
+        self.cache.pop((site, rule))
+        self.connector.put(site, rule, context, source_files, body)
+
+    def put_many(self, items, batch_size=None):
+        def uncached_items():
+            for item in items:
+                self.cache.pop((item[0], item[1]))
+                yield item
+        self.connector.put_many(uncached_items(), batch_size)
+
+    def drop(self, site, rule=None):
+        # Rely on the site's generation, rather than matching rules here.
+        self.connector.drop(site, rule)
+
+    def list(self, site=None, rule=None):
+        return self.connector.list(site, rule)
+
+    def close(self):
+        self.cache.clear()
+        self.connector.close()
+
+
+class SnapshotConnector(BaseConnector):
+    """Read-only shelf connector, serving from a snapshot file via mmap.
+
+    Export a snapshot of the SQLite shelf with `tango snapshot`, which
+    publishes it at SHELF_SNAPSHOT_FILEPATH by atomic rename. Lookups go
+    through the snapshot's hash index, and read the stored bytes straight
+    from the mapped file, with no SQL engine in the way. All processes that
+    map the same snapshot share its pages in the page cache.
+
+    At most every SHELF_SNAPSHOT_CHECK_INTERVAL seconds, the connector checks
+    whether a new snapshot was published and maps it for later lookups.
+    Readers never wait on a writer, as a snapshot file is never modified.
+    """
+
+    def __init__(self, app):
+        BaseConnector.__init__(self, app)
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.stat = None
+        self.checked = None
+
+    def open(self):
+        "Provide the current Snapshot, or None if none is published."
+        interval = self.app.config['SHELF_SNAPSHOT_CHECK_INTERVAL']
+        now = time.time()
+        if self.checked is not None and now - self.checked < interval:
+            return self.snapshot
+        with self.lock:
+            self.checked = now
+            filepath = self.app.config['SHELF_SNAPSHOT_FILEPATH']
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                self.snapshot = self.stat = None
+                return None
+            stat = filepath, stat.st_ino, stat.st_mtime, stat.st_size
+            if stat != self.stat:
+                # Do not close the previous snapshot, which other threads may
+                # be reading; it is unmapped once no longer referenced.
+                self.snapshot = Snapshot(filepath)
+                self.stat = stat
+            return self.snapshot
+
+    def get(self, site, rule, keys=None):
+        entry = self.fetch(site, rule, keys=keys)
+        if entry is None:
+            return {}
+        return entry.context
+
+    def fetch(self, site, rule, generation=None, keys=None):
+        # A snapshot holds one generation, that of the snapshot.
+        snapshot = self.open()
+        if snapshot is None:
+            return None
+        record = snapshot.find(site, rule)
+        if record is None:
+            return None
+        codec, data, body = record
+        size = len(data) + len(body or '')
+        if body is not None:
+            # The body is the response, which writers send as a str.
+            body = str(body)
+        return Entry(site, rule, project(decode(codec, data), keys),
+                     body=body, size=size, generation=snapshot.generation)
+
+    def get_many(self, keys):
+        return dict((key, self.get(*key)) for key in keys)
+
+    def generation(self, site):
+        snapshot = self.open()
+        if snapshot is None:
+            return 0
+        return snapshot.generation
+
+    def list(self, site=None, rule=None):
+        snapshot = self.open()
+        if snapshot is None:
+            return []
+        return [(s, r) for s, r in snapshot.keys()
+                if site in (None, s) and rule in (None, r)]
+
+    def put(self, site, rule, context, source_files=None, body=None):
+        raise ShelfError('A shelf snapshot is read-only.')
+
+    def put_many(self, items, batch_size=None):
+        raise ShelfError('A shelf snapshot is read-only.')
+
+    def drop(self, site, rule=None):
+        raise ShelfError('A shelf snapshot is read-only.')
+
+    def rollback(self, site, generation=None):
+        raise ShelfError('A shelf snapshot is read-only.')
+
+    def close(self):
+        with self.lock:
+            self.snapshot = self.stat = self.checked = None
+
+
+# Snapshot file layout: a header, then records, then a hash table of slots.
+# Header: magic, format version, slot count, record count, generation, and
+# the offset of the slot table.
+SNAPSHOT_MAGIC = 'TANGOSNP'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<8sIIIIQ')
+# Each record is the key (site, NUL, rule), codec tag, data, then body.
+# A slot is the key's hash, the record's offset, then the lengths of each
+# part of the record, with body length stored plus one (0 if no body).
+# An empty slot has offset 0.
+SNAPSHOT_SLOT = struct.Struct('<IQIHII')
+
+
+def snapshot_key(site, rule):
+    "Provide the key of a route in a snapshot, and its hash."
+    key = u'{0}\0{1}'.format(site, rule).encode('utf-8')
+    return key, zlib.crc32(key) & 0xffffffff
+
+
+class Snapshot(object):
+    """A read-only snapshot of the shelf, mapped into memory.
+
+    Example, using write_snapshot to create one:
+    >>> import os, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> filepath = os.path.join(directory, 'shelf.snapshot')
+    >>> write_snapshot(filepath, [('site', '/', 'json', '{}', None),
+    ...                           ('site', '/a', 'json', '[1]', 'body')])
+    2
+    >>> snapshot = Snapshot(filepath)
+    >>> codec, data, body = snapshot.find('site', '/a')
+    >>> codec, str(data), str(body)
+    ('json', '[1]', 'body')
+    >>> snapshot.find('site', '/b') is None
+    True
+    >>> snapshot.keys()
+    [(u'site', u'/'), (u'site', u'/a')]
+    >>> snapshot.close()
+    >>> os.unlink(filepath); os.rmdir(directory)
+    >>>
+    """
+
+    def __init__(self, filepath):
+        with open(filepath, 'rb') as fd:
+            try:
+                self.map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+                header = SNAPSHOT_HEADER.unpack_from(self.map, 0)
+            except (ValueError, struct.error):
+                # The file is empty or too short to hold a header.
+                header = (None, None, None, None, None, None)
+        magic, version, self.slot_count, self.count, self.generation, \
+            self.slots_offset = header
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ShelfError('Not a shelf snapshot: {0}'.format(filepath))
+
+    def slot(self, index):
+        offset = self.slots_offset + index * SNAPSHOT_SLOT.size
+        return SNAPSHOT_SLOT.unpack_from(self.map, offset)
+
+    def find(self, site, rule):
+        """Provide (codec, data, body) as stored for a route, or None.
+
+        Data and body are buffers of the mapped file, copied from it only as
+        they are read, e.g. by decode.
+        """
+        if not self.slot_count:
+            return None
+        key, key_hash = snapshot_key(site, rule)
+        mask = self.slot_count - 1
+        index = key_hash & mask
+        while True:
+            slot_hash, offset, key_len, codec_len, data_len, body_len = \
+                self.slot(index)
+            if offset == 0:
+                return None
+            # Compare the key in place, rather than copy it out of the map.
+            if slot_hash == key_hash and key_len == len(key) and \
+                    self.map.find(key, offset, offset + key_len) == offset:
+                break
+            index = (index + 1) & mask
+        offset += key_len
+        # The codec tag is a few bytes, which decode parses as a str.
+        codec = self.map[offset:offset + codec_len]
+        offset += codec_len
+        data = buffer(self.map, offset, data_len)
+        offset += data_len
+        body = None
+        if body_len:
+            body = buffer(self.map, offset, body_len - 1)
+        return codec, data, body
+
+    def keys(self):
+        "Provide the (site, rule) of each record, in the order written."
+        records = []
+        for index in range(self.slot_count):
+            slot = self.slot(index)
+            offset, key_len = slot[1], slot[2]
+            if offset:
+                key = self.map[offset:offset + key_len].decode('utf-8')
+                records.append((offset, tuple(key.split(u'\0', 1))))
+        return [record_key for _, record_key in sorted(records)]
+
+    def close(self):
+        self.map.close()
+
+
+def write_snapshot(filepath, records):
+    """Write records to a new snapshot file, published by atomic rename.
+
+    Records are (site, rule, codec, data, body) tuples, as given by
+    SqliteConnector.records. Records are streamed to a temporary file in the
+    same directory, which replaces filepath only once complete and synced.
+    The snapshot's generation is a checksum of its records, such that an
+    unchanged export keeps its generation. Returns the count of records.
+    """
+    directory = os.path.dirname(os.path.abspath(filepath))
+    fd, temp_filepath = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as snapshot_file:
+            snapshot_file.write('\0' * SNAPSHOT_HEADER.size)
+            offset = SNAPSHOT_HEADER.size
+            checksum = 0
+            slots = []
+            for site, rule, codec, data, body in records:
+                key, key_hash = snapshot_key(site, rule)
+                codec = str(codec)
+                body_len = 0
+                parts = [key, codec, data]
+                if body is not None:
+                    body_len = len(body) + 1
+                    parts.append(body)
+                record = ''.join(parts)
+                snapshot_file.write(record)
+                checksum = zlib.crc32(record, checksum)
+                slots.append((key_hash, offset, len(key), len(codec),
+                              len(data), body_len))
+                offset += len(record)
+
+            # Size the table as a power of two, at most half full.
+            slot_count = 1
+            while slot_count < 2 * len(slots):
+                slot_count *= 2
+            table = [None] * slot_count
+            for slot in slots:
+                index = slot[0] & (slot_count - 1)
+                while table[index] is not None:
+                    index = (index + 1) & (slot_count - 1)
+                table[index] = slot
+            empty = (0, 0, 0, 0, 0, 0)
+            for slot in table:
+                snapshot_file.write(SNAPSHOT_SLOT.pack(*(slot or empty)))
+
+            snapshot_file.seek(0)
+            snapshot_file.write(SNAPSHOT_HEADER.pack(
+                SNAPSHOT_MAGIC, SNAPSHOT_VERSION, slot_count, len(slots),
+                checksum & 0xffffffff, offset))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.chmod(temp_filepath, 0644)
+        os.rename(temp_filepath, filepath)
+    except:
+        os.unlink(temp_filepath)
+        raise
+    return len(slots)
+
+
+def split_sql(script):
+    """Split a SQL script into its statements.
+
+    Example:
+    >>> for statement in split_sql('''
+    ... CREATE TABLE spam (eggs TEXT DEFAULT ';');
+    ... DROP TABLE spam;
+    ... '''):
+    ...     print statement
+    ...
+    CREATE TABLE spam (eggs TEXT DEFAULT ';');
+    DROP TABLE spam;
+    >>>
+    """
+    statements = []
+    statement = ''
+    for line in script.splitlines(True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement.strip())
+            statement = ''
+    return statements
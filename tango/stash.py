@@ -1,6 +1,12 @@
 "Marshal template contexts exported declaratively by Tango stash modules."
 
+import hashlib
+import marshal
 import os
+import re
+import tempfile
+from functools import partial
+from stat import S_ISDIR
 
 import warnings
 
@@ -8,12 +14,22 @@ import yaml
 
 from tango.errors import DuplicateContextWarning, DuplicateExportWarning
 from tango.errors import DuplicateRouteWarning, HeaderException
-from tango.errors import ModuleNotFound
+from tango.errors import ModuleNotFound, StashModuleWarning
 from tango.imports import discover_modified_modules, discover_modules, get_module
 from tango.imports import get_module_filepath, get_module_docstring
 from tango.imports import fix_import_name_if_pyfile
+from tango.parallel import run_in_children
+from tango import instrument
 
 
+# Interval of a refresh field in a header, as a number and optional unit.
+INTERVAL_PATTERN = re.compile(r'^\s*(\d+(?:\.\d*)?|\.\d+)\s*([smhd]?)\s*$')
+INTERVAL_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+# Size of a memory field in a header, as a number and optional unit.
+SIZE_PATTERN = re.compile(r'^\s*(\d+(?:\.\d*)?|\.\d+)\s*([kKmMgG]?)\s*$')
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
 class Route(object):
     "Route metadata for a Tango stashable context module."
 
@@ -39,8 +55,19 @@ class Route(object):
     # modules from which this stash module was constructed
     modules = None
 
+    # optional seconds between refreshes of context, as `tango schedule` does
+    refresh = None
+
+    # optional limits on pulling context, in seconds and bytes, in a child
+    timeout = None
+    memory = None
+
+    # optional seconds for which clients may cache responses, as max-age
+    max_age = None
+
     def __init__(self, site, rule, exports, static=None, writer_name=None,
-                 context=None, modules=None, source_files=None):
+                 context=None, modules=None, source_files=None, refresh=None,
+                 timeout=None, memory=None, max_age=None):
         self.site = site
         self.rule = rule
         self.exports = exports
@@ -50,6 +77,10 @@ class Route(object):
         self.context = context
         self.modules = modules
         self.source_files = source_files
+        self.refresh = refresh
+        self.timeout = timeout
+        self.memory = memory
+        self.max_age = max_age
 
     def __repr__(self):
         pattern = u'<Route: {0}{1}>'
@@ -59,7 +90,9 @@ class Route(object):
             return pattern.format(self.rule, ', {0}'.format(self.writer_name))
 
 
-def build_module_routes(module_or_name, modified_only=False, import_stash=False, logfile=None):
+def build_module_routes(module_or_name, modified_only=False,
+                        import_stash=False, logfile=None, jobs=1, timeout=None,
+                        memory=None):
     """Discover modules & parse headers from a Tango stash import name.
 
     Returns list of Route objects with attributes via structured docstrings.
@@ -75,12 +108,103 @@ def build_module_routes(module_or_name, modified_only=False, import_stash=False,
      <Route: /route2.txt>]
     >>>
 
+    With import_stash and jobs greater than 1, modules are imported and their
+    contexts pulled in up to that many child processes at once, as they are
+    with a timeout or memory limit; see pull_module_routes. A module which
+    fails there leaves out every rule it declares, even those shared with
+    modules which loaded, such that each is left as shelved rather than
+    shelved in part. Routes are merged the same either way:
+    >>> routes = build_module_routes('testsite.stash', import_stash=True,
+    ...                              jobs=4)
+    >>> [route.context for route in routes if route.rule == '/']
+    [{'title': 'Tango'}]
+    >>>
+
     :param import_name: Tango site stash import name
     :type import_name: str
     :param context: flag whether to pull template contexts into route objects
     """
+    module_routes = parse_module_routes(module_or_name, modified_only)
+    failed = set()
+    if import_stash:
+        module_rules = [set(route.rule for route in routes)
+                        for name, routes in module_routes]
+        pulled = dict(pull_module_routes(module_routes, jobs, logfile,
+                                         timeout, memory))
+        # Back in module order, leaving out modules which failed to load.
+        module_routes = [pulled[index] for index in sorted(pulled)
+                         if pulled[index] is not None]
+        for index in pulled:
+            if pulled[index] is None:
+                failed.update(module_rules[index])
+    else:
+        module_routes = [routes for name, routes in module_routes]
+
     route_collection = []
+    for routes in module_routes:
+        route_collection += [route for route in routes
+                             if route.rule not in failed]
+    return merge_routes(route_collection)
+
+
+def stream_module_routes(module_or_name, modified_only=False, logfile=None,
+                         jobs=1, timeout=None, memory=None):
+    """Pull contexts of stash modules, yielding routes as each is complete.
+
+    As build_module_routes with import_stash, but a module's routes are
+    yielded as soon as its context is pulled, such that the caller can write
+    them and release them while the next module loads. A route declared in
+    more than one module is held until each of those modules is pulled, then
+    merged as in merge_routes, or left out if any of them failed. Routes
+    come in order of completion.
 
+    >>> routes = stream_module_routes('testsite.stash')
+    >>> sorted(routes, key=lambda route: route.rule)
+    ... # doctest: +ELLIPSIS, +NORMALIZE_WHITESPACE
+    [<Route: /, template:index.html>,
+     <Route: /argument/<argument>/, template:argument.html>,
+     <Route: /blank/export.txt>,
+     <Route: /index.json, json>,
+     <Route: /plain/exports.txt, text>,
+     <Route: /route1.txt>,
+     <Route: /route2.txt>]
+    >>>
+    """
+    module_routes = parse_module_routes(module_or_name, modified_only)
+    # Count modules declaring each rule, to know when its route is complete.
+    module_rules = []
+    declared = {}
+    for name, routes in module_routes:
+        rules = set(route.rule for route in routes)
+        module_rules.append(rules)
+        for rule in rules:
+            declared[rule] = declared.get(rule, 0) + 1
+
+    held = {}
+    failed = set()
+    for index, routes in pull_module_routes(module_routes, jobs, logfile,
+                                            timeout, memory):
+        if routes is None:
+            # Leave every rule of a failed module as shelved.
+            failed.update(module_rules[index])
+        for route in routes or []:
+            held.setdefault(route.rule, []).append((index, route))
+        for rule in module_rules[index]:
+            declared[rule] -= 1
+            if declared[rule] == 0:
+                # Merge in module order, whichever module loaded last.
+                pairs = sorted(held.pop(rule, []), key=lambda pair: pair[0])
+                if rule in failed:
+                    continue
+                for route in merge_routes([route for _, route in pairs]):
+                    yield route
+
+
+def parse_module_routes(module_or_name, modified_only=False):
+    """Discover stash modules and parse their headers.
+
+    Returns (name, routes) pairs in module order, for modules with routes.
+    """
     if modified_only:
         try:
             last_modified_time = os.path.getmtime(os.environ['SHELVE_TIME_PATH'])
@@ -91,27 +215,134 @@ def build_module_routes(module_or_name, modified_only=False, import_stash=False,
     else:
         modules = discover_modules(module_or_name)
 
-
-
+    module_routes = []
     for name in modules:
-        module_routes = parse_header(name)
-        if not module_routes:
-            continue
-        if import_stash:
+        with instrument.measure('header', module=name):
+            routes = parse_header(name)
+        if routes:
+            module_routes.append((name, routes))
+    header_cache.save()
+    return module_routes
+
+
+def pull_module_routes(module_routes, jobs=1, logfile=None, timeout=None,
+                       memory=None):
+    """Pull contexts of (name, routes) module pairs, as in pull_context.
+
+    Yields (index, routes) for each module as it is pulled, by its index in
+    module_routes. The given routes are not kept once yielded.
+
+    With jobs greater than 1, each module is imported in a child process of
+    its own, up to jobs at a time, and its routes are pickled back with their
+    contexts, in order of completion. A module which raises or crashes its
+    process is reported with a StashModuleWarning and yields None for routes,
+    so that the rest of the site is still shelved. Otherwise, modules are
+    pulled one by one in this process, and errors are raised.
+
+    Timeout and memory limit pulling each module, in seconds and bytes, as
+    do the timeout and memory fields of a module's header, which take
+    precedence. Modules are pulled in child processes if any is limited, as
+    with jobs, and a module which runs out of either fails as above:
+    >>> module_routes = parse_module_routes('testsite.stash')
+    >>> [index for index, routes in pull_module_routes(module_routes,
+    ...                                                timeout=60)
+    ...  if routes is None]
+    []
+    >>>
+    """
+    limits = [module_limits(routes, timeout, memory)
+              for name, routes in module_routes]
+    if jobs > 1 or limits != [(None, None)] * len(limits):
+        names = [name for name, routes in module_routes]
+        results = run_in_children(partial(instrument.run_recorded,
+                                          pull_context),
+                                  [routes for name, routes in module_routes],
+                                  jobs=jobs, limits=limits)
+        del module_routes[:]
+        for index, result, error in results:
+            name = names[index]
+            if error is None:
+                routes, records = result
+                if records is not None:
+                    instrument.recorder.update(records)
+                if logfile is not None:
+                    logfile.write('Loading {0} ... done.\n'.format(name))
+                    logfile.flush()
+                yield index, routes
+                continue
             if logfile is not None:
-                logfile.write('Loading {0} ... '.format(name))
-                # Flush log file to keep user posted on what is processing;
-                # otherwise no guarantee that anything is displayed in the
-                # log file until an implicit flush.
+                logfile.write('Loading {0} ... failed.\n{1}\n'
+                              .format(name, error))
                 logfile.flush()
-            module_routes = pull_context(module_routes)
-            if logfile is not None:
-                logfile.write('done.\n')
-        route_collection += module_routes
-
+            msg = '{0} failed to load, leaving its routes as shelved: {1}'
+            msg = msg.format(name, error.strip().splitlines()[-1])
+            warnings.warn(msg, StashModuleWarning)
+            yield index, None
+        return
+
+    for index in range(len(module_routes)):
+        name, routes = module_routes[index]
+        # Drop the reference here, to release the context once written.
+        module_routes[index] = None
+        if logfile is not None:
+            logfile.write('Loading {0} ... '.format(name))
+            # Flush log file to keep user posted on what is processing;
+            # otherwise no guarantee that anything is displayed in the
+            # log file until an implicit flush.
+            logfile.flush()
+        pull_context(routes)
+        if logfile is not None:
+            logfile.write('done.\n')
+        yield index, routes
+
+
+def module_limits(routes, timeout=None, memory=None):
+    """Provide (timeout, memory) to pull a module's routes, by its header.
+
+    Limits not given in the header default to the given timeout and memory.
+    """
+    if routes:
+        if routes[0].timeout is not None:
+            timeout = routes[0].timeout
+        if routes[0].memory is not None:
+            memory = routes[0].memory
+    return timeout, memory
+
+
+def merge_routes(route_collection):
+    """Merge routes from all stash modules into one list, sorted by rule.
+
+    Currently, routes can be defined in multiple stash modules. A route
+    declared again in a later module is merged into the earlier one: the
+    merged route gets a new context, the earlier context updated with the
+    later one, warning on any replaced exports, and its modules and source
+    files are combined. The earlier route keeps its own context, which other
+    routes of its module share, and which may be shelved already when
+    streaming. A merged route is refreshed as often as the most often of its
+    modules, and cached by clients for as long as the shortest max_age of its
+    modules.
+
+    Example:
+    >>> first = Route('site', '/', {}, modules=['first'], source_files=['a'],
+    ...               context={'title': 'First'})
+    >>> second = Route('site', '/', {}, modules=['second'], source_files=['b'],
+    ...                context={'count': 2})
+    >>> routes = merge_routes([first, second])
+    >>> routes
+    [<Route: />]
+    >>> sorted(routes[0].context.items())
+    [('count', 2), ('title', 'First')]
+    >>> first.context
+    {'title': 'First'}
+    >>> routes[0].modules, routes[0].source_files
+    (['second', 'first'], ['b', 'a'])
+    >>> merge_routes([Route('site', '/', {}, modules=[], source_files=[],
+    ...                     refresh=300), first])[0].refresh
+    300
+    >>>
+    """
     route_table = {}
     for route in route_collection:
-        # Currently, routes can be defined in multiple stash modules.
         # Check to see if the route is already loaded and check for collisions.
         if route.rule in route_table:
             route_context = route_table[route.rule].context or {}
@@ -125,10 +356,18 @@ def build_module_routes(module_or_name, modified_only=False, import_stash=False,
                 msg = '{0} duplicate context, exports: {1}'
                 msg = msg.format(route, ', '.join(intersection))
                 warnings.warn(msg, DuplicateContextWarning)
-            route_context.update(new_route_context)
-            route.context = route_context
+            # Merge into a new dict, as the earlier module's other routes
+            # share its context, and may already be shelved when streaming.
+            route.context = dict(route_context)
+            route.context.update(new_route_context)
             route.modules += route_table[route.rule].modules
             route.source_files += route_table[route.rule].source_files
+            for field in ('refresh', 'max_age'):
+                values = [value for value in
+                          (getattr(route, field),
+                           getattr(route_table[route.rule], field))
+                          if value is not None]
+                setattr(route, field, min(values) if values else None)
 
         route_table[route.rule] = route
     return sorted(route_table.values(), key=lambda route: route.rule)
@@ -173,14 +412,17 @@ def pull_context(route_objs):
     static = route_objs[0].static
 
     assert len(route_objs[0].modules) == 1, "I'm confused by multiple modules."
-    module = get_module(route_objs[0].modules[0])
+    module_name = route_objs[0].modules[0]
+    with instrument.measure('import', module=module_name):
+        module = get_module(module_name)
 
     context = {}
-    for name in exports:
-        if name in static:
-            context[name] = exports[name]
-        else:
-            context[name] = getattr(module, name)
+    with instrument.measure('pull', module=module_name):
+        for name in exports:
+            if name in static:
+                context[name] = exports[name]
+            else:
+                context[name] = getattr(module, name)
     for route_obj in route_objs:
         route_obj.context = context
 
@@ -219,9 +461,17 @@ def parse_header(import_name):
     * routes
     * exports
 
+    A module may also give how often its routes are to be refreshed, as an
+    interval in a refresh field, see parse_interval. Likewise, it may limit
+    pulling its context with an interval in a timeout field, and a size in a
+    memory field, see parse_size and pull_module_routes. An interval in a
+    max_age field gives how long clients may cache the module's responses,
+    as the max-age of their Cache-Control header.
+
     Return None if module has no docstring or does not appear to be metadata.
     Raise KeyError if any of these fields are missing.
-    Raise HeaderException if header is yaml but not pure yaml.
+    Raise HeaderException if header is yaml but not pure yaml, or if refresh,
+    timeout, memory or max_age is not an interval or size.
 
     Examples:
     >>> routes = parse_header('testsite.stash.index')
@@ -235,6 +485,7 @@ def parse_header(import_name):
     >>> route.site
     'test'
     >>> route.context
+    >>> route.refresh
     >>>
 
     >>> routes = parse_header('testsite.stash.package.module')
@@ -297,18 +548,8 @@ def parse_header(import_name):
     if filepath is None:
         raise ModuleNotFound("'{0}' cannot be found".format(import_name))
 
-    doc = get_module_docstring(filepath)
-    if doc is None:
-        return None
-
-    try:
-        header = yaml.load(doc)
-    except (yaml.scanner.ScannerError, yaml.parser.ParserError):
-        raise HeaderException('metadata docstring must be yaml or doc, '
-                              'but not both.')
-
-    if not isinstance(header, dict):
-        # module has a docstring, but it's not yaml.
+    header = header_cache.get(filepath)
+    if header is None:
         return None
 
     # Relevant values to pull from header, of various types.
@@ -317,6 +558,15 @@ def parse_header(import_name):
     exports = {}
     rawexports = header['exports']
     static = []
+    limits = {}
+    for field, parse in (('refresh', parse_interval),
+                         ('timeout', parse_interval), ('memory', parse_size),
+                         ('max_age', parse_interval)):
+        try:
+            limits[field] = parse(header.get(field))
+        except ValueError, error:
+            raise HeaderException('{0} {1}: {2}'.format(import_name, field,
+                                                         error))
 
     # Ensure an iterable on raw values.
     if rawroutes is None:
@@ -387,9 +637,283 @@ def parse_header(import_name):
             msg = '{0} duplicate route: {1}'
             msg = msg.format(import_name, route)
             warnings.warn(msg, DuplicateRouteWarning)
-        route_obj = Route(site, route, exports, static, template)
+        route_obj = Route(site, route, exports, static, template, **limits)
         route_obj.modules = [import_name]
         route_obj.source_files = [filepath]
         route_table[route] = route_obj
 
     return sorted(route_table.values(), key=lambda route: route.rule)
+
+
+def parse_interval(value):
+    """Parse an interval in seconds, e.g. from the refresh field of a header.
+
+    An interval is a number of seconds, or a number with a unit of s, m, h
+    or d, for seconds, minutes, hours or days. None gives None.
+
+    Example:
+    >>> parse_interval('5m'), parse_interval('1.5h'), parse_interval(30)
+    (300.0, 5400.0, 30.0)
+    >>> parse_interval('soon')
+    Traceback (most recent call last):
+      ...
+    ValueError: not an interval, e.g. 30s, 5m, 2h or 1d: soon
+    >>>
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        seconds = float(value)
+    else:
+        match = INTERVAL_PATTERN.match(unicode(value))
+        if match is None:
+            raise ValueError('not an interval, e.g. 30s, 5m, 2h or 1d: '
+                             '{0}'.format(value))
+        number, unit = match.groups()
+        seconds = float(number) * INTERVAL_UNITS[unit or 's']
+    if seconds <= 0:
+        raise ValueError('interval must be positive: {0}'.format(value))
+    return seconds
+
+
+def parse_size(value):
+    """Parse a size in bytes, e.g. from the memory field of a header.
+
+    A size is a number of bytes, or a number with a unit of K, M or G, for
+    kibibytes, mebibytes or gibibytes. None gives None.
+
+    Example:
+    >>> parse_size('512M'), parse_size('1.5G'), parse_size(4096)
+    (536870912, 1610612736, 4096)
+    >>> parse_size('lots')
+    Traceback (most recent call last):
+      ...
+    ValueError: not a size, e.g. 512M or 2G: lots
+    >>>
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        size = int(value)
+    else:
+        match = SIZE_PATTERN.match(unicode(value))
+        if match is None:
+            raise ValueError('not a size, e.g. 512M or 2G: {0}'.format(value))
+        number, unit = match.groups()
+        size = int(float(number) * SIZE_UNITS[unit.upper()])
+    if size <= 0:
+        raise ValueError('size must be positive: {0}'.format(value))
+    return size
+
+
+def read_header(filepath):
+    """Read the header of module at filepath, as parsed from yaml.
+
+    Return None if module has no docstring or it does not parse to a dict.
+    Raise HeaderException if header is yaml but not pure yaml.
+
+    Example:
+    >>> header = read_header(get_module_filepath('simplest'))
+    >>> header['site'], header['routes']
+    ('simplest', ['/'])
+    >>> read_header(get_module_filepath('testsite.stash.dummy')) is None
+    True
+    >>>
+    """
+    doc = get_module_docstring(filepath)
+    if doc is None:
+        return None
+
+    try:
+        header = yaml.load(doc)
+    except (yaml.scanner.ScannerError, yaml.parser.ParserError):
+        raise HeaderException('metadata docstring must be yaml or doc, '
+                              'but not both.')
+
+    if not isinstance(header, dict):
+        # module has a docstring, but it's not yaml.
+        return None
+    return header
+
+
+class HeaderCache(object):
+    """Headers of stash modules by filepath, as read by read_header.
+
+    Each module's header is kept along with the mtime and size of its file,
+    and a hash of its contents. A file with the same mtime and size is not
+    read again. A file which is touched but otherwise unchanged is read and
+    hashed, but its header is not parsed again.
+
+    With a filepath, the cache is loaded from that file on first use, and
+    written back to it by save, for use in later processes, e.g. each build
+    of an app. Without, headers are kept for the life of this process only.
+    The file is marshaled plain data, in a directory private to this user,
+    see private_dir; a file elsewhere or of another user is not loaded.
+    Headers which are not plain data are read again in each process.
+
+    Example:
+    >>> cache = HeaderCache()
+    >>> cache.get(get_module_filepath('simplest'))['site']
+    'simplest'
+    >>> len(cache.entries)
+    1
+    >>>
+    """
+
+    # Version of the cache file format, to discard files of other versions.
+    version = 2
+
+    def __init__(self, filepath=None):
+        self.filepath = filepath
+        self.entries = None
+        self.dirty = False
+
+    def use_filepath(self, filepath):
+        "Load from and save to filepath from now on, e.g. as in app config."
+        if filepath != self.filepath:
+            self.filepath = filepath
+            self.entries = None
+            self.dirty = False
+
+    def load(self):
+        "Load entries from the cache file, if any, discarding a bad file."
+        self.entries = {}
+        if not self.filepath:
+            return
+        try:
+            version, entries = load_private(self.filepath)
+        except Exception:
+            return
+        if version == self.version and isinstance(entries, dict):
+            self.entries = entries
+
+    def get(self, filepath):
+        "Get header of module at filepath, reading it only if it changed."
+        if self.entries is None:
+            self.load()
+        stat = os.stat(filepath)
+        key = stat.st_mtime, stat.st_size
+        entry = self.entries.get(filepath)
+        if entry is None or entry[0] != key:
+            with open(filepath, 'rb') as fd:
+                digest = hashlib.sha1(fd.read()).hexdigest()
+            if entry is None or entry[1] != digest:
+                header = read_header(filepath)
+                try:
+                    entry = key, digest, marshal.dumps(header)
+                except ValueError:
+                    # Not plain data, e.g. a YAML timestamp; do not keep it.
+                    if self.entries.pop(filepath, None) is not None:
+                        self.dirty = True
+                    return header
+            else:
+                entry = key, digest, entry[2]
+            self.entries[filepath] = entry
+            self.dirty = True
+        # Give each caller a header of its own, as a header holds values.
+        return marshal.loads(entry[2])
+
+    def save(self):
+        "Write entries to the cache file, if changed, by atomic rename."
+        if not self.dirty or not self.filepath:
+            return
+        try:
+            save_private(self.filepath, (self.version, self.entries),
+                         prefix='.tango-headers')
+            self.dirty = False
+        except (IOError, OSError):
+            # The cache is only an optimization; carry on without it.
+            pass
+
+
+def private_dir(dirpath):
+    """Make dirpath with mode 0700 if missing, and tell whether it is private.
+
+    It is if it is a directory, not a symlink, owned by this user and with no
+    permissions for anyone else, such that no other user can place files in
+    it:
+    >>> import shutil, tempfile
+    >>> temp_dir = tempfile.mkdtemp()
+    >>> private_dir(os.path.join(temp_dir, 'private'))
+    True
+    >>> os.chmod(temp_dir, 0755)
+    >>> private_dir(temp_dir)
+    False
+    >>> shutil.rmtree(temp_dir)
+    >>>
+    """
+    try:
+        os.makedirs(dirpath, 0700)
+    except OSError:
+        pass
+    try:
+        stat = os.lstat(dirpath)
+    except OSError:
+        return False
+    return S_ISDIR(stat.st_mode) and stat.st_uid == os.getuid() and \
+        not stat.st_mode & 077
+
+
+def load_private(filepath):
+    """Load marshaled data from a file of this user in a private directory.
+
+    Raise IOError if the file or its directory is not private, see
+    private_dir, as anyone could have written it then.
+    """
+    if not private_dir(os.path.dirname(filepath) or os.curdir):
+        raise IOError('not a private directory: {0}'.format(filepath))
+    with open(filepath, 'rb') as fd:
+        stat = os.fstat(fd.fileno())
+        if stat.st_uid != os.getuid() or stat.st_mode & 077:
+            raise IOError('not a private file: {0}'.format(filepath))
+        return marshal.load(fd)
+
+
+def save_private(filepath, data, prefix='.tango'):
+    """Marshal plain data to filepath in a private directory, atomically.
+
+    The directory is made private if missing, see private_dir. Raise IOError
+    if it is not private, and ValueError if data is not plain data.
+
+    >>> import shutil, tempfile
+    >>> temp_dir = tempfile.mkdtemp()
+    >>> filepath = os.path.join(temp_dir, 'private', 'data')
+    >>> save_private(filepath, {'spam': ['eggs']})
+    >>> load_private(filepath)
+    {'spam': ['eggs']}
+    >>> shutil.rmtree(temp_dir)
+    >>>
+    """
+    dirname = os.path.dirname(filepath) or os.curdir
+    if not private_dir(dirname):
+        raise IOError('not a private directory: {0}'.format(filepath))
+    fd, temp_filepath = tempfile.mkstemp(dir=dirname, prefix=prefix)
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            marshal.dump(data, temp_file)
+        os.rename(temp_filepath, filepath)
+    except:
+        try:
+            os.remove(temp_filepath)
+        except OSError:
+            pass
+        raise
+
+
+# Name of the header cache file within HEADER_CACHE_DIR in config.
+HEADER_CACHE_FILENAME = 'headers'
+
+# Header cache shared by stash modules in each build of an app, kept in memory
+# only until an app's config gives its directory, see use_header_cache_dir.
+header_cache = HeaderCache()
+
+
+def use_header_cache_dir(dirpath):
+    """Keep the header cache in dirpath, e.g. HEADER_CACHE_DIR in config.
+
+    An empty or None dirpath keeps headers in memory only.
+    """
+    filepath = None
+    if dirpath:
+        filepath = os.path.join(dirpath, HEADER_CACHE_FILENAME)
+    header_cache.use_filepath(filepath)
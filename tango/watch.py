@@ -0,0 +1,196 @@
+"""Watch mode for shelving, which shelves a site again as its files change.
+
+`tango shelve --watch` shelves a site incrementally, see
+Tango.shelve_incremental, then keeps running in the same interpreter, polling
+the site's files every SHELVE_WATCH_INTERVAL seconds. Once files change, and
+then stay unchanged for SHELVE_WATCH_DEBOUNCE seconds, the site is shelved
+again, pulling only the stash modules whose inputs changed. A changed config
+pulls every module. Templates are only read when serving, even with
+SHELVE_RESPONSE_BODIES set, as only JSON and text bodies are stored, so a
+changed template leaves the shelf as is.
+
+Before each run, the site's modules are removed from sys.modules, such that
+stash modules and the local modules they import are imported anew. Reloading
+them in place would keep names since removed from their files.
+
+Files are polled, as inotify is Linux only and would add a dependency. Each
+poll stats the files of the site's package and the inputs of its stash.
+
+Example:
+>>> import tempfile
+>>> filepath = tempfile.mkstemp()[1]
+>>> watcher = Watcher(lambda: [filepath])
+>>> def edit(seconds):
+...     with open(filepath, 'a') as fd:
+...         fd.write('edit')
+...
+>>> watcher.wait(0, 0, sleep=edit) == [filepath]
+True
+>>>
+"""
+
+import os
+import sys
+import time
+import traceback
+
+from tango.app import Tango
+from tango.imports import fix_import_name_if_pyfile, get_module_filepath
+from tango.imports import module_exists, module_index, module_is_package
+from tango.imports import namespace_segments
+from tango.incremental import load_state
+from tango.manifest import file_stat
+
+
+class Watcher(object):
+    "Poll files for changes of mtime or size, including files added or gone."
+
+    def __init__(self, filepaths):
+        # Callable which gives the filepaths to poll, called on each poll such
+        # that files added since are seen.
+        self.filepaths = filepaths
+        self.stats = self.poll()
+
+    def poll(self):
+        "Provide a dict of (mtime, size) by filepath, None if a file is gone."
+        return dict((filepath, file_stat(filepath))
+                    for filepath in self.filepaths())
+
+    def wait(self, interval, debounce, sleep=time.sleep, clock=time.time):
+        """Wait for files to change, then to stay unchanged for a while.
+
+        Polls every interval seconds until any file differs from the last
+        wait, then until no file changes for debounce seconds. Returns the
+        sorted list of filepaths changed.
+        """
+        stats = self.poll()
+        while stats == self.stats:
+            sleep(interval)
+            stats = self.poll()
+        quiet_since = clock()
+        while clock() - quiet_since < debounce:
+            sleep(min(interval, debounce))
+            latest = self.poll()
+            if latest != stats:
+                stats = latest
+                quiet_since = clock()
+        changed = sorted(filepath for filepath in set(stats) | set(self.stats)
+                         if stats.get(filepath) != self.stats.get(filepath))
+        self.stats = stats
+        return changed
+
+    def track(self):
+        """Start polling files now given by filepaths, as they are now.
+
+        Files polled before keep their stats as of the last wait, such that
+        changes made since, e.g. during a shelve run, are still seen.
+        """
+        stats = self.poll()
+        for filepath in stats:
+            if filepath in self.stats:
+                stats[filepath] = self.stats[filepath]
+        self.stats = stats
+
+
+def shelve_forever(name, logfile=None, jobs=1, runs=None, sleep=time.sleep):
+    """Shelve site of given import name, then again as its files change.
+
+    Runs until interrupted, or until the given number of runs if any, and
+    returns the app of the last run. A run which fails is logged, and the
+    site shelved again on the next change, which may fix it.
+    """
+    import_name = fix_import_name_if_pyfile(name)
+    app = shelve_site(import_name, logfile=logfile, jobs=jobs)
+    watcher = Watcher(lambda: site_files(app))
+    run = 1
+    while runs is None or run < runs:
+        changed = watcher.wait(app.config['SHELVE_WATCH_INTERVAL'],
+                               app.config['SHELVE_WATCH_DEBOUNCE'],
+                               sleep=sleep)
+        if logfile is not None:
+            logfile.write('Changed: {0}.\n'.format(', '.join(changed)))
+        force = full_reason(app, changed)
+        unload_site(app)
+        try:
+            app = shelve_site(import_name, logfile=logfile, jobs=jobs,
+                              force=force)
+        except Exception:
+            # The site cannot be built; keep watching the files of the last.
+            if logfile is not None:
+                logfile.write(traceback.format_exc())
+        watcher.track()
+        run += 1
+    return app
+
+
+def shelve_site(import_name, logfile=None, jobs=1, force=None):
+    """Build the app of import name anew, and shelve it incrementally.
+
+    Returns the app. An error building the app is raised, but an error
+    shelving it is logged, leaving the shelf and state as they were.
+    """
+    module_index.invalidate()
+    app = Tango.build_app(import_name)
+    try:
+        app.shelve_incremental(logfile=logfile, jobs=jobs, force=force)
+    except Exception:
+        if logfile is not None:
+            logfile.write(traceback.format_exc())
+    return app
+
+
+def site_files(app):
+    """Provide the filepaths to watch for an app, as a set.
+
+    These are the files of the app's package, including its templates and
+    config, and the inputs of its stash modules as of their last run.
+    """
+    filepaths = set()
+    if module_is_package(app.import_name):
+        for dirpath, dirnames, filenames in os.walk(app.root_path):
+            dirnames[:] = [dirname for dirname in dirnames
+                           if not dirname.startswith('.')]
+            for filename in filenames:
+                if filename.startswith('.') or \
+                        filename.endswith(('.pyc', '.pyo')):
+                    continue
+                filepaths.add(os.path.join(dirpath, filename))
+    for name, record in load_state(app.shelve_state_filepath())[1].items():
+        filepaths.update(record['inputs'])
+        entry = module_index.find(name)
+        if entry is not None:
+            filepaths.add(entry[0])
+    for name in config_names(app):
+        filepaths.add(get_module_filepath(name))
+    return filepaths
+
+
+def config_names(app):
+    "Provide the import names of the config modules an app may load."
+    names = set([app.import_name + '.config',
+                 namespace_segments(app.import_name)[0] + '.config'])
+    return [name for name in sorted(names) if module_exists(name)]
+
+
+def full_reason(app, changed):
+    "Provide the reason to pull every module given changed files, or None."
+    config_filepaths = [get_module_filepath(name)
+                        for name in config_names(app)]
+    for filepath in changed:
+        if filepath in config_filepaths:
+            return 'config changed'
+    return None
+
+
+def unload_site(app):
+    "Remove the modules of an app's site from sys.modules, to import anew."
+    filepaths = site_files(app)
+    for name, module in sys.modules.items():
+        filepath = getattr(module, '__file__', None)
+        if filepath is None:
+            continue
+        filepath = os.path.abspath(filepath)
+        if filepath.endswith(('.pyc', '.pyo')):
+            filepath = filepath[:-1]
+        if filepath in filepaths:
+            del sys.modules[name]
@@ -23,6 +23,7 @@ import json
 import mimetypes
 
 from flask import render_template
+from jinja2 import meta
 
 
 class BaseWriter(object):
@@ -36,6 +37,17 @@ class BaseWriter(object):
     Set mimetype attribute as appropriate or to None to use app's default,
     i.e. app.response_class.default_mimetype.
 
+    A writer whose output depends only on the context, and not on the request,
+    may also implement an encode method, which returns the response body as
+    bytes. Tango calls encode once at shelve time when SHELVE_RESPONSE_BODIES
+    is set, and the writer then responds with that body as given:
+
+        writer(request, template_context, body=encoded_body)
+
+    A writer which reads only some keys of the context may implement a
+    context_keys method, which returns those keys. Tango then loads only
+    those keys from the shelf, when SHELF_LAYOUT is 'exports'.
+
     A subclass must implement a write method:
     >>> class IncompleteWriter(BaseWriter):
     ...     "Does not implement the write method."
@@ -54,8 +66,11 @@ class BaseWriter(object):
     def __init__(self, app):
         self.app = app
 
-    def __call__(self, request, context):
-        response = self.write(request, context)
+    def __call__(self, request, context, body=None):
+        if body is None:
+            response = self.write(request, context)
+        else:
+            response = self.app.response_class(body)
         if self.mimetype is not None:
             # Set default_mimetype to allow write method to set mimetype attr.
             response.default_mimetype = self.mimetype
@@ -66,6 +81,14 @@ class BaseWriter(object):
     def write(self, request, context):
         raise NotImplementedError("Where is this writer's write method?")
 
+    def encode(self, context):
+        "Return response body for context as bytes, or None if not supported."
+        return None
+
+    def context_keys(self):
+        "Return the keys of the context this writer reads, or None for all."
+        return None
+
 
 class TextWriter(BaseWriter):
     """Write a template context as a simple string representation.
@@ -80,6 +103,8 @@ class TextWriter(BaseWriter):
     {'answer': 42, 'count': ['one', 'two'],
      'lambda': <function <lambda> at 0x...>,
      'adict': {'second': 2, 'first': 1}, 'title': 'Test Title'}
+    >>> text.encode(test_context) == response.data
+    True
     >>>
     """
 
@@ -88,6 +113,9 @@ class TextWriter(BaseWriter):
     def write(self, request, context):
         return self.app.response_class(unicode(context))
 
+    def encode(self, context):
+        return unicode(context).encode(self.app.response_class.charset)
+
 
 class JsonWriter(BaseWriter):
     """Write a template context in JSON format.
@@ -122,42 +150,65 @@ class JsonWriter(BaseWriter):
     >>> app.config['DEFAULT_DATE_FORMAT'] = '%d %b %Y'
     >>> print json(None, context).data
     {"answer": 42, "adate": "13 Sep 2012", "adatetime": "09/13/2012 14:40"}
+    >>> json.encode(context)
+    '{"answer": 42, "adate": "13 Sep 2012", "adatetime": "09/13/2012 14:40"}'
     >>>
     """
 
     mimetype = 'application/json'
 
     def write(self, request, context):
-        # Trim context down to those values which are JSON serializable.
-        trimmed_context = {}
+        return self.app.response_class(self.encode(context))
+
+    def encode(self, context):
+        # Format datetime & date objects into strings.
+        formatted_context = {}
         for key, value in context.items():
             try:
-                # Format datetime & date objects into strings.
+                formatted_context[key] = self.format(value)
+            except TypeError:
                 # If strf format is invalid, will raise a TypeError.
-                if isinstance(value, datetime.datetime):
-                    format = self.app.config['DEFAULT_DATETIME_FORMAT']
-                    if format is not None:
-                        value = value.strftime(format)
-                    else:
-                        value = str(value)
-                if isinstance(value, datetime.date):
-                    format = self.app.config['DEFAULT_DATE_FORMAT']
-                    if format is not None:
-                        value = value.strftime(format)
-                    else:
-                        value = str(value)
+                self.warn(key, value)
+
+        # Serialize in one pass, and only test values one at a time on error.
+        try:
+            return json.dumps(formatted_context)
+        except TypeError:
+            pass
 
+        # Trim context down to those values which are JSON serializable.
+        trimmed_context = {}
+        for key, value in formatted_context.items():
+            try:
                 # Trigger a TypeError if this value is not JSON serializable.
                 json.dumps({key: value})
-
                 trimmed_context[key] = value
             except TypeError:
-                # This value is not json serializable.
-                self.app.logger.warn(
-                    "Unable to JSON serialize "
-                    "'%(key)s' with value: %(value)r" % locals()
-                )
-        return self.app.response_class(json.dumps(trimmed_context))
+                self.warn(key, value)
+        return json.dumps(trimmed_context)
+
+    def format(self, value):
+        "Format a datetime or date value as a string, as in app.config."
+        if isinstance(value, datetime.datetime):
+            format = self.app.config['DEFAULT_DATETIME_FORMAT']
+            if format is not None:
+                value = value.strftime(format)
+            else:
+                value = str(value)
+        if isinstance(value, datetime.date):
+            format = self.app.config['DEFAULT_DATE_FORMAT']
+            if format is not None:
+                value = value.strftime(format)
+            else:
+                value = str(value)
+        return value
+
+    def warn(self, key, value):
+        # This value is not json serializable.
+        self.app.logger.warn(
+            "Unable to JSON serialize "
+            "'%(key)s' with value: %(value)r" % locals()
+        )
 
 
 class TemplateWriter(BaseWriter):
@@ -194,6 +245,11 @@ class TemplateWriter(BaseWriter):
     'application/xml'
     >>> ctx.pop()
     >>>
+
+    The template's variables are found through templates it extends:
+    >>> sorted(template_writer.context_keys())
+    ['title']
+    >>>
     """
 
     mimetype = 'text/html'
@@ -201,6 +257,7 @@ class TemplateWriter(BaseWriter):
     def __init__(self, app, template_name):
         super(TemplateWriter, self).__init__(app)
         self.template_name = template_name
+        self.keys = None
         basename = self.template_name.rsplit('/', 1)[-1]
         guessed_type, guessed_encoding = mimetypes.guess_type(basename)
         if guessed_type:
@@ -210,6 +267,43 @@ class TemplateWriter(BaseWriter):
         rendered = render_template(self.template_name, **context)
         return self.app.response_class(rendered)
 
+    def context_keys(self):
+        """Return the variables referenced by this writer's template.
+
+        Follows templates which are extended, included or imported. Returns
+        None if any of them is named dynamically, as the variables are then
+        unknown until rendering.
+        """
+        if self.keys is None:
+            self.keys = template_variables(self.app.jinja_env,
+                                           self.template_name)
+        return self.keys or None
+
+
+def template_variables(environment, template_name):
+    """Find variables referenced by a template and the templates it uses.
+
+    Returns a list of variable names, or False if a template is named
+    dynamically. Names include globals such as url_for, which are harmless
+    to look for in a context.
+    """
+    variables = set()
+    seen = set()
+    pending = [template_name]
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        source = environment.loader.get_source(environment, name)[0]
+        ast = environment.parse(source)
+        variables.update(meta.find_undeclared_variables(ast))
+        for referenced in meta.find_referenced_templates(ast):
+            if referenced is None:
+                return False
+            pending.append(referenced)
+    return sorted(variables)
+
 
 test_context = {'answer': 42, 'count': ['one', 'two'], 'title': 'Test Title',
                 'lambda': lambda x: None, 'adict': {'first': 1, 'second': 2}}
@@ -0,0 +1,62 @@
+"""Compare shelf codecs on the shapes of context in sampletypes.py.
+
+Run from the root of this project, with `make bench` or:
+
+    python tests/bench_codecs.py
+
+For each shape of context and each codec, with and without zlib compression,
+this reports the tag actually stored (a codec falls back to pickle when the
+context is not plain data for it), the stored size, and the time to encode and
+to decode once. Decoding is the cost paid on every request to a stash route.
+"""
+
+import timeit
+
+from tango.codec import codecs, decode, encode
+from tango.stash import parse_header, pull_context
+
+
+def sampletypes_context():
+    return pull_context(parse_header('sampletypes'))[0].context
+
+
+def shapes():
+    "Provide (name, context) pairs, built from sampletypes.py values."
+    context = sampletypes_context()
+    # A feed: a long list of plain dicts, common in JSON-backed stash modules.
+    item = dict((key, context[key]) for key in
+                ('a_bool', 'a_float', 'an_int', 'a_str', 'a_unicode'))
+    item['a_simple_list'] = context['a_simple_list']
+    item['a_simple_dict'] = context['a_simple_dict']
+    feed = {'description': context['description'],
+            'items': [dict(item, an_int=i) for i in range(2000)]}
+    # Deep data with tuples and non-string keys, which JSON cannot represent.
+    nested = {'nested': [context['a_nested_dict']] * 500,
+              'tuples': [context['a_simple_tuple']] * 500}
+    return [('sampletypes', context), ('feed', feed), ('nested', nested)]
+
+
+def bench(context, name, threshold, number):
+    tag, data = encode(context, name, threshold=threshold)
+    encode_time = timeit.Timer(
+        lambda: encode(context, name, threshold=threshold)).timeit(number)
+    decode_time = timeit.Timer(lambda: decode(tag, data)).timeit(number)
+    return tag, len(data), encode_time / number, decode_time / number
+
+
+def main(number=20):
+    row = '{0:<12} {1:<8} {2:<14} {3:>10} {4:>12} {5:>12}'
+    print row.format('shape', 'codec', 'stored as', 'bytes',
+                     'encode (ms)', 'decode (ms)')
+    for shape, context in shapes():
+        for name in sorted(codecs):
+            for threshold in (None, 0):
+                tag, size, encode_time, decode_time = \
+                    bench(context, name, threshold, number)
+                print row.format(shape, name, tag, size,
+                                 '%.3f' % (encode_time * 1000),
+                                 '%.3f' % (decode_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,12 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from tango.imports import module_index
+
+
 class ConnectorCommonTests(object):
     "Mixin for common tests in shelf connector implementations."
 
@@ -75,8 +84,120 @@ class ConnectorCommonTests(object):
 
         self.assertEqual(self.connector.list(), site_results + other_results)
 
+    def test_get_keys(self):
+        item = {'spam': 'eggs', 'foo': ['bar'] * 100}
+        self.connector.put('site', 'rule', item)
+        self.assertEqual(self.connector.get('site', 'rule', ['spam']),
+                         {'spam': 'eggs'})
+        self.assertEqual(self.connector.get('site', 'rule', ['spam', 'nope']),
+                         {'spam': 'eggs'})
+        self.assertEqual(self.connector.get('site', 'rule', []), {})
+        self.assertEqual(self.connector.get('site', 'rule'), item)
+        self.assertEqual(self.connector.get('site', 'missing', ['spam']), {})
+
     def test_items_source(self):
         self.assertEqual(self.connector.source('site', 'one'), [])
 
         self.connector.put('site', 'one', {}, ['source.py'])
         self.assertEqual(self.connector.source('site', 'one'), ['source.py'])
+
+    def test_put_many_get_many(self):
+        items = [('site', 'one', {'spam': 'eggs'}),
+                 ('site', 'two', {'foo': 'bar'}, ['source.py']),
+                 ('other', 'one', {1: 'one'})]
+        self.connector.put_many(items)
+        self.assertEqual(self.connector.get('site', 'one'), {'spam': 'eggs'})
+        self.assertEqual(self.connector.source('site', 'two'), ['source.py'])
+
+        keys = [('site', 'one'), ('site', 'two'), ('other', 'one'),
+                ('other', 'missing')]
+        self.assertEqual(self.connector.get_many(keys),
+                         {('site', 'one'): {'spam': 'eggs'},
+                          ('site', 'two'): {'foo': 'bar'},
+                          ('other', 'one'): {1: 'one'},
+                          ('other', 'missing'): {}})
+        self.assertEqual(self.connector.get_many([]), {})
+
+    def test_generation(self):
+        generation = self.connector.generation('site')
+        self.connector.put('site', 'one', {'spam': 'eggs'})
+        self.assertNotEqual(self.connector.generation('site'), generation)
+
+        generation = self.connector.generation('site')
+        other = self.connector.generation('other')
+        self.connector.put_many([('site', 'one', {}), ('site', 'two', {})])
+        self.assertNotEqual(self.connector.generation('site'), generation)
+        self.assertEqual(self.connector.generation('other'), other)
+
+        generation = self.connector.generation('site')
+        self.connector.drop('site')
+        self.assertNotEqual(self.connector.generation('site'), generation)
+
+    def test_rollback(self):
+        self.connector.put('site', 'one', {'spam': 'eggs'})
+        generation = self.connector.generation('site')
+        self.connector.put_many([('site', 'one', {'spam': 'spam'}),
+                                 ('site', 'two', {'foo': 'bar'})])
+        self.assertEqual(self.connector.get('site', 'one'), {'spam': 'spam'})
+
+        self.assertEqual(self.connector.rollback('site'), generation)
+        self.assertEqual(self.connector.generation('site'), generation)
+        self.assertEqual(self.connector.get('site', 'one'), {'spam': 'eggs'})
+        self.assertEqual(self.connector.get('site', 'two'), {})
+        self.assertEqual(self.connector.list('site'), [('site', 'one')])
+
+        # Later writes go to a new generation, never reusing a number.
+        self.connector.put('site', 'two', {'foo': 'baz'})
+        self.assertTrue(self.connector.generation('site') > generation + 1)
+        self.assertEqual(self.connector.get('site', 'one'), {'spam': 'eggs'})
+        self.assertEqual(self.connector.get('site', 'two'), {'foo': 'baz'})
+
+
+class TempSiteTests(object):
+    """Mixin for tests on a site package written to a temporary directory.
+
+    Set `site` to the package name, and extend site_config for its config.
+    """
+
+    site = None
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.writes = 0
+        os.makedirs(os.path.join(self.temp_dir, self.site, 'stash'))
+        self.write(self.site + '/__init__.py', '')
+        self.write_config()
+        self.write(self.site + '/stash/__init__.py', '')
+        sys.path.insert(0, self.temp_dir)
+
+    def tearDown(self):
+        sys.path.remove(self.temp_dir)
+        self.forget_modules()
+        shutil.rmtree(self.temp_dir)
+
+    def site_config(self):
+        return {'SHELF_SQLITE_FILEPATH': os.path.join(self.temp_dir,
+                                                      'shelf.db')}
+
+    def write(self, filepath, content):
+        filepath = os.path.join(self.temp_dir, filepath)
+        with open(filepath, 'w') as fd:
+            fd.write(content)
+        # Move mtime along, in case this runs within the filesystem's tick.
+        self.writes += 1
+        mtime = time.time() + self.writes
+        os.utime(filepath, (mtime, mtime))
+        module_index.invalidate(self.temp_dir)
+
+    def write_config(self, **settings):
+        config = self.site_config()
+        config.update(settings)
+        self.write(self.site + '/config.py',
+                   ''.join('{0} = {1!r}\n'.format(name, config[name])
+                           for name in sorted(config)))
+
+    def forget_modules(self):
+        # As a new process would, import the site's modules anew.
+        for name in list(sys.modules):
+            if name == self.site or name.startswith(self.site + '.'):
+                del sys.modules[name]
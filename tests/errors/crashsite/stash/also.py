@@ -0,0 +1,7 @@
+"""
+site: crashsite
+routes:
+ - json: /shared.json
+exports:
+ - title: Also
+"""
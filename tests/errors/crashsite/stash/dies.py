@@ -0,0 +1,12 @@
+"""
+site: crashsite
+routes:
+ - json: /dies.json
+exports:
+ - title
+"""
+
+import os
+
+# Crash the process outright, as a segfault in an extension module would.
+os._exit(1)
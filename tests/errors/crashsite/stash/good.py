@@ -0,0 +1,9 @@
+"""
+site: crashsite
+routes:
+ - json: /good.json
+exports:
+ - title
+"""
+
+title = 'Good'
@@ -0,0 +1,9 @@
+"""
+site: crashsite
+routes:
+ - json: /raises.json
+exports:
+ - title
+"""
+
+raise RuntimeError('upstream is down')
@@ -0,0 +1,9 @@
+"""
+site: crashsite
+routes:
+ - json: /shared.json
+exports:
+ - count
+"""
+
+count = 2
@@ -0,0 +1,110 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from tango.app import Tango
+from tango.errors import ExportError
+from tango.export import CONTENT_TYPE_MAP, EXPORT_MANIFEST, export_site
+
+
+class ExportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.outdir = os.path.join(self.temp_dir, 'www')
+        self.app = Tango.build_app('testsite', import_stash=True)
+        self.app.config['SHELF_SQLITE_FILEPATH'] = \
+            os.path.join(self.temp_dir, 'shelf.db')
+        self.app.shelve()
+
+    def tearDown(self):
+        self.app.shelf.close()
+        shutil.rmtree(self.temp_dir)
+
+    def export(self, jobs=1):
+        logfile = StringIO()
+        manifest = export_site(self.app, self.outdir, jobs=jobs,
+                               logfile=logfile)
+        return manifest, logfile.getvalue().splitlines()
+
+    def read(self, filepath):
+        with open(os.path.join(self.outdir, filepath)) as fd:
+            return fd.read()
+
+    def inode(self, filepath):
+        return os.stat(os.path.join(self.outdir, filepath)).st_ino
+
+    def test_routes_are_rendered_to_files(self):
+        manifest, log = self.export()
+        self.assertTrue(os.path.islink(self.outdir))
+        self.assertEqual(log[0], 'Skipped /argument/<argument>/: '
+                                 'has view args.')
+        self.assertTrue(log[-1].startswith('Exported 6 routes and 1 static '
+                                           'files to '))
+        self.assertTrue(log[-1].endswith(': 7 written, 0 unchanged.'))
+        client = self.app.test_client()
+        for rule, filepath in (('/', 'index.html'),
+                               ('/index.json', 'index.json'),
+                               ('/plain/exports.txt', 'plain/exports.txt')):
+            self.assertEqual(self.read(filepath), client.get(rule).data)
+        self.assertEqual(manifest['index.json'][1], 'application/json')
+        self.assertEqual(manifest['index.html'][1], 'text/html')
+        self.assertEqual(manifest['static/images/willowtree-avatar.png'][1],
+                         'image/png')
+        with open(os.path.join(self.app.static_folder, 'images',
+                               'willowtree-avatar.png'), 'rb') as fd:
+            self.assertEqual(self.read('static/images/willowtree-avatar.png'),
+                             fd.read())
+        stored = json.loads(self.read(EXPORT_MANIFEST))
+        self.assertEqual(stored['files'], json.loads(json.dumps(manifest)))
+        self.assertTrue('"/index.json" "application/json";\n' in
+                        self.read(CONTENT_TYPE_MAP))
+
+    def test_unchanged_files_are_kept(self):
+        self.export()
+        first_tree = os.path.realpath(self.outdir)
+        inode = self.inode('index.json')
+        self.app.shelf.put('test', '/route1.txt', {'changed': True})
+        manifest, log = self.export()
+        self.assertNotEqual(os.path.realpath(self.outdir), first_tree)
+        self.assertFalse(os.path.exists(first_tree))
+        self.assertTrue(log[-1].endswith(': 1 written, 6 unchanged.'))
+        self.assertEqual(self.inode('index.json'), inode)
+        self.assertEqual(self.read('route1.txt'), "{'changed': True}")
+
+    def test_routes_are_rendered_in_children(self):
+        expected, log = self.export()
+        shutil.rmtree(os.path.realpath(self.outdir))
+        os.remove(self.outdir)
+        manifest, log = self.export(jobs=2)
+        self.assertEqual(manifest, expected)
+        self.assertTrue(log[-1].endswith(': 7 written, 0 unchanged.'))
+
+    def test_failed_route_leaves_last_export(self):
+        self.export()
+        tree = os.path.realpath(self.outdir)
+        def fail(request, context):
+            raise RuntimeError('writer failed')
+        self.app.get_writer('json').write = fail
+        self.app.shelf.put('test', '/index.json', {'changed': True})
+        try:
+            self.export()
+        except ExportError, error:
+            self.assertTrue('/index.json: responded 500' in str(error))
+        else:
+            self.fail('ExportError not raised')
+        self.assertEqual(os.path.realpath(self.outdir), tree)
+        self.assertEqual(sorted(os.listdir(self.temp_dir)),
+                         [os.path.basename(tree), 'shelf.db', 'www'])
+
+    def test_outdir_must_be_an_export(self):
+        os.makedirs(self.outdir)
+        self.assertRaises(ExportError, self.export)
+        self.assertFalse(os.path.islink(self.outdir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+
+from flask.ext.testing import TestCase
+
+from tango.app import Tango
+
+
+class ExportsLayoutTestCase(TestCase):
+
+    def create_app(self):
+        _, self.temp_filepath = tempfile.mkstemp(suffix='.db')
+        app = Tango.build_app('testsite', import_stash=True)
+        app.config['SHELF_SQLITE_FILEPATH'] = self.temp_filepath
+        app.config['SHELF_LAYOUT'] = 'exports'
+        return app
+
+    def setUp(self):
+        self.app.shelve()
+        self.client = self.app.test_client()
+        self.fetches = []
+        fetch = self.app.shelf.fetch
+        def recording_fetch(site, rule, generation=None, keys=None):
+            self.fetches.append((rule, keys))
+            return fetch(site, rule, generation, keys)
+        self.app.shelf.fetch = recording_fetch
+
+    def tearDown(self):
+        os.unlink(self.temp_filepath)
+
+    def test_template_loads_its_variables(self):
+        response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('<title>Tango</title>' in response.data)
+        rule, keys = self.fetches[0]
+        self.assertEqual(rule, '/')
+        self.assertTrue('title' in keys)
+
+    def test_json_loads_whole_context(self):
+        response = self.client.get('/index.json')
+        self.assertTrue('"project": "tango"' in response.data)
+        self.assertEqual(self.fetches, [('/index.json', None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import tango.config
+import tango.stash
+from tango.app import Tango
+from tango.errors import HeaderException
+from tango.stash import HeaderCache, use_header_cache_dir
+
+
+HEADER = '''"""
+site: cached
+routes:
+ - /{0}.txt
+exports:
+ - title: {0}
+"""
+
+title = {0!r}
+'''
+
+
+class HeaderCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_filepath = os.path.join(self.temp_dir, 'headers')
+        self.module_filepath = os.path.join(self.temp_dir, 'module.py')
+        self.write('First')
+        # Count headers actually read, rather than taken from the cache.
+        self.reads = []
+        self.read_header = tango.stash.read_header
+        def counting_read_header(filepath):
+            self.reads.append(filepath)
+            return self.read_header(filepath)
+        tango.stash.read_header = counting_read_header
+
+    def tearDown(self):
+        tango.stash.read_header = self.read_header
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, title, mtime=None):
+        with open(self.module_filepath, 'w') as fd:
+            fd.write(HEADER.format(title))
+        if mtime is not None:
+            os.utime(self.module_filepath, (mtime, mtime))
+
+    def test_unchanged_module_is_not_read_again(self):
+        cache = HeaderCache(self.cache_filepath)
+        header = cache.get(self.module_filepath)
+        self.assertEqual(header['routes'], ['/First.txt'])
+        cache.save()
+
+        # A new process loads the cache from its file.
+        cache = HeaderCache(self.cache_filepath)
+        self.assertEqual(cache.get(self.module_filepath), header)
+        self.assertEqual(len(self.reads), 1)
+
+    def test_touched_module_is_not_read_again(self):
+        cache = HeaderCache(self.cache_filepath)
+        cache.get(self.module_filepath)
+        self.write('First', mtime=time.time() + 10)
+        self.assertEqual(cache.get(self.module_filepath)['exports'],
+                         [{'title': 'First'}])
+        self.assertEqual(len(self.reads), 1)
+
+    def test_changed_module_is_read_again(self):
+        cache = HeaderCache(self.cache_filepath)
+        cache.get(self.module_filepath)
+        self.write('Second', mtime=time.time() + 10)
+        self.assertEqual(cache.get(self.module_filepath)['routes'],
+                         ['/Second.txt'])
+        self.assertEqual(len(self.reads), 2)
+
+    def test_headers_are_not_shared(self):
+        cache = HeaderCache()
+        cache.get(self.module_filepath)['exports'].append('changed')
+        self.assertEqual(cache.get(self.module_filepath)['exports'],
+                         [{'title': 'First'}])
+
+    def test_bad_header_is_not_cached(self):
+        with open(self.module_filepath, 'w') as fd:
+            fd.write('"""\nsite: cached\n\nNot yaml: at all: here\n"""\n')
+        cache = HeaderCache()
+        self.assertRaises(HeaderException, cache.get, self.module_filepath)
+        self.assertRaises(HeaderException, cache.get, self.module_filepath)
+        self.assertEqual(cache.entries, {})
+
+    def test_bad_cache_file_is_discarded(self):
+        with open(self.cache_filepath, 'w') as fd:
+            fd.write('not a cache')
+        cache = HeaderCache(self.cache_filepath)
+        self.assertEqual(cache.get(self.module_filepath)['site'], 'cached')
+        cache.save()
+        self.assertEqual(HeaderCache(self.cache_filepath).get(
+            self.module_filepath)['site'], 'cached')
+        self.assertEqual(len(self.reads), 1)
+
+    def test_cache_file_of_shared_dir_is_not_loaded(self):
+        cache = HeaderCache(self.cache_filepath)
+        cache.get(self.module_filepath)
+        cache.save()
+        os.chmod(self.temp_dir, 0777)
+        self.assertEqual(HeaderCache(self.cache_filepath).get(
+            self.module_filepath)['site'], 'cached')
+        self.assertEqual(len(self.reads), 2)
+
+    def test_cache_file_open_to_others_is_not_loaded(self):
+        cache = HeaderCache(self.cache_filepath)
+        cache.get(self.module_filepath)
+        cache.save()
+        os.chmod(self.cache_filepath, 0666)
+        HeaderCache(self.cache_filepath).get(self.module_filepath)
+        self.assertEqual(len(self.reads), 2)
+
+    def test_cache_dir_is_made_private(self):
+        dirpath = os.path.join(self.temp_dir, 'headers')
+        cache = HeaderCache(os.path.join(dirpath, 'headers'))
+        cache.get(self.module_filepath)
+        cache.save()
+        self.assertEqual(os.stat(dirpath).st_mode & 0777, 0700)
+        HeaderCache(cache.filepath).get(self.module_filepath)
+        self.assertEqual(len(self.reads), 1)
+
+    def test_cache_dir_is_set_in_config(self):
+        dirpath = os.path.join(self.temp_dir, 'headers')
+        default_dirpath = tango.config.HEADER_CACHE_DIR
+        tango.config.HEADER_CACHE_DIR = dirpath
+        try:
+            Tango.build_app('simplest', use_manifest=False)
+        finally:
+            tango.config.HEADER_CACHE_DIR = default_dirpath
+            use_header_cache_dir(default_dirpath)
+        self.assertTrue(os.path.isfile(os.path.join(dirpath, 'headers')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import os
+import time
+import unittest
+from StringIO import StringIO
+
+from tango.app import Tango
+
+from common_tests import TempSiteTests
+
+
+ONE = '''"""
+site: incsite
+routes:
+ - /one.txt
+exports:
+ - title
+"""
+
+from incsite.helpers import TITLE as title
+'''
+
+TWO = '''"""
+site: incsite
+routes:
+ - /two.txt
+exports:
+ - title: Two
+"""
+'''
+
+
+class IncrementalShelveTestCase(TempSiteTests, unittest.TestCase):
+
+    site = 'incsite'
+
+    def setUp(self):
+        TempSiteTests.setUp(self)
+        self.write('incsite/helpers.py', 'TITLE = "One"\n')
+        self.write('incsite/stash/one.py', ONE)
+        self.write('incsite/stash/two.py', TWO)
+
+    def site_config(self):
+        config = TempSiteTests.site_config(self)
+        config['SHELVE_STATE_DIR'] = os.path.join(self.temp_dir, 'state')
+        return config
+
+    def shelve(self, **options):
+        self.forget_modules()
+        logfile = StringIO()
+        app = Tango.shelve_by_name('incsite', logfile=logfile,
+                                   incremental=True, **options)
+        return app, logfile.getvalue().splitlines()
+
+    def test_unchanged_modules_are_skipped(self):
+        app, log = self.shelve()
+        self.assertTrue('Pulling incsite.stash.one: new module.' in log)
+        self.assertTrue('Pulling incsite.stash.two: new module.' in log)
+        self.assertEqual(app.shelf.get('incsite', '/one.txt'),
+                         {'title': 'One'})
+
+        app, log = self.shelve()
+        self.assertEqual([line for line in log if 'incsite.stash.' in line],
+                         ['Skipping incsite.stash.one: unchanged.',
+                          'Skipping incsite.stash.two: unchanged.'])
+        self.assertEqual(app.shelf.get('incsite', '/one.txt'),
+                         {'title': 'One'})
+
+    def test_changed_import_pulls_module(self):
+        self.shelve()
+        self.write('incsite/helpers.py', 'TITLE = "Changed"\n')
+        app, log = self.shelve(jobs=2)
+        helpers = os.path.join(self.temp_dir, 'incsite', 'helpers.py')
+        self.assertTrue('Pulling incsite.stash.one: {0} changed.'
+                        .format(helpers) in log)
+        self.assertTrue('Skipping incsite.stash.two: unchanged.' in log)
+        self.assertEqual(app.shelf.get('incsite', '/one.txt'),
+                         {'title': 'Changed'})
+        self.assertEqual(app.shelf.get('incsite', '/two.txt'),
+                         {'title': 'Two'})
+
+    def test_touched_module_is_skipped(self):
+        self.shelve()
+        filepath = os.path.join(self.temp_dir, 'incsite', 'stash', 'two.py')
+        os.utime(filepath, (time.time() + 10, time.time() + 10))
+        app, log = self.shelve()
+        self.assertTrue('Skipping incsite.stash.two: unchanged.' in log)
+
+    def test_failed_module_is_pulled_again(self):
+        self.shelve()
+        self.write('incsite/stash/two.py', TWO + 'raise RuntimeError\n')
+        self.assertRaises(RuntimeError, self.shelve)
+        # Without jobs, the run fails whole, and the module stays changed.
+        self.write('incsite/stash/two.py', TWO + 'import os\n')
+        app, log = self.shelve()
+        self.assertTrue('Skipping incsite.stash.one: unchanged.' in log)
+        self.assertTrue(any(line.startswith('Pulling incsite.stash.two: ')
+                            for line in log))
+
+    def test_deleted_shelf_pulls_every_module(self):
+        app, log = self.shelve()
+        app.shelf.close()
+        os.remove(os.path.join(self.temp_dir, 'shelf.db'))
+        app, log = self.shelve()
+        self.assertTrue('Pulling incsite.stash.one: '
+                        'shelf changed since last run.' in log)
+        self.assertTrue('Pulling incsite.stash.two: '
+                        'shelf changed since last run.' in log)
+        self.assertEqual(app.shelf.get('incsite', '/one.txt'),
+                         {'title': 'One'})
+
+    def test_state_others_can_write_is_not_loaded(self):
+        app, log = self.shelve()
+        os.chmod(app.shelve_state_filepath(), 0666)
+        app, log = self.shelve()
+        self.assertTrue('Pulling incsite.stash.one: new module.' in log)
+        # The state is written anew, privately.
+        app, log = self.shelve()
+        self.assertTrue('Skipping incsite.stash.one: unchanged.' in log)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import pkgutil
+import shutil
+import sys
+import tempfile
+import unittest
+
+import testsite.stash
+from tango.imports import ModuleIndex, discover_modules
+
+
+class ModuleIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.package_dir = os.path.join(self.temp_dir, 'indexsite')
+        os.makedirs(os.path.join(self.package_dir, 'broken'))
+        self.write('indexsite/__init__.py', '')
+        self.write('indexsite/one.py', '')
+        self.write('indexsite/broken/__init__.py', 'raise ImportError')
+        self.write('indexsite/broken/module.py', '')
+        sys.path.insert(0, self.temp_dir)
+        self.index = ModuleIndex()
+
+    def tearDown(self):
+        sys.path.remove(self.temp_dir)
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, filepath, content):
+        with open(os.path.join(self.temp_dir, filepath), 'w') as fd:
+            fd.write(content)
+
+    def test_find(self):
+        self.assertEqual(self.index.find('indexsite'),
+                         (os.path.join(self.package_dir, '__init__.py'), True))
+        self.assertEqual(self.index.find('indexsite.one'),
+                         (os.path.join(self.package_dir, 'one.py'), False))
+        self.assertEqual(self.index.find('indexsite.one.two'), None)
+        self.assertEqual(self.index.find('indexsite.two'), None)
+
+    def test_walk_imports_nothing(self):
+        self.assertEqual(list(self.index.walk('indexsite')),
+                         ['indexsite.broken', 'indexsite.broken.module',
+                          'indexsite.one'])
+        self.assertFalse('indexsite' in sys.modules)
+        self.assertFalse('indexsite.broken' in sys.modules)
+
+    def test_walk_matches_pkgutil(self):
+        walked = [name for _, name, _ in pkgutil.walk_packages(
+            testsite.stash.__path__, 'testsite.stash.')]
+        self.assertEqual(list(self.index.walk('testsite.stash')), walked)
+        self.assertEqual(list(discover_modules('testsite.stash'))[1:], walked)
+
+    def test_invalidate(self):
+        mtime = self.index.mtime('indexsite.one')
+        self.write('indexsite/two.py', '')
+        os.utime(os.path.join(self.package_dir, 'one.py'),
+                 (mtime + 10, mtime + 10))
+        # Listings and mtimes are kept until invalidated.
+        self.assertEqual(self.index.find('indexsite.two'), None)
+        self.assertEqual(self.index.mtime('indexsite.one'), mtime)
+        self.index.invalidate(os.path.join(self.package_dir, 'broken'))
+        self.assertEqual(self.index.find('indexsite.two'), None)
+        self.index.invalidate(self.package_dir)
+        self.assertEqual(self.index.find('indexsite.two'),
+                         (os.path.join(self.package_dir, 'two.py'), False))
+        self.assertAlmostEqual(self.index.mtime('indexsite.one'), mtime + 10,
+                               places=3)
+
+    def test_sys_path_change(self):
+        self.assertEqual(self.index.find('indexsite.one')[1], False)
+        sys.path.remove(self.temp_dir)
+        try:
+            self.assertEqual(self.index.find('indexsite.one'), None)
+        finally:
+            sys.path.insert(0, self.temp_dir)
+
+    def test_egg_after_module_is_passed_over(self):
+        egg = os.path.join(self.temp_dir, 'other.egg')
+        self.write('other.egg', '')
+        sys.path.insert(1, egg)
+        try:
+            self.assertEqual(self.index.find('indexsite')[1], True)
+        finally:
+            sys.path.remove(egg)
+
+    def test_egg_before_module_is_left_to_pkgutil(self):
+        egg = os.path.join(self.temp_dir, 'other.egg')
+        self.write('other.egg', '')
+        sys.path.insert(0, egg)
+        try:
+            self.assertEqual(self.index.find('indexsite'), None)
+        finally:
+            sys.path.remove(egg)
+
+
+if __name__ == '__main__':
+    unittest.main()
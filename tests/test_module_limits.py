@@ -0,0 +1,133 @@
+import time
+import unittest
+import warnings
+from StringIO import StringIO
+
+from tango.app import Tango
+from tango.errors import StashModuleWarning
+from tango.parallel import address_space
+
+from common_tests import TempSiteTests
+
+
+MODULE = '''"""
+site: limitsite
+routes:
+ - /{name}.txt
+exports:
+ - title
+{limits}
+"""
+
+{code}
+title = {title!r}
+'''
+
+# Declares the rule of the quick module as well, with an export of its own.
+SHARED = '''"""
+site: limitsite
+routes:
+ - /quick.txt
+exports:
+ - count
+timeout: 0.5s
+"""
+
+{code}
+count = 1
+'''
+
+
+class ModuleLimitsTestCase(TempSiteTests, unittest.TestCase):
+
+    site = 'limitsite'
+
+    def setUp(self):
+        TempSiteTests.setUp(self)
+        self.write_module('quick', title='Quick')
+        self.write_module('slow', title='Slow')
+
+    def write_module(self, name, limits='', code='', title='Changed'):
+        self.write('limitsite/stash/{0}.py'.format(name),
+                   MODULE.format(name=name, limits=limits, code=code,
+                                 title=title))
+
+    def shelve(self, **options):
+        self.forget_modules()
+        logfile = StringIO()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            app = Tango.shelve_by_name('limitsite', logfile=logfile,
+                                       **options)
+        failed = [str(warning.message) for warning in caught
+                  if issubclass(warning.category, StashModuleWarning)]
+        return app, logfile.getvalue(), failed
+
+    def test_module_past_its_timeout_is_left_as_shelved(self):
+        self.shelve()
+        self.write_module('quick')
+        self.write_module('slow', limits='timeout: 0.5s',
+                          code='import time\ntime.sleep(30)')
+        started = time.time()
+        app, log, failed = self.shelve()
+        self.assertTrue(time.time() - started < 10)
+        self.assertTrue('Child process timed out after 0.5s.' in log)
+        self.assertEqual(len(failed), 1)
+        self.assertTrue(failed[0].startswith('limitsite.stash.slow failed'))
+        self.assertEqual(app.shelf.get('limitsite', '/slow.txt'),
+                         {'title': 'Slow'})
+        self.assertEqual(app.shelf.get('limitsite', '/quick.txt'),
+                         {'title': 'Changed'})
+
+    def test_module_past_its_memory_is_left_as_shelved(self):
+        if address_space() is None:
+            self.skipTest('No /proc to read address space from.')
+        self.shelve()
+        # The limit counts growth past the shelve run, whatever its size.
+        self.write_module('quick', limits='memory: 64M',
+                          code="data = ' ' * (8 * 1024 ** 2)")
+        self.write_module('slow', limits='memory: 64M',
+                          code="data = ' ' * (128 * 1024 ** 2)")
+        app, log, failed = self.shelve()
+        self.assertTrue('MemoryError' in log)
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(app.shelf.get('limitsite', '/slow.txt'),
+                         {'title': 'Slow'})
+        self.assertEqual(app.shelf.get('limitsite', '/quick.txt'),
+                         {'title': 'Changed'})
+
+    def test_rule_shared_with_failed_module_is_left_as_shelved(self):
+        self.write('limitsite/stash/shared.py', SHARED.format(code=''))
+        app, log, failed = self.shelve()
+        self.assertEqual(app.shelf.get('limitsite', '/quick.txt'),
+                         {'title': 'Quick', 'count': 1})
+        self.write_module('quick')
+        self.write_module('slow')
+        self.write('limitsite/stash/shared.py',
+                   SHARED.format(code='import time\ntime.sleep(30)'))
+        for options in ({}, {'stream': True}):
+            app, log, failed = self.shelve(**options)
+            self.assertEqual(len(failed), 1)
+            self.assertEqual(app.shelf.get('limitsite', '/quick.txt'),
+                             {'title': 'Quick', 'count': 1})
+            self.assertEqual(app.shelf.get('limitsite', '/slow.txt'),
+                             {'title': 'Changed'})
+
+    def test_config_limits_every_module(self):
+        self.write_config(SHELVE_MODULE_TIMEOUT=0.5)
+        self.write_module('slow', code='import time\ntime.sleep(30)')
+        app, log, failed = self.shelve()
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(app.shelf.get('limitsite', '/quick.txt'),
+                         {'title': 'Quick'})
+        # The header's own limit takes precedence over config.
+        self.write_module('slow', limits='timeout: 30s',
+                          code='import time\ntime.sleep(1)')
+        app, log, failed = self.shelve()
+        self.assertEqual(failed, [])
+        self.assertEqual(app.shelf.get('limitsite', '/slow.txt'),
+                         {'title': 'Changed'})
+
+
+if __name__ == '__main__':
+    unittest.main()
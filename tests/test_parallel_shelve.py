@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+import warnings
+from StringIO import StringIO
+
+from tango.app import Tango
+from tango.errors import StashModuleWarning
+from tango.stash import build_module_routes
+
+
+class ParallelShelveTestCase(unittest.TestCase):
+
+    def build(self, name, **options):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            routes = build_module_routes(name, import_stash=True, **options)
+        return routes, caught
+
+    def test_same_routes_as_sequential(self):
+        sequential, _ = self.build('testsite.stash')
+        parallel, _ = self.build('testsite.stash', jobs=3)
+        self.assertEqual(
+            [(r.rule, r.context, r.modules, r.source_files)
+             for r in sequential],
+            [(r.rule, r.context, r.modules, r.source_files)
+             for r in parallel])
+        # Routes of one module still share one context.
+        route1, route2 = [r for r in parallel if r.rule.startswith('/route')]
+        self.assertTrue(route1.context is route2.context)
+
+    def test_failing_modules_are_skipped(self):
+        logfile = StringIO()
+        routes, caught = self.build('crashsite.stash', jobs=2, logfile=logfile)
+        self.assertEqual([route.rule for route in routes],
+                         ['/good.json', '/shared.json'])
+        # Duplicate routes across modules merge as in a sequential run.
+        self.assertEqual(routes[1].context, {'title': 'Also', 'count': 2})
+
+        messages = sorted(str(warning.message) for warning in caught
+                          if warning.category is StashModuleWarning)
+        self.assertEqual(len(messages), 2)
+        self.assertTrue(messages[0].startswith('crashsite.stash.dies failed'))
+        self.assertTrue(messages[0].endswith('exited with status 1.'))
+        self.assertTrue(messages[1].startswith('crashsite.stash.raises'))
+        self.assertTrue(messages[1].endswith('upstream is down'))
+        log = logfile.getvalue()
+        self.assertTrue('Loading crashsite.stash.good ... done.' in log)
+        self.assertTrue('Loading crashsite.stash.raises ... failed.' in log)
+
+    def test_shelve_keeps_routes_of_failed_modules(self):
+        _, temp_filepath = tempfile.mkstemp(suffix='.db')
+        try:
+            with warnings.catch_warnings(record=True):
+                warnings.simplefilter('always')
+                app = Tango.build_app('crashsite', import_stash=True, jobs=2)
+            app.config['SHELF_SQLITE_FILEPATH'] = temp_filepath
+            app.shelf.put('crashsite', '/raises.json', {'title': 'Last good'})
+            app.shelve()
+            self.assertEqual(app.shelf.get('crashsite', '/raises.json'),
+                             {'title': 'Last good'})
+            self.assertEqual(app.shelf.get('crashsite', '/good.json'),
+                             {'title': 'Good'})
+        finally:
+            os.unlink(temp_filepath)
+
+
+if __name__ == '__main__':
+    unittest.main()
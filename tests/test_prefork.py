@@ -0,0 +1,140 @@
+import os
+import shutil
+import signal
+import tempfile
+import time
+import unittest
+import urllib2
+
+from tango.app import Tango
+from tango.prefork import PreforkServer, resident_memory
+
+
+class PreforkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.logpath = os.path.join(self.temp_dir, 'serve.log')
+        self.app = Tango.build_app('testsite', import_stash=True)
+        self.app.config['SHELF_SQLITE_FILEPATH'] = \
+            os.path.join(self.temp_dir, 'shelf.db')
+        self.app.shelve()
+        self.pid = None
+
+    def tearDown(self):
+        if self.pid is not None:
+            self.stop()
+        self.app.shelf.close()
+        shutil.rmtree(self.temp_dir)
+
+    def serve(self, **options):
+        "Serve the app in a child process, as `tango serve` would."
+        logfile = open(self.logpath, 'w')
+        server = PreforkServer(self.app, port=0, logfile=logfile,
+                               check_interval=0.1, **options)
+        self.address = server.bind().server_address
+        self.pid = os.fork()
+        if self.pid == 0:
+            status = 0
+            try:
+                server.run()
+            except:
+                status = 1
+            finally:
+                os._exit(status)
+        server.server.server_close()
+        logfile.close()
+        self.wait_for_log('Serving ')
+
+    def stop(self):
+        os.kill(self.pid, signal.SIGTERM)
+        pid, status = os.waitpid(self.pid, 0)
+        self.pid = None
+        return status
+
+    def get(self, rule):
+        url = 'http://{0}:{1}{2}'.format(self.address[0], self.address[1],
+                                         rule)
+        return urllib2.urlopen(url, timeout=10).read()
+
+    def read_log(self):
+        with open(self.logpath) as fd:
+            return fd.read().splitlines()
+
+    def wait_for_log(self, start, count=1):
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            lines = [line for line in self.read_log()
+                     if line.startswith(start)]
+            if len(lines) >= count:
+                return lines
+            time.sleep(0.05)
+        self.fail('Not logged: {0!r}'.format(start))
+
+    def test_workers_serve_requests(self):
+        self.serve(workers=2)
+        self.assertEqual(self.read_log()[0], 'Warmed 6 routes.')
+        expected = self.app.test_client().get('/index.json').data
+        for _ in range(6):
+            self.assertEqual(self.get('/index.json'), expected)
+        self.assertEqual(self.stop(), 0)
+        self.assertEqual(self.read_log()[-1], 'Stopped.')
+
+    def test_workers_are_recycled(self):
+        self.serve(workers=1, max_requests=1)
+        for _ in range(3):
+            self.get('/route1.txt')
+        self.wait_for_log('Worker ', count=2)
+        self.assertEqual(self.get('/route1.txt'),
+                         self.app.test_client().get('/route1.txt').data)
+
+    def test_memory_limit_counts_growth_since_fork(self):
+        if resident_memory() is None:
+            self.skipTest('No /proc to read resident memory from.')
+        # Well below the parent's footprint, which workers share.
+        limit = resident_memory() // 4
+        self.serve(workers=1, max_memory=limit)
+        for _ in range(5):
+            self.get('/route1.txt')
+        self.assertEqual(self.stop(), 0)
+        self.assertFalse(any(line.startswith('Worker ')
+                             for line in self.read_log()))
+
+    def test_worker_stopped_before_it_works(self):
+        # A worker which got SIGTERM before installing its own handler, and
+        # so saw only the parent's, stops rather than serve.
+        server = PreforkServer(self.app, port=0)
+        server.bind()
+        handlers = dict((signum, signal.getsignal(signum)) for signum in
+                        (signal.SIGTERM, signal.SIGINT, signal.SIGHUP))
+        try:
+            server.handle_stop(signal.SIGTERM, None)
+            server.work()
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+            server.server.server_close()
+        self.assertTrue(server.stopped)
+        self.assertEqual(server.server.served, 0)
+
+    def test_workers_are_replaced_on_new_generation(self):
+        self.serve(workers=2)
+        self.get('/index.json')
+        self.app.shelf.put('test', '/index.json', {'changed': True})
+        self.wait_for_log('Reloading')
+        self.assertEqual(self.get('/index.json'), '{"changed": true}')
+        # Workers stopped on reload are not logged as exited.
+        self.assertFalse(any(line.startswith('Worker ')
+                             for line in self.read_log()))
+
+    def test_workers_are_replaced_on_hangup(self):
+        self.serve(workers=1, warm=False)
+        os.kill(self.pid, signal.SIGHUP)
+        self.get('/index.json')
+        self.assertEqual(self.stop(), 0)
+        self.assertFalse(any(line.startswith('Warmed ')
+                             for line in self.read_log()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import json
+import os
+import tempfile
+import unittest
+
+from flask.ext.testing import TestCase
+
+from tango.app import Tango
+
+
+class ResponseBodiesTestCase(TestCase):
+
+    def create_app(self):
+        _, self.temp_filepath = tempfile.mkstemp(suffix='.db')
+        app = Tango.build_app('testsite', import_stash=True)
+        app.config['SHELF_SQLITE_FILEPATH'] = self.temp_filepath
+        app.config['SHELVE_RESPONSE_BODIES'] = True
+        return app
+
+    def setUp(self):
+        self.app.shelve()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        os.unlink(self.temp_filepath)
+
+    def test_bodies_on_shelf(self):
+        entry = self.app.shelf.fetch('test', '/index.json')
+        self.assertEqual(json.loads(entry.body), entry.context)
+        entry = self.app.shelf.fetch('test', '/plain/exports.txt')
+        self.assertEqual(entry.body, '{}')
+        # Template output depends on the request, and is not pre-encoded.
+        entry = self.app.shelf.fetch('test', '/')
+        self.assertEqual(entry.body, None)
+
+    def test_serve_stored_body(self):
+        # Responses come from the stored body, not from encoding the context.
+        writer = self.app.get_writer('json')
+        def fail(context):
+            self.fail('Encoded a context at request time.')
+        writer.encode = fail
+
+        response = self.client.get('/index.json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(json.loads(response.data),
+                         {'project': 'tango',
+                          'hint': 'You can arrange your content package '
+                                  'as you please.'})
+
+        response = self.client.get('/')
+        self.assertTrue('Tango' in response.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import gzip
+import os
+import tempfile
+import unittest
+import zlib
+from StringIO import StringIO
+
+from flask.ext.testing import TestCase
+
+from tango.app import Tango
+from tango.shelf import SqliteConnector
+
+
+class ResponseCacheTestCase(TestCase):
+
+    def create_app(self):
+        _, self.temp_filepath = tempfile.mkstemp(suffix='.db')
+        app = Tango.build_app('testsite', import_stash=True)
+        app.config['SHELF_SQLITE_FILEPATH'] = self.temp_filepath
+        app.config['RESPONSE_CACHE'] = True
+        return app
+
+    def setUp(self):
+        self.app.shelve()
+        self.client = self.app.test_client()
+        # Count the writes of each writer, i.e. responses rendered.
+        self.writes = []
+        for name in ('json', 'template:argument.html',
+                     'template:index.html'):
+            writer = self.app.get_writer(name)
+            def counting_write(request, context, write=writer.write,
+                               name=name):
+                self.writes.append(name)
+                return write(request, context)
+            writer.write = counting_write
+
+    def tearDown(self):
+        os.unlink(self.temp_filepath)
+
+    def put(self, *args):
+        # Write through a separate connector, as a shelving process would.
+        writer = SqliteConnector(self.app)
+        writer.put(*args)
+        writer.close()
+
+    def test_response_is_rendered_once(self):
+        first = self.client.get('/index.json')
+        second = self.client.get('/index.json')
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(second.mimetype, 'application/json')
+        self.assertEqual(self.writes, ['json'])
+
+    def test_view_args_are_kept_apart(self):
+        self.assertTrue('spam' in self.client.get('/argument/spam/').data)
+        self.assertTrue('eggs' in self.client.get('/argument/eggs/').data)
+        self.assertTrue('spam' in self.client.get('/argument/spam/').data)
+        self.assertEqual(self.writes, ['template:argument.html'] * 2)
+
+    def test_changed_route_is_rendered_again(self):
+        self.client.get('/index.json')
+        self.put('test', '/index.json', {'project': 'changed'})
+        self.assertEqual(self.client.get('/index.json').data,
+                         '{"project": "changed"}')
+        self.assertEqual(self.writes, ['json', 'json'])
+
+    def test_unchanged_route_survives_new_generation(self):
+        self.client.get('/index.json')
+        self.put('test', '/route1.txt', {'changed': True})
+        self.client.get('/index.json')
+        self.assertEqual(self.writes, ['json'])
+
+    def test_rollback_is_rendered_again(self):
+        self.client.get('/index.json')
+        self.put('test', '/index.json', {'project': 'changed'})
+        self.client.get('/index.json')
+        self.app.shelf.rollback('test')
+        self.assertNotEqual(self.client.get('/index.json').data,
+                            '{"project": "changed"}')
+        self.assertEqual(self.writes, ['json', 'json', 'json'])
+
+    def test_response_larger_than_bound_is_not_kept(self):
+        self.app.config['RESPONSE_CACHE_MAX_BYTES'] = 10
+        self.client.get('/index.json')
+        self.client.get('/index.json')
+        self.assertEqual(self.writes, ['json', 'json'])
+
+    def test_debug_mode_renders_each_time(self):
+        self.app.debug = True
+        self.client.get('/index.json')
+        self.client.get('/index.json')
+        self.assertEqual(self.writes, ['json', 'json'])
+
+    def test_compressed_variants_are_served_by_accept_encoding(self):
+        plain = self.client.get('/')
+        gzipped = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+        deflated = self.client.get('/', headers={'Accept-Encoding':
+                                                 'gzip;q=0, deflate'})
+        self.assertEqual(self.writes, ['template:index.html'])
+        self.assertEqual(plain.content_encoding, None)
+        self.assertEqual(gzipped.content_encoding, 'gzip')
+        self.assertEqual(deflated.content_encoding, 'deflate')
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(gzipped.data)).read(),
+                         plain.data)
+        self.assertEqual(zlib.decompress(deflated.data), plain.data)
+        self.assertEqual(int(gzipped.headers['Content-Length']),
+                         len(gzipped.data))
+        for response in plain, gzipped, deflated:
+            self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+            self.assertEqual(response.mimetype, 'text/html')
+
+    def test_compressed_variants_have_etags_of_their_own(self):
+        self.app.config['RESPONSE_VALIDATORS'] = True
+        plain = self.client.get('/').headers['ETag']
+        gzipped = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+        etag = gzipped.headers['ETag']
+        self.assertEqual(etag, plain[:-1] + '-gzip"')
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip',
+                                                 'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+
+    def test_small_response_is_not_compressed(self):
+        response = self.client.get('/index.json',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.content_encoding, None)
+        self.assertEqual(response.data, self.client.get('/index.json').data)
+
+    def test_compression_can_be_turned_off(self):
+        self.app.config['RESPONSE_COMPRESS'] = False
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.content_encoding, None)
+        self.assertFalse('Vary' in response.headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import time
+import unittest
+
+from werkzeug.http import http_date
+
+from tango.app import Tango
+from tango.errors import HeaderException
+from tango.stash import parse_header
+
+from common_tests import TempSiteTests
+
+
+MODULE = '''"""
+site: validsite
+routes:
+ - json: /{name}.json
+exports:
+ - title
+{max_age}
+"""
+
+title = {title!r}
+'''
+
+
+class ResponseValidatorsTestCase(TempSiteTests, unittest.TestCase):
+
+    site = 'validsite'
+
+    def setUp(self):
+        TempSiteTests.setUp(self)
+        self.write_module('feed', 'Feed', 'max_age: 5m')
+        self.write_module('about', 'About')
+        self.app = self.shelve()
+        self.client = self.app.test_client()
+
+    def site_config(self):
+        config = TempSiteTests.site_config(self)
+        config['RESPONSE_VALIDATORS'] = True
+        return config
+
+    def write_module(self, name, title, max_age=''):
+        self.write('validsite/stash/{0}.py'.format(name),
+                   MODULE.format(name=name, title=title, max_age=max_age))
+
+    def shelve(self):
+        self.forget_modules()
+        return Tango.shelve_by_name('validsite')
+
+    def get(self, rule, **headers):
+        return self.client.get(rule, headers=headers)
+
+    def test_response_has_validators(self):
+        response = self.get('/feed.json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['ETag'].startswith('"'))
+        shelved_at = self.app.shelf.stamp('validsite', '/feed.json')[1]
+        self.assertEqual(response.headers['Last-Modified'],
+                         http_date(shelved_at))
+        self.assertEqual(response.headers['Cache-Control'], 'max-age=300')
+        # Only routes with max_age in their header have it.
+        self.assertFalse('Cache-Control' in self.get('/about.json').headers)
+
+    def test_matching_etag_is_not_modified_without_reading_shelf(self):
+        etag = self.get('/feed.json').headers['ETag']
+        def fetch(*args, **kwargs):
+            raise AssertionError('route read from shelf')
+        self.app.shelf.fetch = fetch
+        response = self.get('/feed.json', **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, '')
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.headers['Cache-Control'], 'max-age=300')
+
+    def test_other_etag_is_modified(self):
+        response = self.get('/feed.json', **{'If-None-Match': '"other"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, '{"title": "Feed"}')
+
+    def test_changed_route_has_new_etag(self):
+        etag = self.get('/feed.json').headers['ETag']
+        self.write_module('feed', 'Changed', 'max_age: 5m')
+        self.app = self.shelve()
+        self.client = self.app.test_client()
+        response = self.get('/feed.json', **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, '{"title": "Changed"}')
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_unchanged_route_keeps_validators(self):
+        before = self.get('/feed.json')
+        self.write_module('about', 'Changed')
+        time.sleep(1)
+        self.app = self.shelve()
+        self.client = self.app.test_client()
+        after = self.get('/feed.json', **{'If-None-Match':
+                                          before.headers['ETag']})
+        self.assertEqual(after.status_code, 304)
+        self.assertEqual(self.get('/feed.json').headers['Last-Modified'],
+                         before.headers['Last-Modified'])
+
+    def test_if_modified_since(self):
+        last_modified = self.get('/feed.json').headers['Last-Modified']
+        response = self.get('/feed.json',
+                            **{'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+        response = self.get('/feed.json', **{'If-Modified-Since':
+                                             http_date(time.time() - 3600)})
+        self.assertEqual(response.status_code, 200)
+
+    def test_validators_with_response_cache(self):
+        self.app.config['RESPONSE_CACHE'] = True
+        etag = self.get('/feed.json').headers['ETag']
+        response = self.get('/feed.json')
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.headers['Cache-Control'], 'max-age=300')
+        self.assertEqual(self.get('/feed.json', **{'If-None-Match': etag})
+                         .status_code, 304)
+
+    def test_validators_are_off_in_config_and_debug(self):
+        self.app.config['RESPONSE_VALIDATORS'] = False
+        response = self.get('/feed.json')
+        self.assertFalse('ETag' in response.headers)
+        self.assertFalse('Last-Modified' in response.headers)
+        self.assertEqual(response.headers['Cache-Control'], 'max-age=300')
+        self.app.config['RESPONSE_VALIDATORS'] = True
+        self.app.debug = True
+        response = self.get('/feed.json')
+        self.assertFalse('ETag' in response.headers)
+        self.assertFalse('Cache-Control' in response.headers)
+
+    def test_validators_are_off_by_default(self):
+        app = Tango.build_app('testsite')
+        # Neither validators nor the response cache read the generation.
+        def generation(*args, **kwargs):
+            raise AssertionError('generation read from shelf')
+        app.shelf.generation = generation
+        response = app.test_client().get('/index.json')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse('ETag' in response.headers)
+        self.assertFalse('Last-Modified' in response.headers)
+
+    def test_max_age_must_be_an_interval(self):
+        self.write_module('feed', 'Feed', 'max_age: forever')
+        self.assertRaises(HeaderException, parse_header,
+                          'validsite.stash.feed')
+
+
+if __name__ == '__main__':
+    unittest.main()
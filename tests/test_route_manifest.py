@@ -0,0 +1,84 @@
+import os
+import unittest
+
+from tango.app import Tango
+from tango.imports import module_index
+
+from common_tests import TempSiteTests
+
+
+MODULE = '''"""
+site: manifestsite
+routes:
+ - {0}
+exports:
+ - title: Manifest
+"""
+'''
+
+
+class RouteManifestTestCase(TempSiteTests, unittest.TestCase):
+
+    site = 'manifestsite'
+
+    def setUp(self):
+        TempSiteTests.setUp(self)
+        self.stash_dir = os.path.join(self.temp_dir, 'manifestsite', 'stash')
+        self.write('manifestsite/stash/one.py', MODULE.format('/one.txt'))
+
+    def site_config(self):
+        config = TempSiteTests.site_config(self)
+        config['ROUTE_MANIFEST_DIR'] = os.path.join(self.temp_dir,
+                                                    'manifests')
+        return config
+
+    def rules(self, app):
+        return [route.rule for route in app.routes]
+
+    def test_fresh_manifest_is_loaded(self):
+        Tango.compile_by_name('manifestsite')
+        app = Tango.build_app('manifestsite')
+        # A name rather than the stash module: discovery did not import it.
+        self.assertEqual(app.stash_module, 'manifestsite.stash')
+        self.assertEqual(self.rules(app), ['/one.txt'])
+        self.assertEqual(
+            sorted(rule.rule for rule in app.url_map.iter_rules()),
+            ['/one.txt', '/static/<path:filename>'])
+
+    def test_changed_module_is_discovered(self):
+        Tango.compile_by_name('manifestsite')
+        self.write('manifestsite/stash/one.py', MODULE.format('/changed.txt'))
+        app = Tango.build_app('manifestsite')
+        self.assertNotEqual(app.stash_module, 'manifestsite.stash')
+        self.assertEqual(self.rules(app), ['/changed.txt'])
+
+    def test_new_module_is_discovered(self):
+        Tango.compile_by_name('manifestsite')
+        self.write('manifestsite/stash/two.py', MODULE.format('/two.txt'))
+        app = Tango.build_app('manifestsite')
+        self.assertEqual(self.rules(app), ['/one.txt', '/two.txt'])
+
+    def test_removed_module_is_not_served(self):
+        self.write('manifestsite/stash/two.py', MODULE.format('/two.txt'))
+        Tango.compile_by_name('manifestsite')
+        os.remove(os.path.join(self.stash_dir, 'two.py'))
+        module_index.invalidate(self.stash_dir)
+        app = Tango.build_app('manifestsite')
+        self.assertEqual(self.rules(app), ['/one.txt'])
+
+    def test_manifest_dir_is_made_private(self):
+        Tango.compile_by_name('manifestsite')
+        manifest_dir = os.path.join(self.temp_dir, 'manifests')
+        self.assertEqual(os.stat(manifest_dir).st_mode & 0777, 0700)
+
+    def test_manifest_of_shared_dir_is_not_loaded(self):
+        Tango.compile_by_name('manifestsite')
+        os.chmod(os.path.join(self.temp_dir, 'manifests'), 0777)
+        app = Tango.build_app('manifestsite')
+        self.assertNotEqual(app.stash_module, 'manifestsite.stash')
+        self.assertEqual(self.rules(app), ['/one.txt'])
+        self.assertRaises(IOError, Tango.compile_by_name, 'manifestsite')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import sqlite3
+import unittest
+import warnings
+from StringIO import StringIO
+
+from tango.errors import HeaderException
+from tango.schedule import schedule_by_name
+from tango.stash import parse_header
+
+from common_tests import TempSiteTests
+
+
+# Each import appends a line to a file of pulls, from any child process.
+MODULE = '''"""
+site: schedsite
+routes:
+ - {rule}
+exports:
+ - title
+{refresh}
+"""
+
+with open({pulls!r}, 'a') as fd:
+    fd.write({name!r} + '\\n')
+title = {title!r}
+'''
+
+
+class ScheduleTestCase(TempSiteTests, unittest.TestCase):
+
+    site = 'schedsite'
+
+    def setUp(self):
+        TempSiteTests.setUp(self)
+        self.pulls = os.path.join(self.temp_dir, 'pulls')
+        self.write_module('ticker', '/ticker.txt', 'refresh: 0.1s')
+        self.write_module('about', '/about.txt')
+
+    def site_config(self):
+        config = TempSiteTests.site_config(self)
+        config['SCHEDULE_JITTER'] = 0
+        return config
+
+    def write_module(self, name, rule, refresh='', title=None):
+        self.write('schedsite/stash/{0}.py'.format(name),
+                   MODULE.format(rule=rule, refresh=refresh, name=name,
+                                 pulls=self.pulls, title=title or name))
+
+    def read_pulls(self):
+        with open(self.pulls) as fd:
+            return fd.read().split()
+
+    def test_modules_are_pulled_as_they_fall_due(self):
+        logfile = StringIO()
+        scheduler = schedule_by_name('schedsite', jobs=2, logfile=logfile,
+                                     pulls=4)
+        pulls = self.read_pulls()
+        # The module without refresh is pulled only once, at start.
+        self.assertEqual(pulls.count('about'), 1)
+        self.assertEqual(pulls.count('ticker'), 3)
+        log = logfile.getvalue().splitlines()
+        self.assertEqual(len(log), 4)
+        self.assertTrue(all(line.startswith('Refreshed schedsite.stash.')
+                            for line in log))
+        self.assertTrue('backlog: ' in log[0])
+        self.assertEqual(scheduler.app.shelf.get('schedsite', '/ticker.txt'),
+                         {'title': 'ticker'})
+
+    def test_modules_without_refresh_end_the_run(self):
+        self.write_module('ticker', '/ticker.txt')
+        scheduler = schedule_by_name('schedsite', jobs=1)
+        self.assertEqual(sorted(self.read_pulls()), ['about', 'ticker'])
+        self.assertEqual(scheduler.backlog(), (0, 0.0))
+
+    def test_failed_module_is_left_as_shelved(self):
+        logfile = StringIO()
+        scheduler = schedule_by_name('schedsite', logfile=logfile, pulls=2)
+        self.write('schedsite/stash/ticker.py', 'raise RuntimeError\n' +
+                   open(os.path.join(self.temp_dir, 'schedsite', 'stash',
+                                     'ticker.py')).read())
+        scheduler.run(pulls=1)
+        log = logfile.getvalue()
+        self.assertTrue('Failed to refresh schedsite.stash.ticker' in log)
+        self.assertTrue('RuntimeError' in log)
+        self.assertEqual(scheduler.app.shelf.get('schedsite', '/ticker.txt'),
+                         {'title': 'ticker'})
+
+    def test_failed_write_is_rescheduled(self):
+        logfile = StringIO()
+        scheduler = schedule_by_name('schedsite', logfile=logfile, pulls=2)
+        def put_many(items):
+            raise sqlite3.OperationalError('database is locked')
+        scheduler.app.shelf.put_many = put_many
+        scheduler.run(pulls=2)
+        log = logfile.getvalue()
+        self.assertEqual(log.count('Failed to refresh schedsite.stash.ticker'),
+                         2)
+        self.assertTrue('database is locked' in log)
+        self.assertEqual(len(scheduler.queue), 1)
+
+    def test_shared_route_is_pulled_with_all_its_modules(self):
+        self.write_module('other', '/ticker.txt')
+        with warnings.catch_warnings():
+            # Both modules export a title, which the merge warns about.
+            warnings.simplefilter('ignore')
+            scheduler = schedule_by_name('schedsite', pulls=1)
+        names = [unit[0] for unit in scheduler.units]
+        self.assertTrue(['schedsite.stash.other', 'schedsite.stash.ticker']
+                        in names)
+        self.assertEqual([refresh for unit_names, module_routes, refresh
+                          in scheduler.units if len(unit_names) == 2], [0.1])
+
+    def test_refresh_must_be_an_interval(self):
+        self.write_module('ticker', '/ticker.txt', 'refresh: often')
+        self.assertRaises(HeaderException, parse_header,
+                          'schedsite.stash.ticker')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -25,9 +25,23 @@ class BaseConnectorTestCase(TestCase):
     def test_get_notimplemented(self):
         self.assertRaises(NotImplementedError, self.connector.get, '', '')
 
+    def test_fetch_notimplemented(self):
+        self.assertRaises(NotImplementedError, self.connector.fetch, '', '')
+
+    def test_generation_notimplemented(self):
+        self.assertRaises(NotImplementedError, self.connector.generation, '')
+
     def test_put_notimplemented(self):
         self.assertRaises(NotImplementedError, self.connector.put, '', '', {})
 
+    def test_get_many_notimplemented(self):
+        self.assertRaises(NotImplementedError,
+                          self.connector.get_many, [('', '')])
+
+    def test_put_many_notimplemented(self):
+        self.assertRaises(NotImplementedError,
+                          self.connector.put_many, [('', '', {})])
+
     def test_drop_notimplemented(self):
         self.assertRaises(NotImplementedError, self.connector.drop, '', '')
 
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+
+from flask.ext.testing import TestCase
+
+from tango.app import Tango
+from tango.shelf import CachingConnector, SqliteConnector
+
+from common_tests import ConnectorCommonTests
+
+
+class CachingConnectorTestCase(TestCase, ConnectorCommonTests):
+
+    def create_app(self):
+        return Tango(__name__)
+
+    def setUp(self):
+        _, self.temp_filepath = tempfile.mkstemp(suffix='.db')
+        self.app.config['SHELF_SQLITE_FILEPATH'] = self.temp_filepath
+        self.app.config['SHELF_CACHE_MAX_ENTRIES'] = 2
+        self.backend = SqliteConnector(self.app)
+        self.connector = CachingConnector(self.app, self.backend)
+        self.loads = []
+        fetch = self.backend.fetch
+        def counting_fetch(site, rule, generation=None, keys=None):
+            self.loads.append((site, rule))
+            return fetch(site, rule, generation, keys)
+        self.backend.fetch = counting_fetch
+
+    def tearDown(self):
+        self.connector.close()
+        os.unlink(self.temp_filepath)
+
+    def test_cache_hit(self):
+        self.connector.put('site', 'rule', {'spam': 'eggs'})
+        self.assertEqual(self.connector.get('site', 'rule'), {'spam': 'eggs'})
+        self.assertEqual(self.connector.get('site', 'rule'), {'spam': 'eggs'})
+        self.assertEqual(self.loads, [('site', 'rule')])
+
+    def test_invalidation_by_another_process(self):
+        self.connector.put('site', 'rule', {'spam': 'eggs'})
+        self.connector.put('other', 'rule', {'foo': 'bar'})
+        self.connector.get('site', 'rule')
+        self.connector.get('other', 'rule')
+
+        # Write through a separate connector, as a shelving process would.
+        writer = SqliteConnector(self.app)
+        writer.put('site', 'rule', {'spam': 'spam'})
+        writer.close()
+
+        self.assertEqual(self.connector.get('site', 'rule'), {'spam': 'spam'})
+        self.assertEqual(self.connector.get('other', 'rule'), {'foo': 'bar'})
+        # Only the route of the written site is loaded again.
+        self.assertEqual(self.loads, [('site', 'rule'), ('other', 'rule'),
+                                      ('site', 'rule')])
+
+    def test_unchanged_entries_survive_new_generation(self):
+        self.connector.put_many([('site', 'one', {'spam': 'eggs'}),
+                                 ('site', 'two', {'foo': 'bar'})])
+        self.connector.get('site', 'one')
+        self.connector.get('site', 'two')
+
+        # Only route two changes in the new generation of the site.
+        writer = SqliteConnector(self.app)
+        writer.put_many([('site', 'one', {'spam': 'eggs'}),
+                         ('site', 'two', {'foo': 'baz'})])
+        writer.close()
+
+        self.assertEqual(self.connector.get('site', 'one'), {'spam': 'eggs'})
+        self.assertEqual(self.connector.get('site', 'two'), {'foo': 'baz'})
+        self.assertEqual(self.loads, [('site', 'one'), ('site', 'two'),
+                                      ('site', 'two')])
+
+    def test_eviction(self):
+        self.connector.put_many([('site', rule, {'rule': rule})
+                                 for rule in ('a', 'b', 'c')])
+        for rule in ('a', 'b', 'c'):
+            self.connector.get('site', rule)
+        self.assertEqual(len(self.connector.cache), 2)
+        self.assertFalse(('site', 'a') in self.connector.cache)
+        self.assertTrue(self.connector.cache.size > 0)
+
+    def test_app_shelf(self):
+        self.app.config['SHELF_CACHE'] = True
+        self.assertTrue(isinstance(self.app.shelf, CachingConnector))
+        self.app.config['SHELF_CACHE'] = False
+        self.assertTrue(isinstance(self.app.shelf, SqliteConnector))
+
+
+if __name__ == '__main__':
+    unittest.main()
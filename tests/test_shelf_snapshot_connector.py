@@ -0,0 +1,120 @@
+import os
+import tempfile
+import time
+import unittest
+
+from flask.ext.testing import TestCase
+
+from tango.app import Tango
+from tango.errors import ShelfError
+from tango.shelf import SnapshotConnector, SqliteConnector, write_snapshot
+
+
+class SnapshotConnectorTestCase(TestCase):
+
+    def create_app(self):
+        return Tango(__name__)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app.config['SHELF_SQLITE_FILEPATH'] = self.path('shelf.db')
+        self.app.config['SHELF_SNAPSHOT_FILEPATH'] = \
+            self.path('shelf.snapshot')
+        self.app.config['SHELF_SNAPSHOT_CHECK_INTERVAL'] = 0
+        self.shelf = SqliteConnector(self.app)
+        self.connector = SnapshotConnector(self.app)
+
+    def tearDown(self):
+        self.shelf.close()
+        self.connector.close()
+        for filename in os.listdir(self.directory):
+            os.unlink(self.path(filename))
+        os.rmdir(self.directory)
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def export(self):
+        return write_snapshot(self.app.config['SHELF_SNAPSHOT_FILEPATH'],
+                              self.shelf.records())
+
+    def test_no_snapshot(self):
+        self.assertEqual(self.connector.get('site', 'rule'), {})
+        self.assertEqual(self.connector.list(), [])
+
+    def test_not_a_snapshot(self):
+        open(self.app.config['SHELF_SNAPSHOT_FILEPATH'], 'w').close()
+        self.assertRaises(ShelfError, self.connector.get, 'site', 'rule')
+
+    def test_read_only(self):
+        self.assertRaises(ShelfError, self.connector.put, 'site', 'rule', {})
+        self.assertRaises(ShelfError, self.connector.drop, 'site')
+
+    def test_export(self):
+        self.app.config['SHELF_CODEC'] = 'marshal'
+        self.shelf.put('site', 'one', {'spam': 'eggs'},
+                       body='{"spam": "eggs"}')
+        self.shelf.put('site', 'two', {'foo': ('bar',)})
+        self.shelf.put('other', 'one', {1: 'one'})
+        self.assertEqual(self.export(), 3)
+
+        self.assertEqual(self.connector.get('site', 'one'), {'spam': 'eggs'})
+        self.assertEqual(self.connector.fetch('site', 'one').body,
+                         '{"spam": "eggs"}')
+        self.assertEqual(self.connector.get('site', 'two'), {'foo': ('bar',)})
+        self.assertEqual(self.connector.fetch('site', 'two').body, None)
+        self.assertEqual(self.connector.get('other', 'one'), {1: 'one'})
+        self.assertEqual(self.connector.get('other', 'two'), {})
+        self.assertEqual(self.connector.get_many([('site', 'one')]),
+                         {('site', 'one'): {'spam': 'eggs'}})
+        self.assertEqual(self.connector.list(),
+                         [('site', 'one'), ('site', 'two'), ('other', 'one')])
+        self.assertEqual(self.connector.list('site', 'two'), [('site', 'two')])
+
+    def test_contexts_are_read_in_place(self):
+        self.shelf.put('site', 'pickle', {'spam': ('eggs',)})
+        self.app.config['SHELF_CODEC'] = 'json'
+        self.shelf.put('site', 'json', {u'spam': [u'eggs']})
+        self.app.config['SHELF_COMPRESS_THRESHOLD'] = 0
+        self.shelf.put('site', 'zlib', {u'spam': [u'eggs']})
+        self.export()
+        snapshot = self.connector.open()
+        for rule in ('pickle', 'json', 'zlib'):
+            codec, data, body = snapshot.find('site', rule)
+            self.assertEqual(type(data), buffer)
+        self.assertEqual(self.connector.get('site', 'pickle'),
+                         {'spam': ('eggs',)})
+        self.assertEqual(self.connector.get('site', 'json'),
+                         {u'spam': [u'eggs']})
+        self.assertEqual(self.connector.get('site', 'zlib'),
+                         {u'spam': [u'eggs']})
+
+    def test_many_routes(self):
+        rules = ['/route/{0}'.format(i) for i in range(1000)]
+        self.shelf.put_many(('site', rule, {'rule': rule}) for rule in rules)
+        self.export()
+        for rule in rules:
+            self.assertEqual(self.connector.get('site', rule), {'rule': rule})
+
+    def test_publish(self):
+        self.shelf.put('site', 'rule', {'spam': 'eggs'})
+        self.export()
+        generation = self.connector.generation('site')
+        self.assertEqual(self.connector.get('site', 'rule'), {'spam': 'eggs'})
+
+        # An unchanged export keeps its generation.
+        self.export()
+        self.assertEqual(self.connector.generation('site'), generation)
+
+        # A new export is picked up, after the check interval.
+        self.app.config['SHELF_SNAPSHOT_CHECK_INTERVAL'] = 60
+        self.shelf.put('site', 'rule', {'spam': 'spam'})
+        self.export()
+        self.assertEqual(self.connector.get('site', 'rule'), {'spam': 'eggs'})
+        self.connector.checked = time.time() - 61
+        self.assertEqual(self.connector.get('site', 'rule'), {'spam': 'spam'})
+        self.assertNotEqual(self.connector.generation('site'), generation)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,17 @@
+import cPickle as pickle
 import os
+import sqlite3
 import tempfile
+import threading
 import unittest
+from collections import defaultdict
 
 from flask.ext.testing import TestCase
+from jinja2 import Markup
 
 from tango.app import Tango
+from tango.codec import decode
+from tango.errors import ShelfError
 from tango.shelf import SqliteConnector
 
 from common_tests import ConnectorCommonTests
@@ -40,6 +47,311 @@ class SqliteConnectorTestCase(TestCase, ConnectorCommonTests):
         open(self.temp_filepath, 'w').close()
         self.smoke_test('Test empty file.')
 
+    def test_migrate_legacy_file(self):
+        # Build a shelf file as written by the original schema, which allowed
+        # duplicate rows for a route and had no schema version.
+        legacy = sqlite3.connect(self.temp_filepath)
+        legacy.execute('CREATE TABLE contexts ('
+                       'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                       'site TEXT NOT NULL, rule TEXT NOT NULL, '
+                       'context BLOB NOT NULL);')
+        for value in ('old', 'new'):
+            legacy.execute('INSERT INTO contexts (site, rule, context) '
+                           'VALUES (?, ?, ?);',
+                           ('site', 'rule', pickle.dumps({'spam': value})))
+        legacy.commit()
+        legacy.close()
+
+        # The newest row wins, and there is now one row per route.
+        self.assertEqual(self.connector.get('site', 'rule'), {'spam': 'new'})
+        self.assertEqual(self.connector.list('site'), [('site', 'rule')])
+        with self.connector.connection() as db:
+            version = db.execute('PRAGMA user_version;').fetchone()[0]
+        self.assertEqual(version, len(self.connector.migrations))
+
+        # Legacy rows are read as the site's initial generation.
+        self.connector.put('site', 'rule', {'spam': 'newer'})
+        self.assertEqual(self.connector.get('site', 'rule'), {'spam': 'newer'})
+        self.assertEqual(self.connector.list('site'), [('site', 'rule')])
+
+    def test_codecs(self):
+        self.connector.put('site', 'pickled', {'spam': 'eggs'})
+        self.app.config['SHELF_CODEC'] = 'marshal'
+        self.app.config['SHELF_COMPRESS_THRESHOLD'] = 100
+        self.connector.put('site', 'small', {'spam': 'eggs'})
+        self.connector.put('site', 'large', {'spam': ['eggs'] * 100})
+        self.connector.put('site', 'tuple', {'spam': ('eggs', 'eggs')})
+
+        with self.connector.connection() as db:
+            tags = dict(db.execute('SELECT rule, codec FROM contexts;'))
+        self.assertEqual(tags, {'pickled': 'pickle', 'small': 'marshal',
+                                'large': 'marshal+zlib', 'tuple': 'marshal'})
+
+        # Rows decode by their own tag, whatever the configured codec.
+        self.app.config['SHELF_CODEC'] = 'json'
+        self.assertEqual(self.connector.get('site', 'pickled'), {'spam': 'eggs'})
+        self.assertEqual(self.connector.get('site', 'large'),
+                         {'spam': ['eggs'] * 100})
+        self.assertEqual(self.connector.get_many([('site', 'tuple')]),
+                         {('site', 'tuple'): {'spam': ('eggs', 'eggs')}})
+
+    def test_codecs_keep_types(self):
+        markup = Markup(u'<b>caf\xe9</b>')
+        counts = defaultdict(int, {u'spam': 1})
+        self.app.config['SHELF_CODEC'] = 'marshal'
+        self.connector.put('site', 'markup', {'html': markup})
+        self.app.config['SHELF_CODEC'] = 'json'
+        self.connector.put('site', 'counts', {u'counts': counts})
+        self.connector.put('site', 'ascii', {'title': 'Tango'})
+        self.connector.put('site', 'bytes', {u'title': 'Tang\xc3\xb6'})
+
+        with self.connector.connection() as db:
+            tags = dict(db.execute('SELECT rule, codec FROM contexts;'))
+        self.assertEqual(tags, {'markup': 'pickle', 'counts': 'pickle',
+                                'ascii': 'json', 'bytes': 'pickle'})
+        # ASCII byte strings come back as equal unicode strings.
+        self.assertEqual(self.connector.get('site', 'ascii'),
+                         {u'title': u'Tango'})
+        html = self.connector.get('site', 'markup')['html']
+        self.assertEqual((type(html), html), (Markup, markup))
+        self.assertEqual(type(self.connector.get('site', 'counts')
+                              ['counts']), defaultdict)
+        self.assertEqual(type(self.connector.get('site', 'bytes')['title']),
+                         str)
+
+    def test_put_many_is_one_transaction(self):
+        self.connector.put('site', 'one', {'spam': 'eggs'})
+        items = [('site', 'one', {'spam': 'spam'}),
+                 ('site', 'two', {'unpicklable': lambda: None})]
+        self.assertRaises(Exception, self.connector.put_many, items)
+        # Nothing in the failed batch is written.
+        self.assertEqual(self.connector.get('site', 'one'), {'spam': 'eggs'})
+        self.assertEqual(self.connector.list('site'), [('site', 'one')])
+
+    def test_readers_see_whole_generations(self):
+        self.connector.put_many([('site', 'one', {'spam': 'eggs'}),
+                                 ('site', 'two', {'spam': 'eggs'})])
+        generation = self.connector.generation('site')
+
+        # A reader on another connection, during a shelve run.
+        reader = SqliteConnector(self.app)
+        seen = []
+        def items():
+            yield 'site', 'one', {'spam': 'spam'}
+            seen.append(reader.get_many([('site', 'one'), ('site', 'two')]))
+            seen.append(reader.list('site'))
+            yield 'site', 'two', {'spam': 'spam'}
+            yield 'site', 'three', {'spam': 'spam'}
+        self.connector.put_many(items())
+        self.assertEqual(seen, [{('site', 'one'): {'spam': 'eggs'},
+                                 ('site', 'two'): {'spam': 'eggs'}},
+                                [('site', 'one'), ('site', 'two')]])
+
+        # Once committed, the reader sees the new generation whole.
+        self.assertNotEqual(reader.generation('site'), generation)
+        self.assertEqual(reader.get('site', 'two'), {'spam': 'spam'})
+        self.assertEqual(reader.list('site'), [('site', 'one'),
+                                               ('site', 'two'),
+                                               ('site', 'three')])
+        # A read pinned to the prior generation still sees that generation.
+        self.assertEqual(reader.fetch('site', 'two', generation).context,
+                         {'spam': 'eggs'})
+        self.assertEqual(reader.fetch('site', 'three', generation), None)
+        reader.close()
+
+    def test_history_and_pruning(self):
+        self.app.config['SHELF_KEEP_GENERATIONS'] = 1
+        for value in range(5):
+            self.connector.put_many([('site', 'one', {'spam': value}),
+                                     ('site', 'two', {'spam': value})])
+        self.connector.drop('site', 'two')
+        history = [g for g, _ in self.connector.history('site')]
+        self.assertEqual(history, [self.connector.generation('site'),
+                                   self.connector.generation('site') - 1])
+        self.assertRaises(ShelfError, self.connector.rollback, 'site',
+                          history[-1] - 1)
+
+        # Only the rows read by the kept generations remain.
+        with self.connector.connection() as db:
+            rows = db.execute('SELECT rule, generation, dropped '
+                              'FROM contexts ORDER BY id;').fetchall()
+        self.assertEqual(rows, [('one', history[1], 0),
+                                ('two', history[1], 0),
+                                ('two', history[0], 1)])
+
+        self.connector.rollback('site')
+        self.assertEqual(self.connector.get('site', 'two'), {'spam': 4})
+        self.connector.put('site', 'one', {'spam': 5})
+        self.connector.put('site', 'one', {'spam': 6})
+        with self.connector.connection() as db:
+            rows = db.execute('SELECT rule, context FROM contexts '
+                              'ORDER BY id;').fetchall()
+        self.assertEqual([rule for rule, _ in rows], ['two', 'one', 'one'])
+        self.assertEqual(self.connector.get('site', 'two'), {'spam': 4})
+
+    def test_abandoned_generation(self):
+        # A shelve run which wrote rows, then crashed before committing.
+        with self.connector.connection() as db:
+            generation = self.connector.begin(db, 'site')
+            self.connector.write(db, {'site': generation}, 'site', 'one',
+                                 {'spam': 1})
+            db.commit()
+        self.connector.put('site', 'two', {'spam': 2})
+        self.assertEqual(self.connector.get('site', 'one'), {})
+        self.assertEqual(self.connector.list('site'), [('site', 'two')])
+
+        # Its rows are pruned once it is older than every kept generation.
+        keep = self.app.config['SHELF_KEEP_GENERATIONS']
+        for value in range(keep):
+            self.connector.put('site', 'two', {'spam': value})
+        with self.connector.connection() as db:
+            rules = db.execute('SELECT rule FROM contexts;').fetchall()
+        self.assertEqual(set(rules), set([('two',)]))
+
+    def count_rows(self):
+        with self.connector.connection() as db:
+            return (db.execute('SELECT COUNT(*) FROM contexts;').fetchone()[0],
+                    db.execute('SELECT COUNT(*) FROM blobs;').fetchone()[0])
+
+    def test_contexts_stored_once(self):
+        # Routes of one module share a context, as given by pull_context.
+        context = {'spam': ['eggs'] * 100}
+        items = [('site', rule, context, ['source.py'], 'body')
+                 for rule in ('/', '/index.html', '/home')]
+        self.connector.put_many(items)
+        self.assertEqual(self.count_rows(), (3, 2))
+        self.assertEqual(self.connector.get('site', '/home'), context)
+        self.assertEqual(self.connector.fetch('site', '/home').body, 'body')
+        digests = set(self.connector.digest('site', rule)
+                      for site, rule, _, _, _ in items)
+        self.assertEqual(len(digests), 1)
+
+        # An unchanged run writes nothing, not even a new generation.
+        generation = self.connector.generation('site')
+        self.connector.put_many(items)
+        self.connector.put('site', '/', {'spam': ['eggs'] * 100},
+                           ['source.py'], 'body')
+        self.assertEqual(self.connector.generation('site'), generation)
+        self.assertEqual(self.count_rows(), (3, 2))
+
+        # A new source file or body is a change.
+        self.connector.put('site', '/', context, ['other.py'], 'body')
+        self.assertEqual(self.connector.source('site', '/'),
+                         ['other.py', 'source.py'])
+        self.connector.put('site', '/home', context, None, 'new body')
+        self.assertEqual(self.count_rows(), (5, 3))
+        self.assertNotEqual(self.connector.digest('site', '/home'),
+                            self.connector.digest('site', '/'))
+
+    def test_route_written_twice_in_a_run(self):
+        self.connector.put_many([('site', 'rule', {'spam': 'first'}),
+                                 ('site', 'rule', {'spam': 'second'})])
+        self.assertEqual(self.count_rows(), (1, 2))
+        self.assertEqual(self.connector.get('site', 'rule'),
+                         {'spam': 'second'})
+        self.assertEqual(self.connector.generation('site'), 1)
+
+    def test_context_changed_between_items(self):
+        context = {'spam': 'eggs'}
+        def items():
+            yield 'site', 'one', context
+            context['ham'] = 'spam'
+            yield 'site', 'two', context
+        self.connector.put_many(items())
+        self.assertEqual(self.connector.get('site', 'one'), {'spam': 'eggs'})
+        self.assertEqual(self.connector.get('site', 'two'),
+                         {'spam': 'eggs', 'ham': 'spam'})
+
+    def test_blobs_pruned(self):
+        self.app.config['SHELF_KEEP_GENERATIONS'] = 0
+        for value in range(3):
+            self.connector.put('site', 'rule', {'spam': value})
+        self.assertEqual(self.count_rows(), (1, 1))
+        self.connector.drop('site')
+        self.assertEqual(self.count_rows(), (0, 0))
+        self.assertEqual(self.connector.digest('site', 'rule'), None)
+
+    def test_exports_layout(self):
+        self.connector.put('site', 'whole', {'spam': 'eggs'})
+        self.app.config['SHELF_LAYOUT'] = 'exports'
+        large = ['eggs'] * 1000
+        self.connector.put_many([('site', 'one', {'title': 'One',
+                                                  'large': large}),
+                                 ('site', 'two', {'title': 'Two',
+                                                  'large': large})])
+        # The large export is stored once, shared by both routes.
+        self.assertEqual(self.count_rows(), (3, 6))
+
+        entry = self.connector.fetch('site', 'one')
+        self.assertEqual(entry.context, {'title': 'One', 'large': large})
+        small = self.connector.fetch('site', 'one', keys=['title'])
+        self.assertEqual(small.context, {'title': 'One'})
+        self.assertTrue(small.size < entry.size / 10)
+        self.assertEqual(small.digest, entry.digest)
+        self.assertEqual(self.connector.get('site', 'whole', ['spam']),
+                         {'spam': 'eggs'})
+        self.assertEqual(self.connector.get_many([('site', 'two')]),
+                         {('site', 'two'): {'title': 'Two', 'large': large}})
+
+        # Exports are exported whole, e.g. to a snapshot.
+        records = dict(((site, rule), decode(codec, data))
+                       for site, rule, codec, data, body
+                       in self.connector.records())
+        self.assertEqual(records[('site', 'two')],
+                         {'title': 'Two', 'large': large})
+
+    def test_exports_kept_while_referred_to(self):
+        self.app.config['SHELF_LAYOUT'] = 'exports'
+        keep = self.app.config['SHELF_KEEP_GENERATIONS']
+        for value in range(keep + 3):
+            self.connector.put_many([('site', '/a', {'title': value}),
+                                     ('site', '/b', {'title': 'static'})])
+            self.assertEqual(self.connector.get('site', '/a'),
+                             {'title': value})
+            self.assertEqual(self.connector.get('site', '/b'),
+                             {'title': 'static'})
+        # Exports of pruned rows go, along with the rows.
+        self.assertEqual(self.count_rows(), (keep + 2, 2 * (keep + 1) + 2))
+
+    def test_migrate_export_references(self):
+        self.app.config['SHELF_LAYOUT'] = 'exports'
+        self.app.config['SHELF_KEEP_GENERATIONS'] = 0
+        self.connector.put('site', '/b', {'title': 'static'})
+        # Take the shelf back to before export references were recorded.
+        with self.connector.connection() as db:
+            db.execute('DROP TABLE export_blobs;')
+            db.execute('PRAGMA user_version = {0};'
+                       .format(len(self.connector.migrations) - 1))
+            db.commit()
+        self.connector.close()
+        connector = SqliteConnector(self.app)
+        connector.put('site', '/a', {'title': 'changed'})
+        connector.put('site', '/a', {'title': 'again'})
+        self.assertEqual(connector.get('site', '/b'), {'title': 'static'})
+        connector.close()
+
+    def test_connection_pool(self):
+        with self.connector.connection() as db:
+            pass
+        with self.connector.connection() as again:
+            self.assertTrue(again is db)
+
+        # Each thread has a connection of its own.
+        other = []
+        def connect():
+            with self.connector.connection() as db:
+                other.append(db)
+        thread = threading.Thread(target=connect)
+        thread.start()
+        thread.join()
+        self.assertFalse(other[0] is db)
+
+        # A closed connector opens a new connection on next use.
+        self.connector.close()
+        with self.connector.connection() as again:
+            self.assertFalse(again is db)
+        self.smoke_test('Test after close.')
+
 
 if __name__ == '__main__':
     unittest.main()
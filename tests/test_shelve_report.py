@@ -0,0 +1,76 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from tango import instrument
+from tango.app import Tango
+
+
+class ShelveReportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.temp_dir, 'report.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def shelve(self, **options):
+        logfile = StringIO()
+        Tango.shelve_by_name('testsite', logfile=logfile,
+                             report=self.filepath, **options)
+        with open(self.filepath) as fd:
+            return json.load(fd), logfile.getvalue().splitlines()
+
+    def check_report(self, report):
+        module = report['modules']['testsite.stash.index']
+        self.assertEqual(sorted(module['stages']),
+                         ['header', 'import', 'pull'])
+        self.assertEqual(module['routes'], [['test', '/']])
+        for measure in module['stages'].values():
+            self.assertEqual(sorted(measure), ['count', 'cpu',
+                                               'peak_growth', 'peak_memory',
+                                               'wall'])
+            self.assertTrue(measure['wall'] >= 0)
+            self.assertTrue(measure['peak_memory'] > 0)
+        routes = dict((route['rule'], route) for route in report['routes'])
+        self.assertEqual(len(routes), 7)
+        route = routes['/index.json']
+        self.assertEqual(sorted(route['modules']),
+                         ['testsite.stash', 'testsite.stash.package.module'])
+        self.assertTrue(route['bytes'] > 0)
+        self.assertEqual(sorted(route['stages']), ['serialize', 'write'])
+        self.assertTrue('commit' in report['run'])
+
+    def test_report_has_each_stage(self):
+        report, log = self.shelve()
+        self.check_report(report)
+        self.assertTrue(any(line.startswith('Measured ') and
+                            ' modules and 7 routes, in ' in line
+                            for line in log))
+        largest = log[log.index('Largest modules:') + 1]
+        self.assertTrue(largest.endswith('B  testsite.stash.multiple'))
+
+    def test_report_measures_children(self):
+        report, log = self.shelve(jobs=2)
+        self.check_report(report)
+
+    def test_report_of_stream(self):
+        report, log = self.shelve(stream=True)
+        self.check_report(report)
+
+    def test_recorder_of_caller_is_kept(self):
+        recorder = instrument.start()
+        try:
+            Tango.shelve_by_name('testsite')
+            self.assertTrue(instrument.recorder is recorder)
+        finally:
+            instrument.finish()
+        self.assertTrue(len(recorder.routes) > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+import warnings
+from StringIO import StringIO
+
+from tango.app import Tango
+from tango.stash import stream_module_routes
+
+from common_tests import TempSiteTests
+
+
+class StreamingShelveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        _, self.temp_filepath = tempfile.mkstemp(suffix='.db')
+
+    def tearDown(self):
+        os.remove(self.temp_filepath)
+
+    def build_app(self, name):
+        app = Tango.build_app(name)
+        app.config['SHELF_SQLITE_FILEPATH'] = self.temp_filepath
+        return app
+
+    def shelved(self, app, site):
+        return dict((rule, app.shelf.get(site, rule))
+                    for _, rule in app.shelf.list(site))
+
+    def test_same_shelf_as_batch(self):
+        app = Tango.build_app('testsite', import_stash=True)
+        app.config['SHELF_SQLITE_FILEPATH'] = self.temp_filepath
+        app.shelve()
+        batch = self.shelved(app, 'test')
+        app.shelf.drop('test')
+
+        app = self.build_app('testsite')
+        app.config['SHELVE_QUEUE_SIZE'] = 1
+        app.config['SHELVE_BATCH_SIZE'] = 2
+        app.shelve_stream()
+        self.assertEqual(self.shelved(app, 'test'), batch)
+
+    def test_duplicate_routes_merge_across_modules(self):
+        routes = list(stream_module_routes('testsite.stash'))
+        self.assertEqual(len(routes), len(set(r.rule for r in routes)))
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            routes = stream_module_routes('crashsite.stash', jobs=2)
+            routes = dict((route.rule, route) for route in routes)
+        self.assertEqual(sorted(routes), ['/good.json', '/shared.json'])
+        self.assertEqual(routes['/shared.json'].context,
+                         {'title': 'Also', 'count': 2})
+
+    def test_failed_run_is_not_seen(self):
+        app = self.build_app('indexerror')
+        app.config['SHELVE_BATCH_SIZE'] = 1
+        app.shelf.put('indexerror', '/', {'title': 'Last good'})
+        generation = app.shelf.generation('indexerror')
+        # A stash module which raises fails the run.
+        self.assertRaises(IndexError, app.shelve_stream)
+        self.assertEqual(app.shelf.generation('indexerror'), generation)
+        self.assertEqual(app.shelf.get('indexerror', '/'),
+                         {'title': 'Last good'})
+
+    def test_failed_write_stops_the_run(self):
+        logfile = StringIO()
+        self.build_app('testsite').shelve_stream(logfile=logfile)
+        modules = logfile.getvalue().count('Loading ')
+
+        app = self.build_app('testsite')
+        app.config['SHELVE_QUEUE_SIZE'] = 1
+        def put_many(items, batch_size=None):
+            for item in items:
+                raise sqlite3.OperationalError('database is locked')
+        app.shelf.put_many = put_many
+        logfile = StringIO()
+        self.assertRaises(sqlite3.OperationalError, app.shelve_stream,
+                          logfile=logfile)
+        self.assertTrue(logfile.getvalue().count('Loading ') < modules)
+
+    def test_batches_are_not_seen_until_complete(self):
+        app = self.build_app('testsite')
+        app.shelf.put('site', 'one', {'spam': 'spam'})
+        reader = Tango.build_app('testsite')
+        reader.config['SHELF_SQLITE_FILEPATH'] = self.temp_filepath
+
+        seen = []
+        def items():
+            for rule in ('one', 'two', 'three'):
+                yield 'site', rule, {'spam': 'eggs'}
+                seen.append(reader.shelf.list('site'))
+        app.shelf.put_many(items(), batch_size=1)
+        self.assertEqual(seen, [[('site', 'one')]] * 3)
+        self.assertEqual(reader.shelf.get('site', 'three'), {'spam': 'eggs'})
+
+    def test_failed_batches_are_rolled_back(self):
+        app = self.build_app('testsite')
+        app.shelf.put('site', 'one', {'spam': 'spam'})
+        generation = app.shelf.generation('site')
+        def items():
+            yield 'site', 'one', {'spam': 'eggs'}
+            yield 'site', 'two', {'spam': 'eggs'}
+            raise RuntimeError('upstream is down')
+        self.assertRaises(RuntimeError, app.shelf.put_many, items(),
+                          batch_size=1)
+        self.assertEqual(app.shelf.generation('site'), generation)
+        self.assertEqual(app.shelf.get('site', 'one'), {'spam': 'spam'})
+        with app.shelf.connection() as db:
+            states = db.execute('SELECT state FROM generations '
+                                'WHERE site = ? AND generation > ?;',
+                                ('site', generation)).fetchall()
+        self.assertEqual(states, [('rolledback',)])
+
+    def test_log_lines_are_whole(self):
+        logfile = StringIO()
+        self.build_app('testsite').shelve_stream(logfile=logfile)
+        lines = logfile.getvalue().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            self.assertTrue(line.startswith(('Loading ', 'Stashing ')), line)
+            self.assertTrue(line.endswith(' ... done.'), line)
+
+
+class StreamingMergeTestCase(TempSiteTests, unittest.TestCase):
+
+    site = 'mergesite'
+
+    def setUp(self):
+        TempSiteTests.setUp(self)
+        self.write('mergesite/stash/first.py', '''"""
+site: mergesite
+routes:
+ - /x.txt
+ - /y.txt
+exports:
+ - first
+"""
+
+first = 1
+''')
+        self.write('mergesite/stash/second.py', '''"""
+site: mergesite
+routes:
+ - /x.txt
+exports:
+ - second
+"""
+
+import time
+time.sleep(0.5)
+second = 2
+''')
+
+    def shelved(self, **options):
+        self.forget_modules()
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            app = Tango.shelve_by_name('mergesite', jobs=2, **options)
+        shelf = dict((rule, app.shelf.get(site, rule))
+                     for site, rule in app.shelf.list('mergesite'))
+        app.shelf.drop('mergesite')
+        return shelf
+
+    def test_same_shelf_as_batch(self):
+        batch = self.shelved()
+        self.assertEqual(batch, {'/x.txt': {'first': 1, 'second': 2},
+                                 '/y.txt': {'first': 1}})
+        self.assertEqual(self.shelved(stream=True), batch)
+
+
+if __name__ == '__main__':
+    unittest.main()
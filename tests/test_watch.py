@@ -0,0 +1,133 @@
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from tango.watch import Watcher, shelve_forever
+
+from common_tests import TempSiteTests
+
+
+ONE = '''"""
+site: watchsite
+routes:
+ - /one.txt
+exports:
+ - title
+"""
+
+from watchsite.helpers import TITLE as title
+'''
+
+TWO = '''"""
+site: watchsite
+routes:
+ - /two.txt
+exports:
+ - title: Two
+"""
+'''
+
+
+class WatchTestCase(TempSiteTests, unittest.TestCase):
+
+    site = 'watchsite'
+
+    def setUp(self):
+        TempSiteTests.setUp(self)
+        self.write('watchsite/helpers.py', 'TITLE = "One"\n')
+        self.write('watchsite/stash/one.py', ONE)
+        self.write('watchsite/stash/two.py', TWO)
+
+    def site_config(self):
+        config = TempSiteTests.site_config(self)
+        config['SHELVE_STATE_DIR'] = os.path.join(self.temp_dir, 'state')
+        config['SHELVE_WATCH_DEBOUNCE'] = 0
+        return config
+
+    def watch(self, *edits):
+        "Shelve once, then again after each edit, an (filepath, content)."
+        pending = list(edits)
+
+        def sleep(seconds):
+            # Each wait for changes makes the next edit.
+            if pending:
+                self.write(*pending.pop(0))
+
+        logfile = StringIO()
+        app = shelve_forever('watchsite', logfile=logfile,
+                             runs=len(edits) + 1, sleep=sleep)
+        return app, logfile.getvalue().splitlines()
+
+    def test_changed_import_is_shelved_anew(self):
+        app, log = self.watch(('watchsite/helpers.py', 'TITLE = "Changed"\n'))
+        helpers = os.path.join(self.temp_dir, 'watchsite', 'helpers.py')
+        self.assertTrue('Changed: {0}.'.format(helpers) in log)
+        self.assertTrue('Pulling watchsite.stash.one: {0} changed.'
+                        .format(helpers) in log)
+        self.assertTrue('Skipping watchsite.stash.two: unchanged.' in log)
+        self.assertEqual(app.shelf.get('watchsite', '/one.txt'),
+                         {'title': 'Changed'})
+
+    def test_changed_config_pulls_every_module(self):
+        config = os.path.join(self.temp_dir, 'watchsite', 'config.py')
+        with open(config) as fd:
+            content = fd.read()
+        app, log = self.watch(('watchsite/config.py', content + '# Edit.\n'))
+        self.assertTrue('Pulling watchsite.stash.one: config changed.' in log)
+        self.assertTrue('Pulling watchsite.stash.two: config changed.' in log)
+
+    def test_failed_run_keeps_watching(self):
+        app, log = self.watch(
+            ('watchsite/stash/two.py', TWO + 'raise RuntimeError\n'),
+            ('watchsite/stash/two.py', TWO.replace('Two', 'Fixed')))
+        self.assertTrue('RuntimeError' in log)
+        self.assertEqual(app.shelf.get('watchsite', '/two.txt'),
+                         {'title': 'Fixed'})
+
+
+class WatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.filepaths = [os.path.join(self.temp_dir, name)
+                          for name in ('a.py', 'b.py')]
+        for filepath in self.filepaths:
+            open(filepath, 'w').close()
+        self.now = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_burst_of_edits_gives_one_change(self):
+        watcher = Watcher(lambda: self.filepaths)
+        # Edit a file on each of the first polls, then leave them be.
+        edits = [self.filepaths[0], self.filepaths[1], self.filepaths[0]]
+        polls = []
+
+        def sleep(seconds):
+            polls.append(seconds)
+            self.now += seconds
+            if edits:
+                with open(edits.pop(0), 'a') as fd:
+                    fd.write('edit')
+
+        changed = watcher.wait(1, 2, sleep=sleep, clock=lambda: self.now)
+        self.assertEqual(changed, self.filepaths)
+        # One poll sees the first edit, two more the rest of the burst, and
+        # two then find the files unchanged for the debounce time.
+        self.assertEqual(len(polls), 5)
+
+    def test_track_keeps_changes_since_wait(self):
+        watched = [self.filepaths[0]]
+        watcher = Watcher(lambda: watched)
+        with open(self.filepaths[0], 'a') as fd:
+            fd.write('edit')
+        watched.append(self.filepaths[1])
+        watcher.track()
+        self.assertEqual(watcher.wait(0, 0), [self.filepaths[0]])
+
+
+if __name__ == '__main__':
+    unittest.main()